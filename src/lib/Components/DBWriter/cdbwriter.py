@@ -7,6 +7,8 @@ __revision__ = '$Revision: 1 $'
 import os
 import sys
 import logging
+import collections
+import itertools
 import ConfigParser
 import traceback
 
@@ -41,6 +43,11 @@ def get_cdbwriter_config(option, default):
 
 class MessageQueue(Component):
    
+   """Queue of messages from other components, written to the database in
+   batches.  Once max_queued messages are waiting, further messages are
+   appended to the overflow file, which is read back from the point the
+   database writes have reached and removed once all of it is written."""
+
    name = "cdbwriter"
    implementation = "cdbwriter"
    logger = logging.getLogger("Cobalt.Components.cdbwriter")
@@ -51,6 +58,8 @@ class MessageQueue(Component):
    if not config._sections.has_key('cdbwriter'):
       logger.error('"cdbwriter" section missing from config file.')
    config = _config._sections['cdbwriter']
+   # most messages written to the database together
+   batch_size = int(get_cdbwriter_config('batch_size', '100'))
    mfields = [field for field in _configfields if not config.has_key(field)]
    if mfields:
       logger.error("Missing option(s) in cobalt config file [cdbwriter] section: %s" % (" ".join(mfields)))
@@ -61,13 +70,13 @@ class MessageQueue(Component):
       Component.__init__(self, *args, **kwargs)
       self.sync_state = Cobalt.Util.FailureMode("Foreign Data Sync")
       self.connected = False
-      self.msg_queue = []
+      self.msg_queue = collections.deque()
       self.decoder = LogMessageDecoder()
 
       self.overflow = False
       self.overflow_filename = None
+      self.overflow_offset = 0
       self.overflow_file = None
-      self.clearing_overflow = False
       
       self.max_queued = int(get_cdbwriter_config('max_queued_msgs', '-1'))
                         
@@ -86,17 +95,17 @@ class MessageQueue(Component):
        state.update(Component.__getstate__(self))
        state.update({
                'cdbwriter_version': 1,
-               'msg_queue': self.msg_queue,
-               'overflow': self.overflow})
+               'msg_queue': list(self.msg_queue),
+               'overflow': self.overflow,
+               'overflow_offset': self.overflow_offset})
        return state
              
    def __setstate__(self, state):
       Component.__setstate__(self, state)
 
-      self.msg_queue = state['msg_queue']
+      self.msg_queue = collections.deque(state['msg_queue'])
       self.connected = False
       self.decoder = LogMessageDecoder()
-      self.clearing_overflow = False
       self.overflow_filename = None
       self.overflow_file = None
       self.max_queued = int(get_cdbwriter_config('max_queued_msgs', '-1'))
@@ -113,8 +122,10 @@ class MessageQueue(Component):
 
       if state.has_key('overflow') and self.max_queued:
          self.overflow = state['overflow']
+         self.overflow_offset = state.get('overflow_offset', 0)
       else:
          self.overflow = False
+         self.overflow_offset = 0
 
    def init_database_connection(self):
       user = get_cdbwriter_config('user', None)
@@ -133,130 +144,140 @@ class MessageQueue(Component):
 
    def iterate(self):
       """Go through the messages that are sitting on the queue and
-      load them into the database."""
+      load them into the database, batch_size at a time."""
       
       #if we're not connected, try to reconnect to the database
       if not self.connected:
          logger.debug("Attempting reconnection.")
          self.init_database_connection()
-      
-      if self.connected and self.overflow:
-         self.clearing_overflow = True
-         self.open_overflow('r')
-         if self.overflow_file:
-            overflow_queue = [self.decoder.decode(line) 
-                              for line in self.overflow_file]
-            overflow_queue.extend(self.msg_queue)
-            self.msg_queue = overflow_queue
-            self.close_overflow()
-            self.del_overflow()
-            self.overflow = False
-
-      while self.msg_queue and self.connected:
-         msg = self.msg_queue[0]
 
+      while self.connected:
+         batch, offsets = self.next_batch()
+         if not batch:
+            break
          try:
-            self.database_writer.addMessage(msg)
-         except db2util.adapterError:
-            logger.error ("Error updating databse.  Unable to add message due to adapter error. Message dropped.")
-            logging.debug(traceback.format_exc())
-            self.msg_queue.pop(0)
+            written = self.database_writer.addMessages(batch)
          except:
-            logger.error ("Error updating databse.  Unable to add message.")
+            logger.error ("Error updating databse.  Unable to add messages.")
             logging.debug(traceback.format_exc())
+            written = 0
+         if offsets is None:
+            for _ in xrange(written):
+               self.msg_queue.popleft()
+         elif written:
+            self.overflow_offset = offsets[written - 1]
+         if written < len(batch):
             self.connected = False
-            #if we were clearing an overflow, here we go again.
-            if ((self.max_queued != None) and
-                (len(self.msg_queue) >= self.max_queued)):
-               self.overflow = True
-               self.open_overflow('a')
-               if self.overflow_file != None:
-                  self.queue_to_overflow()
-                  self.close_overflow()
-
-            break
-         else:
-            #message added
-            self.msg_queue.pop(0)
-            
-      self.clearing_overflow = False
 
    iterate = automatic(iterate)
 
+   def next_batch(self):
+      """Return the next messages to write and, for messages read from the
+      overflow file, the file offset following each of them."""
+      if self.msg_queue:
+         return list(itertools.islice(self.msg_queue, self.batch_size)), None
+      if not self.overflow:
+         return [], None
+      messages, offsets = self.read_overflow()
+      if not messages:
+         #the whole overflow file has been written
+         self.close_overflow()
+         self.del_overflow()
+         self.overflow = False
+         self.overflow_offset = 0
+      return messages, offsets
 
    def add_message(self, msg):
-     
-      #keep the queue from consuming all memory
-      if ((self.max_queued != None) and
-          (len(self.msg_queue) >= self.max_queued)and
-          (not self.clearing_overflow)):
-         
-         self.overflow = True
-         self.open_overflow('a')
-         if self.overflow_file == None:
-            logger.critical("MESSAGE DROPPED: %s", msg)
-         else:
-            self.queue_to_overflow()
-            self.close_overflow()
-      #and now queue as normal
+      self.queue_message(msg)
+   add_message = exposed(add_message)
 
-      msgDict = None
-   
+   def add_messages(self, msgs):
+      """Queue a batch of messages.  Returns the number of messages queued."""
+      queued = 0
+      for msg in msgs:
+         if self.queue_message(msg):
+            queued += 1
+      return queued
+   add_messages = exposed(add_messages)
+
+   def queue_message(self, msg):
+      """Decode a message and queue it, or append it to the overflow file
+      if too many messages are waiting."""
       try:
          msgDict = self.decoder.decode(msg)
-         
       except ValueError:
          logger.error("Bad message recieved.  Failed to decode string %s" % msg)
-         return
+         return False
       except:
          logging.debug(traceback.format_exc()) 
+         return False
 
-      self.msg_queue.append(msgDict) 
-      
-   add_message = exposed(add_message)
-   
+      #keep the queue from consuming all memory
+      if (self.overflow or
+          ((self.max_queued != None) and
+           (len(self.msg_queue) >= self.max_queued))):
+         return self.spill(msgDict)
+
+      self.msg_queue.append(msgDict)
+      return True
    
    def save_me(self):
       Component.save(self)
    save_me = automatic(save_me)
 
 
-   def open_overflow(self, mode):
-        
+   def spill(self, msg):
+      """Append a message to the overflow file."""
       try:
-         self.overflow_file = open(self.overflow_filename,mode)
-      except:
+         if self.overflow_file is None:
+            self.overflow_file = open(self.overflow_filename, 'a')
+         self.overflow_file.write(json.dumps(msg, cls=LogMessageEncoder)+'\n')
+         self.overflow_file.flush()
+      except (IOError, TypeError):
+         self.logger.critical("Unable to write overflow file!  Information to database will be lost!")
+         logger.critical("MESSAGE DROPPED: %s", json.dumps(msg, cls=LogMessageEncoder))
+         self.close_overflow()
+         return False
+      self.overflow = True
+      return True
+
+   def read_overflow(self):
+      """Read the next batch of messages from the overflow file, starting
+      at overflow_offset.  Returns the messages and the file offset
+      following each one."""
+      messages = []
+      offsets = []
+      try:
+         overflow = open(self.overflow_filename, 'r')
+      except (IOError, TypeError):
          self.logger.critical("Unable to open overflow file!  Information to database will be lost!")
+         return messages, offsets
+      try:
+         overflow.seek(self.overflow_offset)
+         while len(messages) < self.batch_size:
+            line = overflow.readline()
+            if not line.endswith('\n'):
+               break
+            try:
+               messages.append(self.decoder.decode(line))
+            except ValueError:
+               logger.error("Bad message in overflow file.  Failed to decode string %s" % line)
+               continue
+            offsets.append(overflow.tell())
+      finally:
+         overflow.close()
+      return messages, offsets
 
    def close_overflow(self):
-      if self.overflow and self.overflow_file:
+      if self.overflow_file:
          self.overflow_file.close()
          self.overflow_file = None
     
    def del_overflow(self):
-      os.remove(self.overflow_filename)
-        
-
-   def queue_to_overflow(self):
-        
-      elements_written = 0
-      if len(self.msg_queue) == 0:
-         return
-
-      while self.msg_queue:
-         msg = self.msg_queue.pop(0)
-         try:
-            self.overflow_file.write(json.dumps(msg, cls=LogMessageEncoder)+'\n')
-            elements_written += 1
-         except IOError:
-            logger.error('Could only partially empty queue, %d messages written' % 
-                         elements_written)
-            self.msg_queue.insert(0, msg)
-                
-      if elements_written > 0:
-         del self.msg_queue[0:elements_written-1] #empty the queue of what we have written
-        
-      return len(self.msg_queue)
+      try:
+         os.remove(self.overflow_filename)
+      except (OSError, TypeError):
+         pass
 
 #for storing the message queue to avoid memory problems:
 def encodeLogMsg(logMsg):
@@ -280,6 +301,8 @@ class DatabaseWriter(object):
          raise
 
       self.schema = schema
+      #JOB_PROG records held back for one multi-row insert per batch
+      self.job_prog_records = None
 
       table_names = ['RESERVATION_DATA', 'RESERVATION_PARTS',
                      'RESERVATION_EVENTS', 'RESERVATION_USERS',
@@ -326,6 +349,50 @@ class DatabaseWriter(object):
       #we opened with a schema, let's make that the default for now.
       self.db.prepExec("set current schema %s" % schema)
       
+   def addMessages(self, logMsgs):
+      """Write a batch of messages.  The JOB_PROG records of the batch are
+      written together with one multi-row insert at the end; insert_many
+      drops only the records the adapter rejects.
+
+      Returns the number of messages handled before an error.  Messages
+      rejected by the adapter are dropped and count as handled.  If the
+      JOB_PROG records cannot be written for another reason, such as a lost
+      connection, only the messages before the first one with JOB_PROG
+      records count as handled, so the rest stay queued.
+      """
+      self.job_prog_records = []
+      handled = 0
+      # the first message to hold back if the JOB_PROG insert fails
+      job_prog_start = None
+      try:
+         for logMsg in logMsgs:
+            held = len(self.job_prog_records)
+            try:
+               self.addMessage(logMsg)
+            except db2util.adapterError:
+               logger.error ("Error updating databse.  Unable to add message due to adapter error. Message dropped.")
+               logging.debug(traceback.format_exc())
+               del self.job_prog_records[held:]
+            except:
+               logger.error ("Error updating databse.  Unable to add message.")
+               logging.debug(traceback.format_exc())
+               del self.job_prog_records[held:]
+               break
+            if job_prog_start is None and len(self.job_prog_records) > held:
+               job_prog_start = handled
+            handled += 1
+         if self.job_prog_records:
+            try:
+               self.daos['JOB_PROG'].insert_many(self.job_prog_records)
+            except:
+               logger.error ("Error updating databse.  Unable to add JOB_PROG records; %d messages left queued." %
+                             (handled - job_prog_start))
+               logging.debug(traceback.format_exc())
+               handled = job_prog_start
+      finally:
+         self.job_prog_records = None
+      return handled
+
    def addMessage(self, logMsg):
 
       logger.debug("Inserting Data message of type: %s.%s " % (logMsg.item_type, logMsg.state))
@@ -373,24 +440,22 @@ class DatabaseWriter(object):
       part_list = logMsg.item.partitions.split(':')
       
       if part_list[0] != '':
-         for partition in part_list:
-            res_partitions_record = self.daos['RESERVATION_PARTS'].table.getRecord({
+         self.daos['RESERVATION_PARTS'].insert_many([
+            self.daos['RESERVATION_PARTS'].table.getRecord({
                'RES_DATA_ID': res_data_id,
                'NAME': partition
-               })
-            self.daos['RESERVATION_PARTS'].insert(res_partitions_record)
+               }) for partition in part_list])
       
 
       if logMsg.item.users:
          user_list = logMsg.item.users.split(':')
 
          if user_list[0] != '':
-            for user in user_list:
-               res_users_record = self.daos['RESERVATION_USERS'].table.getRecord({
+            self.daos['RESERVATION_USERS'].insert_many([
+               self.daos['RESERVATION_USERS'].table.getRecord({
                      'RES_DATA_ID': res_data_id,
                      'NAME': user #eventually a FK into users from cbank?
-                     }) 
-               self.daos['RESERVATION_USERS'].insert(res_users_record)
+                     }) for user in user_list])
 
             
       reservation_event_record = self.daos['RESERVATION_EVENTS'].table.getRecord({'NAME': logMsg.state})
@@ -497,12 +562,12 @@ class DatabaseWriter(object):
       
       #populate job_attrs, if needed.
       try:
-          for key in specialObjects['attrs'].keys():
-              job_attr_record = self.daos['JOB_ATTR'].table.getRecord({
+          self.daos['JOB_ATTR'].insert_many([
+              self.daos['JOB_ATTR'].table.getRecord({
                       'JOB_DATA_ID' : job_data_id,
                       'KEY' : key,
                       'VALUE' : str(specialObjects['attrs'][key])})
-              self.daos['JOB_ATTR'].insert(job_attr_record)
+              for key in specialObjects['attrs'].keys()])
       except AttributeError:
           logger.error('Bad formatting on attrs.  Add these later. Got %s', specialObjects['attrs'])
       
@@ -521,11 +586,11 @@ class DatabaseWriter(object):
       #parse and add users:
 
       if specialObjects.has_key('job_user_list'):
-        for user_name in specialObjects['job_user_list']:
-            job_run_users_record = self.daos['JOB_RUN_USERS'].table.getRecord({
+        self.daos['JOB_RUN_USERS'].insert_many([
+            self.daos['JOB_RUN_USERS'].table.getRecord({
                   'JOB_DATA_ID' : job_data_id,
                   'USER_NAME' : user_name})
-            self.daos['JOB_RUN_USERS'].insert(job_run_users_record)
+            for user_name in specialObjects['job_user_list']])
 
 
       self.__addJobProgMsg(logMsg, logMsg.item.job_prog_msg, job_data_id)
@@ -612,7 +677,14 @@ class DatabaseWriter(object):
       job_prog_record.v.EXEC_USER = logMsg.exec_user
       job_prog_record.v.ENTRY_TIME = logMsg.timestamp
 
-      self.daos['JOB_PROG'].insert(job_prog_record)
+      if self.job_prog_records is None:
+         self.daos['JOB_PROG'].insert(job_prog_record)
+      else:
+         invalidFields = job_prog_record.invalidFields()
+         if invalidFields:
+            raise db2util.adapterError("Validation error prior to insert.\n\nTable: %s\n\nField(s): %s\n" %
+                                       (job_prog_record.fqtn, str(invalidFields)))
+         self.job_prog_records.append(job_prog_record)
       
       job_data_record = None
       job_data_record = self.daos['JOB_DATA'].getID(job_data_id)
@@ -716,6 +788,57 @@ class DatabaseWriter(object):
       
    
    
+class MultiRowInsert(object):
+
+   """dao mixin that writes several records of its table with one insert
+   statement."""
+
+   def insert_many (self, records):
+      """Insert the passed records.  Records that set different fields are
+      written by separate statements.  Identity values are not returned.
+
+      If the adapter rejects a multi-row statement, its records are
+      inserted one at a time and only the records that are rejected are
+      dropped, so that one bad record does not hold back the rest.  Records
+      failing validation are dropped as well.  Any other error, such as a
+      lost connection, is raised.  Returns the number of records dropped."""
+      statements = {}
+      dropped = 0
+      for record in records:
+         invalidFields = record.invalidFields()
+         if invalidFields:
+            logger.error("Validation error prior to insert.  Table: %s Field(s): %s  Record dropped." %
+                         (record.fqtn, str(invalidFields)))
+            dropped += 1
+            continue
+         names = db2util.valueFormatter(record, db2util.FFORMAT.NAMES)
+         places = db2util.valueFormatter(record, db2util.FFORMAT.PLACES)
+         values = db2util.helpers.num2str(db2util.valueFormatter(record, db2util.FFORMAT.VALUES))
+         group_records, rows, all_values = statements.setdefault((names, places), ([], [], []))
+         group_records.append((record, values))
+         rows.append("(%s)" % places)
+         all_values.extend(values)
+      for (names, places), (group_records, rows, all_values) in statements.iteritems():
+         insertSQL = "insert into %s (%s) values %s" % (self.table.fqName, names, ", ".join(rows))
+         try:
+            self.db.prepExec(insertSQL, all_values)
+            continue
+         except db2util.adapterError:
+            logger.warning("Multi-row insert into %s failed.  Inserting %d records one at a time." %
+                           (self.table.fqName, len(group_records)))
+            logging.debug(traceback.format_exc())
+         insertSQL = "insert into %s (%s) values (%s)" % (self.table.fqName, names, places)
+         for record, values in group_records:
+            try:
+               self.db.prepExec(insertSQL, values)
+            except db2util.adapterError:
+               logger.error("Error updating databse.  Unable to insert record into %s.  Record dropped." %
+                            self.table.fqName)
+               logging.debug(traceback.format_exc())
+               dropped += 1
+      return dropped
+
+
 class StateTableData(db2util.dao):
    
    def getStatesDict(self):
@@ -825,7 +948,7 @@ class JobDataData(db2util.dao):
 
 
       
-class JobProgData(db2util.dao):
+class JobProgData(MultiRowInsert, db2util.dao):
 
    """helpers for getting at job progress data"""
    
@@ -863,7 +986,7 @@ class JobDepsData(db2util.dao):
 
       return self.db.getDict(' '.join(SQL))
 
-class no_pk_dao(db2util.dao):
+class no_pk_dao(MultiRowInsert, db2util.dao):
     
     def insert (self, record):
         """Inserts the passed record and returns the IDENTITY value
@@ -872,7 +995,7 @@ class no_pk_dao(db2util.dao):
         invalidFields = record.invalidFields()
         
         if invalidFields:
-            raise adapterError("Validation error prior to insert.\n\nTable: %s\n\nField(s): %s\n" % (record.fqtn, str(invalidFields)))
+            raise db2util.adapterError("Validation error prior to insert.\n\nTable: %s\n\nField(s): %s\n" % (record.fqtn, str(invalidFields)))
         
         insertSQL = "insert into %s (%s) values (%s)" %(
             self.table.fqName,
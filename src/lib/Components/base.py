@@ -19,10 +19,12 @@ import xmlrpclib
 import Cobalt
 import Cobalt.Proxy
 import Cobalt.Logging
-from Cobalt.Server import BaseXMLRPCServer, XMLRPCServer, find_intended_location
+from Cobalt.Server import BaseXMLRPCServer, XMLRPCServer, PooledXMLRPCServer, \
+        find_intended_location
 from Cobalt.Data import get_spec_fields
 from Cobalt.Exceptions import NoExposedMethod
-from Cobalt.Statistics import Statistics
+from Cobalt.Statistics import Statistics, CallProfile
+from Cobalt.Journal import StateJournal, read_journal
 import Cobalt.Util
 init_cobalt_config = Cobalt.Util.init_cobalt_config
 get_config_option = Cobalt.Util.get_config_option
@@ -40,6 +42,33 @@ except Exception, e:
     sys.exit(1)
 
 
+def get_journal_settings():
+    '''Read the [statefiles] journal options.
+
+    Returns None when journaling is disabled, otherwise a dictionary of the
+    sync policy and interval and the compaction interval and minimum size.
+
+    '''
+    enabled = get_config_option('statefiles', 'journal', 'false')
+    if enabled.lower() not in Cobalt.Util.config_true_values:
+        return None
+    return {'sync':get_config_option('statefiles', 'journal_sync', 'interval'),
+            'sync_interval':float(get_config_option('statefiles', 'journal_sync_interval', 5)),
+            'compact_interval':float(get_config_option('statefiles', 'journal_compact_interval', 300)),
+            'compact_size':int(get_config_option('statefiles', 'journal_compact_size', 1048576))}
+
+_journal_containers = (list, dict, set)
+
+def _copy_containers (value):
+    """Copy the lists, dicts and sets in a value, sharing anything else."""
+    if type(value) is list:
+        return [_copy_containers(element) for element in value]
+    if type(value) is dict:
+        return dict([(key, _copy_containers(element)) for key, element in value.iteritems()])
+    if type(value) is set:
+        return set(value)
+    return value
+
 def state_file_location():
 
     '''Grab the location of the Cobalt statefiles.  
@@ -125,6 +154,10 @@ def run_component (component_cls, argv=None, register=True, state_name=False,
             component = component_cls(**cls_kwargs)
             component.logger.error("UNABLE TO LOAD STATE FROM %s.  STARTING WITH A BLANK SLATE.", state_file_name, exc_info=True)
         component.statefile = state_file_name
+        try:
+            component.replay_journal()
+        except:
+            component.logger.error("UNABLE TO REPLAY STATE JOURNAL FOR %s.", state_file_name, exc_info=True)
     else:
         component = component_cls(**cls_kwargs)
 
@@ -138,9 +171,21 @@ def run_component (component_cls, argv=None, register=True, state_name=False,
         certpath = None
         capath = None
 
+    # a component may have its requests served by a fixed pool of threads
+    # by setting server_workers in its own config section
+    workers = int(get_config_option(component.implementation, 'server_workers', 0))
+
     if single_threaded:
         server = BaseXMLRPCServer(location, keyfile=keypath, certfile=certpath, 
                           cafile=capath, register=register, timeout=time_out)
+    elif workers > 0:
+        server = PooledXMLRPCServer(location, keyfile=keypath, certfile=certpath,
+                          cafile=capath, register=register, timeout=time_out,
+                          workers=workers,
+                          backlog=int(get_config_option(component.implementation,
+                              'server_backlog', 4 * workers)),
+                          queue_timeout=float(get_config_option(component.implementation,
+                              'server_queue_timeout', 60)))
     else:
         server = XMLRPCServer(location, keyfile=keypath, certfile=certpath,
                           cafile=capath, register=register, timeout=time_out)
@@ -175,10 +220,15 @@ def exposed (func):
     func.exposed = True
     return func
 
-def automatic (func, period=10):
-    """Mark a method to be run periodically."""
+def automatic (func, period=10, min_spacing=0):
+    """Mark a method to be run periodically.
+
+    A task woken through Component.wake_task runs before its period is up,
+    but never sooner than min_spacing seconds after its last run.
+    """
     func.automatic = True
     func.automatic_period = period
+    func.automatic_min_spacing = min_spacing
     func.automatic_ts = -1
     return func
 
@@ -188,7 +238,11 @@ def locking (func):
     return func
 
 def readonly (func):
-    """Mark a function as read-only -- no data effects in component inst"""
+    """Mark a function as read-only -- no data effects in component inst
+
+    Read-only exposed methods hold the component lock shared, so they run
+    concurrently with each other but never alongside other methods.
+    """
     func.readonly = True
     return func
 
@@ -227,10 +281,21 @@ class Component (object):
     save -- pickle the component to a file
     do_tasks -- perform automatic tasks for the component
 
+    A component whose statefile is dominated by large collections of items
+    can have save journal changes to those items between full snapshots by
+    implementing journal_collections and journal_replace (and, for other
+    state that changes with them, journal_extra and journal_restore_extra).
+    Journaling is enabled with the [statefiles] journal option.
+
     """
 
     name = "component"
     implementation = "generic"
+    profile_window = 300
+    profile_slots = 10
+    # collection name -> fields that may be journaled on their own when they
+    # are the only ones to change; any other change journals the whole item
+    journal_delta_fields = {}
 
     def __init__ (self, **kwargs):
         """Initialize a new component.
@@ -245,15 +310,24 @@ class Component (object):
         else:
             self._registered_component=False
         self.logger = logging.getLogger("%s %s" % (self.implementation, self.name))
-        self._component_lock = threading.Lock()
+        self._component_lock = Cobalt.Util.ReadWriteLock()
         self._component_lock_acquired_time = None
+        self._component_lock_holder = None
         self.statistics = Statistics()
+        self.profile = CallProfile(self.profile_window, self.profile_slots)
+        self._task_wakeup = threading.Event()
+        self._woken_tasks = set()
+        self._scheduler_notify_lock = threading.Lock()
+        self._scheduler_notifications = set()
+        self._journal_generation = 0
+        self._journal_reset()
 
     def __getstate__(self):
         state = {}
         return {
             'base_component_version':1,
-            'register_component':self._registered_component}
+            'register_component':self._registered_component,
+            'journal_generation':self._journal_generation}
 
     def __setstate__(self, state):
         Cobalt.Util.fix_set(state)
@@ -263,55 +337,347 @@ class Component (object):
         else:
             self._registered_component=False
         self.logger = logging.getLogger("%s %s" % (self.implementation, self.name))
-        self._component_lock = threading.Lock()
+        self._component_lock = Cobalt.Util.ReadWriteLock()
         self._component_lock_acquired_time = None
+        self._component_lock_holder = None
         self.statistics = Statistics()
+        self.profile = CallProfile(self.profile_window, self.profile_slots)
+        self._task_wakeup = threading.Event()
+        self._woken_tasks = set()
+        self._scheduler_notify_lock = threading.Lock()
+        self._scheduler_notifications = set()
+        self._journal_generation = state.get('journal_generation', 0)
+        self._journal_reset()
+
+    def component_lock_acquire(self, holder=None):
+        """Acquire the component lock.
 
-    def component_lock_acquire(self):
+        Arguments:
+        holder -- name the lock time is charged to in the profile; defaults
+                  to the calling function's name
+        """
+        if holder is None:
+            holder = sys._getframe(1).f_code.co_name
         entry_time = time.time()
+        blocked_by = self._component_lock_holder
         self._component_lock.acquire()
         self._component_lock_acquired_time = time.time()
-        self.statistics.add_value('component_lock_wait', self._component_lock_acquired_time - entry_time)
+        self._component_lock_holder = holder
+        waited = self._component_lock_acquired_time - entry_time
+        self.statistics.add_value('component_lock_wait', waited)
+        self.profile.add_lock_wait(blocked_by, waited)
 
     def component_lock_release(self):
-        self.statistics.add_value('component_lock_held', time.time() - self._component_lock_acquired_time)
+        held = time.time() - self._component_lock_acquired_time
+        self.statistics.add_value('component_lock_held', held)
+        self.profile.add_lock_held(self._component_lock_holder, held)
         self._component_lock_acquired_time = None
+        self._component_lock_holder = None
         self._component_lock.release()
 
+    def component_lock_acquire_read(self, holder=None):
+        """Acquire the component lock shared with other readers.
+
+        Only for code that does not modify component state.  Returns the
+        time the lock was acquired, to be passed to
+        component_lock_release_read.
+        """
+        if holder is None:
+            holder = sys._getframe(1).f_code.co_name
+        entry_time = time.time()
+        blocked_by = self._component_lock_holder
+        self._component_lock.acquire_read()
+        acquired_time = time.time()
+        self.statistics.add_value('component_lock_wait', acquired_time - entry_time)
+        self.profile.add_lock_wait(blocked_by, acquired_time - entry_time)
+        return acquired_time
+
+    def component_lock_release_read(self, acquired_time, holder=None):
+        if holder is None:
+            holder = sys._getframe(1).f_code.co_name
+        held = time.time() - acquired_time
+        self.statistics.add_value('component_lock_read_held', held)
+        self.profile.add_lock_held("%s (read)" % holder, held)
+        self._component_lock.release_read()
+
     def save (self, statefile=None):
         """Pickle the component.
 
+        When journaling is enabled and the component supports it, saving to
+        component.statefile appends the changes since the last save to the
+        journal, and only writes a full snapshot when the journal is due
+        for compaction.
+
         Arguments:
         statefile -- use this file, rather than component.statefile
         """
         statefile = statefile or self.statefile
         if statefile:
-            temp_statefile = statefile + ".temp"
-            data = cPickle.dumps(self)
+            if statefile == self.statefile:
+                collections = self.journal_collections()
+                if collections is not None:
+                    settings = get_journal_settings()
+                    if settings is not None:
+                        return self._save_journaled(statefile, collections, settings)
+                # any journal left from before no longer applies
+                self._journal_generation += 1
             try:
-                fd = file(temp_statefile, "wb")
-                fd.write(data)
-                fd.close()
+                self._write_statefile(statefile)
             except IOError, e:
                 self.logger.error("statefile failure : %s" % e)
                 return str(e)
             else:
-                os.rename(temp_statefile, statefile)
                 return "state saved to file: %s" % statefile
     save = exposed(save)
 
+    def _write_statefile (self, statefile):
+        """Write a full snapshot of the component; returns its size."""
+        temp_statefile = statefile + ".temp"
+        data = cPickle.dumps(self)
+        fd = file(temp_statefile, "wb")
+        fd.write(data)
+        fd.close()
+        os.rename(temp_statefile, statefile)
+        return len(data)
+
+    def journal_collections (self):
+        """Return the collections of items to save through the journal.
+
+        The result maps a collection name to a dictionary of items by key.
+        Items should be versioned Data so that unchanged ones are skipped
+        cheaply.  The default of None saves full snapshots only.
+        """
+        return None
+
+    def journal_replace (self, collection, key, item):
+        """Install a journaled item during replay, or remove it if item is None.
+
+        Abstract; a component whose journal_collections returns collections
+        must implement it.  Journals are not replayed for other components.
+        """
+        raise NotImplementedError
+
+    def journal_extra (self):
+        """Return other small state to journal when it changes."""
+        return {}
+
+    def journal_restore_extra (self, extra):
+        """Restore state returned by journal_extra during replay."""
+        pass
+
+    def journal_snapshot (self):
+        """Write a full snapshot on the next save.
+
+        For changes to state that is neither in the journaled collections
+        nor in journal_extra.
+        """
+        self._journal_snapshot_due = True
+
+    def _journal_reset (self):
+        self._journal = None
+        self._journal_baseline = None
+        self._journal_extra = None
+        self._journal_snapshot_due = True
+        self._journal_snapshot_time = 0
+        self._journal_snapshot_size = 0
+
+    def _journal_persistent_id (self, obj):
+        # items may refer back to the component (through callbacks, for
+        # instance); journal those references rather than the component
+        if obj is self:
+            return "component"
+        return None
+
+    def _journal_persistent_load (self, persistent_id):
+        if persistent_id == "component":
+            return self
+        raise cPickle.UnpicklingError("unknown journal reference %r" % (persistent_id, ))
+
+    def _journal_state (self, item):
+        """Return a copy of the fields of an item to compare against later,
+        and the names of the fields that hold lists, dicts or sets.
+
+        Those are copied as well, since they may be changed in place without
+        a new version being issued for the item.
+        """
+        state = {}
+        mutable = []
+        for field, value in item.__dict__.iteritems():
+            if field in ('_version', '_index_owners'):
+                continue
+            if type(value) in _journal_containers:
+                value = _copy_containers(value)
+                mutable.append(field)
+            state[field] = value
+        return state, mutable
+
+    def _save_journaled (self, statefile, collections, settings):
+        now = time.time()
+        if self._journal is None:
+            self._journal = StateJournal(statefile + ".journal",
+                    settings['sync'], settings['sync_interval'], self._journal_persistent_id)
+        if self._journal_snapshot_due or \
+                now - self._journal_snapshot_time > settings['compact_interval'] or \
+                self._journal.size > max(self._journal_snapshot_size, settings['compact_size']):
+            return self._compact_journal(statefile, collections)
+
+        records = []
+        for name, items in collections.iteritems():
+            baseline = self._journal_baseline.setdefault(name, {})
+            delta_fields = self.journal_delta_fields.get(name, ())
+            for key, item in items.iteritems():
+                version = item.__dict__.get('_version')
+                entry = baseline.get(key)
+                if entry is not None and version is not None and entry[0] == version:
+                    old_state = entry[1]
+                    for field in entry[2]:
+                        if item.__dict__.get(field) != old_state[field]:
+                            break
+                    else:
+                        continue
+                state, mutable = self._journal_state(item)
+                if entry is None:
+                    records.append(('put', name, key, item))
+                else:
+                    old_state = entry[1]
+                    changed = [field for field, value in state.iteritems()
+                               if field not in old_state or
+                               (old_state[field] is not value and old_state[field] != value)]
+                    removed = [field for field in old_state if field not in state]
+                    if removed:
+                        records.append(('put', name, key, item))
+                    elif not changed:
+                        pass
+                    elif not [field for field in changed if field not in delta_fields]:
+                        records.append(('set', name, key,
+                                        dict([(field, state[field]) for field in changed])))
+                    else:
+                        records.append(('put', name, key, item))
+                baseline[key] = (version, state, mutable)
+            for key in [key for key in baseline if key not in items]:
+                records.append(('del', name, key))
+                del baseline[key]
+        extra = self.journal_extra()
+        if extra != self._journal_extra:
+            records.append(('extra', extra))
+            self._journal_extra = extra
+
+        if not records:
+            return "no changes to journal"
+        try:
+            self._journal.append(records)
+        except (IOError, OSError), e:
+            self.logger.error("journal failure : %s" % e)
+            self._journal_snapshot_due = True
+            return str(e)
+        return "%d changes journaled to %s" % (len(records), self._journal.path)
+
+    def _compact_journal (self, statefile, collections):
+        """Write a snapshot and start a new journal after it."""
+        self._journal_generation += 1
+        try:
+            size = self._write_statefile(statefile)
+            self._journal.reset(self._journal_generation)
+        except (IOError, OSError), e:
+            self.logger.error("statefile failure : %s" % e)
+            self._journal.close()
+            self._journal_snapshot_due = True
+            return str(e)
+        self._journal_baseline = {}
+        for name, items in collections.iteritems():
+            self._journal_baseline[name] = dict([
+                (key, (item.__dict__.get('_version'), ) + self._journal_state(item))
+                for key, item in items.iteritems()])
+        self._journal_extra = self.journal_extra()
+        self._journal_snapshot_due = False
+        self._journal_snapshot_time = time.time()
+        self._journal_snapshot_size = size
+        return "state saved to file: %s" % statefile
+
+    def replay_journal (self):
+        """Apply the changes journaled since the statefile was written.
+
+        Returns the number of records replayed.  A journal left by a
+        different snapshot than the one loaded is ignored.
+        """
+        generation, batches = read_journal(self.statefile + ".journal",
+                                           self._journal_persistent_load)
+        if generation is None:
+            return 0
+        if generation != self._journal_generation:
+            self.logger.info("ignoring journal for snapshot %s; statefile is snapshot %s",
+                             generation, self._journal_generation)
+            return 0
+        collections = self.journal_collections()
+        if collections is None:
+            self.logger.info("ignoring journal; this component does not journal its state")
+            return 0
+        replayed = 0
+        for batch in batches:
+            for record in batch:
+                if record[0] == 'put':
+                    name, key, item = record[1:]
+                    self.journal_replace(name, key, item)
+                    collections.setdefault(name, {})[key] = item
+                elif record[0] == 'set':
+                    name, key, fields = record[1:]
+                    item = collections.get(name, {}).get(key)
+                    if item is None:
+                        self.logger.error("journal updates unknown item %s in %s", key, name)
+                        continue
+                    for field, value in fields.iteritems():
+                        setattr(item, field, value)
+                elif record[0] == 'del':
+                    name, key = record[1:]
+                    self.journal_replace(name, key, None)
+                    collections.get(name, {}).pop(key, None)
+                elif record[0] == 'extra':
+                    self.journal_restore_extra(record[1])
+                replayed += 1
+        self.logger.info("replayed %d journaled changes from %d saves", replayed, len(batches))
+        return replayed
+
+    def wake_task (self, name):
+        """Ask for an automatic task to run ahead of its period.
+
+        Wakeups for the same task are coalesced until it next runs.
+        """
+        func = getattr(self, name, None)
+        if not getattr(func, "automatic", False):
+            raise ValueError("%s is not an automatic task" % name)
+        self._woken_tasks.add(name)
+        self._task_wakeup.set()
+
+    def wait_for_tasks (self, timeout):
+        """Sleep until timeout expires or a woken task is due to run."""
+        self._task_wakeup.clear()
+        deadline = time.time() + timeout
+        for name in list(self._woken_tasks):
+            func = getattr(self, name)
+            deadline = min(deadline,
+                    func.automatic_ts + func.automatic_min_spacing)
+        delay = deadline - time.time()
+        if delay > 0:
+            self._task_wakeup.wait(delay)
+
     def do_tasks (self):
         """Perform automatic tasks for the component.
 
         Automatic tasks are member callables with an attribute
-        automatic == True.
+        automatic == True.  They run once their period has elapsed, or
+        earlier if woken and at least automatic_min_spacing seconds have
+        passed since their last run.
         """
         for name, func in inspect.getmembers(self, callable):
             if getattr(func, "automatic", False):
                 need_to_lock = not getattr(func, 'locking', False)
-                if (time.time() - func.automatic_ts) > func.automatic_period:
+                since_last = time.time() - func.automatic_ts
+                woken = name in self._woken_tasks and \
+                        since_last >= getattr(func, 'automatic_min_spacing', 0)
+                if woken or since_last > func.automatic_period:
+                    self._woken_tasks.discard(name)
                     if need_to_lock:
-                        self.component_lock_acquire()
+                        self.component_lock_acquire(name)
                     try:
                         mt1 = time.time()
                         func()
@@ -320,12 +686,45 @@ class Component (object):
                                           % (name), exc_info=1)
                     finally:
                         mt2 = time.time()
+                        self.profile.add_call(name, mt2-mt1, "automatic")
                         if not need_to_lock:
-                            self.component_lock_acquire()
+                            self.component_lock_acquire(name)
                         self.statistics.add_value(name, mt2-mt1)
                         self.component_lock_release()
                         func.__dict__['automatic_ts'] = time.time()
 
+    def notify_scheduler (self, reason):
+        """Nudge the scheduler to run a pass soon.
+
+        Safe to call with the component lock held; notifications are
+        collected here and sent by flush_scheduler_notifications.
+        """
+        self._scheduler_notify_lock.acquire()
+        try:
+            self._scheduler_notifications.add(reason)
+        finally:
+            self._scheduler_notify_lock.release()
+        self.wake_task('flush_scheduler_notifications')
+
+    def flush_scheduler_notifications (self):
+        """Send any pending notify_scheduler reasons in a single call."""
+        self._scheduler_notify_lock.acquire()
+        try:
+            reasons = self._scheduler_notifications
+            self._scheduler_notifications = set()
+        finally:
+            self._scheduler_notify_lock.release()
+        if not reasons:
+            return
+        try:
+            Cobalt.Proxy.ComponentProxy("scheduler", retry=False).wake_scheduler(
+                    ", ".join(sorted(reasons)))
+        except:
+            self.logger.debug("unable to notify the scheduler (%s)",
+                    ", ".join(sorted(reasons)), exc_info=1)
+    flush_scheduler_notifications = locking(automatic(
+        flush_scheduler_notifications, 60))
+
     def _resolve_exposed_method (self, method_name):
         """Resolve an exposed method.
 
@@ -340,11 +739,12 @@ class Component (object):
             raise NoExposedMethod(method_name)
         return func
 
-    def _dispatch (self, method, args, dispatch_dict):
+    def _dispatch (self, method, args, dispatch_dict, caller=None):
         """Custom XML-RPC dispatcher for components.
 
         method -- XML-RPC method name
         args -- tuple of paramaters to method
+        caller -- address of the client, recorded in the call profile
         """
         if method in dispatch_dict:
             method_func = dispatch_dict[method]
@@ -357,8 +757,11 @@ class Component (object):
                 raise xmlrpclib.Fault(getattr(e, "fault_code", 1), str(e))
 
         need_to_lock = not getattr(method_func, 'locking', False)
-        if need_to_lock:
-            self.component_lock_acquire()
+        read_only = need_to_lock and getattr(method_func, 'readonly', False)
+        if read_only:
+            read_acquired_time = self.component_lock_acquire_read(method)
+        elif need_to_lock:
+            self.component_lock_acquire(method)
         try:
             method_start = time.time()
             result = method_func(*args)
@@ -368,10 +771,20 @@ class Component (object):
             raise xmlrpclib.Fault(getattr(e, "fault_code", 1), str(e))
         finally:
             method_done = time.time()
-            if not need_to_lock:
-                self.component_lock_acquire()
-            self.statistics.add_value(method, method_done - method_start)
-            self.component_lock_release()
+            self.profile.add_call(method, method_done - method_start,
+                    caller or "local")
+            if read_only:
+                self.statistics.add_value(method, method_done - method_start)
+                self.component_lock_release_read(read_acquired_time, method)
+            else:
+                if not need_to_lock:
+                    self.component_lock_acquire(method)
+                self.statistics.add_value(method, method_done - method_start)
+                self.component_lock_release()
+        return self._marshal_result(method_func, args, result)
+
+    def _marshal_result (self, method_func, args, result):
+        """Marshal the result of a query method for transport."""
         if getattr(method_func, "query", False):
             if not getattr(method_func, "query_all_methods", False):
                 margs = args[:1]
@@ -380,6 +793,84 @@ class Component (object):
             result = marshal_query_result(result, *margs)
         return result
 
+    def _dispatch_multicall (self, calls, dispatch_dict, caller=None):
+        """Run a batch of XML-RPC calls (system.multicall).
+
+        Arguments:
+        calls -- list of {'methodName':name, 'params':args} dictionaries
+        dispatch_dict -- as for _dispatch
+        caller -- address of the client, recorded in the call profile
+
+        The calls run in order.  A batch of readonly methods shares the
+        component lock once; otherwise the lock is held exclusively across
+        each run of methods that need it and released around locking
+        methods, which take it themselves.  Returns a list holding [result]
+        for each call that succeeded and a fault dictionary for each call
+        that failed.
+        """
+        resolved = []
+        for call in calls:
+            method = call.get('methodName')
+            try:
+                if method in dispatch_dict:
+                    method_func = dispatch_dict[method]
+                else:
+                    method_func = self._resolve_exposed_method(method)
+            except Exception, e:
+                if getattr(e, "log", True):
+                    self.logger.error(e, exc_info=True)
+                method_func = e
+            resolved.append((method, tuple(call.get('params', ())), method_func))
+
+        funcs = [func for (method, args, func) in resolved if callable(func)]
+        read_only = bool(funcs) and not [func for func in funcs
+                if getattr(func, 'locking', False) or not getattr(func, 'readonly', False)]
+        if read_only:
+            read_acquired_time = self.component_lock_acquire_read("system.multicall")
+        held = False
+        results = []
+        try:
+            for method, args, method_func in resolved:
+                if not callable(method_func):
+                    e = method_func
+                    results.append({'faultCode':getattr(e, "fault_code", 1), 'faultString':str(e)})
+                    continue
+                if not read_only:
+                    need_to_lock = not getattr(method_func, 'locking', False)
+                    if need_to_lock and not held:
+                        self.component_lock_acquire("system.multicall")
+                        held = True
+                    elif held and not need_to_lock:
+                        self.component_lock_release()
+                        held = False
+                method_start = time.time()
+                try:
+                    result = method_func(*args)
+                except Exception, e:
+                    if getattr(e, "log", True):
+                        self.logger.error(e, exc_info=True)
+                    results.append({'faultCode':getattr(e, "fault_code", 1), 'faultString':str(e)})
+                else:
+                    results.append([result])
+                method_done = time.time()
+                self.profile.add_call(method, method_done - method_start,
+                        caller or "local")
+                self.statistics.add_value(method, method_done - method_start)
+        finally:
+            if read_only:
+                self.component_lock_release_read(read_acquired_time, "system.multicall")
+            elif held:
+                self.component_lock_release()
+
+        for index, (method, args, method_func) in enumerate(resolved):
+            if isinstance(results[index], list):
+                try:
+                    results[index] = [self._marshal_result(method_func, args, results[index][0])]
+                except Exception, e:
+                    self.logger.error(e, exc_info=True)
+                    results[index] = {'faultCode':getattr(e, "fault_code", 1), 'faultString':str(e)}
+        return results
+
     @exposed
     def listMethods (self):
         """Custom XML-RPC introspective method list."""
@@ -416,4 +907,22 @@ class Component (object):
         return self.statistics.display()
     get_statistics = exposed(get_statistics)
 
+    def get_profile (self, reset=False):
+        """Get per-method latency percentiles, per-caller call counts and
+        component lock wait/held times for the recent profile window.
+
+        Arguments:
+        reset -- clear the profile after reading it
+        """
+        result = self.profile.dump()
+        if reset:
+            self.profile.reset()
+        return result
+    get_profile = locking(exposed(get_profile))
+
+    def reset_profile (self):
+        """Clear the call profile."""
+        self.profile.reset()
+    reset_profile = locking(exposed(reset_profile))
+
 
@@ -2,12 +2,14 @@
 
 Classes:
 BaseForker -- generic implementation
+ChildBatch -- a set of commands run by the forker with a limit on how many run at once
 
 The forker component provides a single threaded component which can safely
 fork new processes.
 
 """
 
+import collections
 import copy
 import errno
 import fcntl
@@ -25,7 +27,9 @@ Component = Cobalt.Components.base.Component
 exposed = Cobalt.Components.base.exposed
 automatic = Cobalt.Components.base.automatic
 import Cobalt.Data
+import Cobalt.Proxy
 IncrID = Cobalt.Data.IncrID
+ChangeLog = Cobalt.Data.ChangeLog
 import Cobalt.Statistics
 Statistics = Cobalt.Statistics.Statistics
 import Cobalt.Util
@@ -132,6 +136,7 @@ class BaseChild (object):
         del state['stdout_file']
         del state['stderr_file']
         del state['_cobalt_log_file']
+        state.pop('_version', None)
         return state
 
     def __setstate__(self, state):
@@ -172,6 +177,21 @@ class BaseChild (object):
         d['core_dump'] = self.core_dump
         return d
 
+    def to_rx(self, fields=None):
+        '''Marshal the child for the forker's change feed.  All fields are always returned.'''
+        return self.export_state()
+
+    def close_files(self):
+        '''Close the parent's copies of the standard I/O files once the child has exited.'''
+        for name in ('stdin_file', 'stdout_file', 'stderr_file'):
+            f = getattr(self, name)
+            if f is not None:
+                try:
+                    f.close()
+                except (OSError, IOError), e:
+                    _logger.warning("%s: unable to close %s: %s", self.label, name, e)
+                setattr(self, name, None)
+
     def _open_clf(self):
         if not self._cobalt_log_file and self.cobalt_log_filename and not self._cobalt_log_failed:
             if os.geteuid() == 0:
@@ -389,6 +409,38 @@ class BaseChild (object):
             _logger.info("%s: unable to send signal %s to dead process", self.label, signame)
 
 
+class ChildBatch (object):
+    '''
+    A set of commands, each identified by a key such as a host name, that the forker runs with at most max_running of them
+    at a time.  The result of each command is kept until the client acknowledges it, so the children themselves are cleaned
+    up as soon as they finish.  Batches are saved in the state file with the forker's children; after a restart, commands
+    that were running are reported as lost and pending commands are started.  A batch unknown to the forker is reported as
+    lost.
+    '''
+
+    id_gen = IncrID()
+
+    def __init__(self, commands, tag=None, label=None, max_running=None, timeout=None, notify=None):
+        self.id = self.id_gen.next()
+        self.tag = tag
+        self.label = label
+        self.max_running = max_running
+        self.timeout = timeout
+        self.notify = notify
+        self.pending = collections.deque(sorted(commands.items()))
+        self.running = {} # child id:(key, start time)
+        self.finished = {} # key:result
+
+    @property
+    def done(self):
+        '''True once every result has been acknowledged.'''
+        return not (self.pending or self.running or self.finished)
+
+    def export_state(self):
+        return {'id': self.id, 'lost': False, 'finished': self.finished, 'running': len(self.running),
+                'pending': len(self.pending)}
+
+
 class BaseForker (Component):
     
     """Generic implementation of the service-location component.
@@ -398,7 +450,11 @@ class BaseForker (Component):
     signal -- signal a child with the specified signame (exposed)
     active_list -- retrieve a list of children which are still running (exposed)
     get_status -- return a dictionary of status information for a finished process (exposed)
+    poll_children -- return the children that changed since the caller's last poll (exposed)
+    fork_batch -- run a set of commands with a limit on how many run at once (exposed)
+    poll_batches -- return and acknowledge the results of batched commands (exposed)
     wait -- wait on children and record their status (automatic)
+    wakeup -- reap children after the wakeup_fd signals that one has exited
     """
     
     # name = __name__.split('.')[-1]
@@ -408,6 +464,8 @@ class BaseForker (Component):
 
     UNKNOWN_ERROR = 256
     DEATH_TIMEOUT = 300 # seconds
+    MAX_OUTPUT_BYTES = int(get_forker_config('max_output_bytes', 1048576))
+    OUTPUT_CHUNK_SIZE = 65536
     
     __statefields__ = ['next_task_id', 'children']
 
@@ -424,6 +482,11 @@ class BaseForker (Component):
         self.children = {}
         self.active_runids = []
         self.marked_for_death = {}
+        self._pids = {}
+        self._changes = ChangeLog()
+        self.batches = {}
+        self._batch_notifications = set()
+        self._open_wakeup_pipe()
 
     def __getstate__(self):
         state = {}
@@ -431,7 +494,9 @@ class BaseForker (Component):
         state.update({
                 'base_forker_version': 2,
                 'next_task_id': BaseChild.id_gen.idnum+1,
+                'next_batch_id': ChildBatch.id_gen.idnum+1,
                 'children': self.children,
+                'batches': self.batches,
                 'active_runids': self.active_runids,
                 'marked_for_death': self.marked_for_death})
         return state
@@ -449,6 +514,9 @@ class BaseForker (Component):
 
         BaseChild.id_gen = IncrID()
         BaseChild.id_gen.set(state['next_task_id'])
+        ChildBatch.id_gen = IncrID()
+        if state.has_key('next_batch_id'):
+            ChildBatch.id_gen.set(state['next_batch_id'])
         if state.has_key('children'):
             self.children = state['children']
         else:
@@ -462,6 +530,71 @@ class BaseForker (Component):
         else:
             self.marked_for_death = {}
 
+        # the pid index is not saved; children that were lost across the restart have already had their pids cleared
+        self._pids = {}
+        for child in self.marked_for_death.values() + self.children.values():
+            if child.pid is not None:
+                self._pids[child.pid] = child
+        self._changes = ChangeLog()
+        # the children of a saved batch are cleaned up as the batch is advanced
+        if state.has_key('batches'):
+            self.batches = state['batches']
+        else:
+            self.batches = {}
+        self._batch_notifications = set()
+        self._open_wakeup_pipe()
+
+    def _open_wakeup_pipe(self):
+        '''
+        Create the pipe that the SIGCHLD handler writes to.  A single threaded server watches the read end (wakeup_fd) and
+        calls wakeup() so that children are reaped as soon as they exit rather than on the next wait_interval poll.  If the
+        handler cannot be installed, the forker falls back to polling.
+        '''
+        self._wakeup_r = None
+        self._wakeup_w = None
+        try:
+            rfd, wfd = os.pipe()
+        except OSError, e:
+            _logger.error("unable to create the SIGCHLD wakeup pipe; polling for dead children instead: %s", e)
+            return
+        for fd in (rfd, wfd):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+            fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+        try:
+            signal.signal(signal.SIGCHLD, self._handle_sigchld)
+            signal.siginterrupt(signal.SIGCHLD, False)
+        except ValueError:
+            # signal handlers may only be installed by the main thread
+            _logger.warning("unable to catch SIGCHLD outside of the main thread; polling for dead children instead")
+            os.close(rfd)
+            os.close(wfd)
+            return
+        self._wakeup_r = rfd
+        self._wakeup_w = wfd
+
+    def _handle_sigchld(self, signum, frame):
+        # only async-safe work here; the children are reaped by wakeup() from the server loop
+        try:
+            os.write(self._wakeup_w, '\0')
+        except OSError:
+            # the pipe is full, so a wakeup is already pending
+            pass
+
+    def _get_wakeup_fd(self):
+        return self._wakeup_r
+
+    wakeup_fd = property(_get_wakeup_fd)
+
+    def wakeup(self):
+        '''Drain the wakeup pipe and have the wait task reap the children that exited.'''
+        try:
+            while os.read(self._wakeup_r, 4096):
+                pass
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+        self.wake_task('_wait')
+
     def __save_me(self):
         '''Periodically save off a statefile.'''
         Component.save(self)
@@ -519,12 +652,15 @@ class BaseForker (Component):
                         " task initialization.")
 
             if child is not None and child.pid is not None:
-                for c in self.children.itervalues():
-                    if c.pid == child.pid:
-                        if self.marked_for_death.has_key(c.id):
-                            del self.marked_for_death[c.id]
-                        c.pid = None
+                # a child still holding this pid was reaped without our knowledge; make sure it is never signaled
+                stale = self._pids.get(child.pid)
+                if stale is not None:
+                    if self.marked_for_death.has_key(stale.id):
+                        del self.marked_for_death[stale.id]
+                    stale.pid = None
+                self._pids[child.pid] = child
                 self.children[child.id] = child
+                self._changes.stamp(child)
                 if child.runid is not None:
                     self.active_runids.append(runid)
                 return child.id
@@ -585,6 +721,24 @@ class BaseForker (Component):
         return ret
 
     get_children = exposed(get_children)
+
+    def poll_children(self, tag=None, epoch=None, version="0", cleanup_ids=None):
+        """
+        Retrieve the children that were created or completed since the caller's last poll.  If cleanup ids are supplied, those
+        children are cleaned up first, so that a client may acknowledge the children it has handled and collect the next
+        batch in a single call.
+
+        Returns a dictionary with the epoch and version to pass on the next poll, whether the update is full (the caller has
+        missed changes and must drop any children it is not sent), the exported state of the updated children, the ids of
+        the children cleaned up since the last poll, and the number of children.  An epoch of None requests a full update.
+
+        """
+        if cleanup_ids:
+            self.cleanup_children(cleanup_ids)
+        children = [child for child in self.children.itervalues() if tag is None or child.tag == tag]
+        return self._changes.get_changes_since(children, 'id', epoch, version)
+
+    poll_children = exposed(poll_children)
    
     def cleanup_children(self, child_ids):
         '''Let the forker know that we are done with the child process data.
@@ -609,9 +763,145 @@ class BaseForker (Component):
                     _logger.warning("%s: unable to remove child from the active runid list: runid %s was not present",
                         child.label, child.runid)
             del self.children[child_id]
+            self._changes.record_deleted([child_id])
 
     cleanup_children = exposed(cleanup_children)
 
+    def fork_batch(self, commands, tag=None, label=None, max_running=None, timeout=None, notify=None):
+        """
+        Run a set of commands, such as the epilogue for each host of a job, as a single request.
+        commands -- a mapping of keys (host names, for example) to the args of the command to run for each key
+        tag -- a tag identifying the type of job, as for fork
+        label -- a label for logger lines
+        max_running -- the most commands to run at once (default no limit)
+        timeout -- seconds after which a running command is interrupted and reported as timed out (default none)
+        notify -- name of a component whose batch_progress method is called as commands finish
+
+        returns the id of the batch, to be passed to poll_batches.
+
+        """
+        batch = ChildBatch(commands, tag, label, max_running, timeout, notify)
+        _logger.info("%s: starting batch %s of %s commands, %s at a time", label, batch.id, len(commands),
+            max_running or "all")
+        self.batches[batch.id] = batch
+        self._advance_batch(batch, time.time())
+        return batch.id
+
+    fork_batch = exposed(fork_batch)
+
+    def poll_batches(self, batch_ids, done=None):
+        """
+        Retrieve the results of batched commands.  Each result remains available until it is acknowledged by passing its
+        [batch id, key] pair in done on a later call; a batch is discarded once all of its results have been acknowledged.
+
+        Returns a list of dictionaries holding the batch id, the results of the finished commands keyed by command key, and
+        the number of commands still running and still pending.  A batch the forker no longer knows of is marked lost.
+
+        """
+        for batch_id, key in done or []:
+            batch = self.batches.get(batch_id)
+            if batch is not None:
+                batch.finished.pop(key, None)
+                if batch.done:
+                    del self.batches[batch_id]
+        ret = []
+        for batch_id in batch_ids:
+            batch = self.batches.get(batch_id)
+            if batch is None:
+                ret.append({'id': batch_id, 'lost': True, 'finished': {}, 'running': 0, 'pending': 0})
+            else:
+                ret.append(batch.export_state())
+        return ret
+
+    poll_batches = exposed(poll_batches)
+
+    def _batch_result(self, child=None, timed_out=False):
+        '''Summarize a batched child for poll_batches.  Without a child, the command is reported as lost.'''
+        if child is None:
+            return {'exit_status': None, 'signum': 0, 'core_dump': False, 'lost_child': True, 'timed_out': False,
+                    'stdout': [], 'stderr': []}
+        return {'exit_status': child.exit_status, 'signum': child.signum, 'core_dump': child.core_dump,
+                'lost_child': child.lost_child, 'timed_out': timed_out, 'stdout': child.stdout_data or [],
+                'stderr': child.stderr_data or []}
+
+    def _advance_batch(self, batch, now):
+        '''Collect the results of finished or timed out commands in a batch and start pending commands in their place.'''
+        progressed = False
+        for child_id, (key, start_time) in batch.running.items():
+            child = self.children.get(child_id)
+            if child is None or child.complete:
+                result = self._batch_result(child)
+            elif batch.timeout is not None and now - start_time > batch.timeout:
+                _logger.warning("%s: command timed out after %s seconds", child.label, batch.timeout)
+                try:
+                    child.signal(signal.SIGINT)
+                except OSError:
+                    pass
+                result = self._batch_result(child, timed_out=True)
+            else:
+                continue
+            del batch.running[child_id]
+            if child is not None:
+                self.cleanup_children([child_id])
+            batch.finished[key] = result
+            progressed = True
+        while batch.pending and (not batch.max_running or len(batch.running) < batch.max_running):
+            key, args = batch.pending.popleft()
+            if batch.label:
+                label = "%s %s" % (batch.label, key)
+            else:
+                label = key
+            child_id = self.fork(args, batch.tag, label)
+            if child_id is None:
+                batch.finished[key] = self._batch_result()
+                progressed = True
+            else:
+                batch.running[child_id] = (key, now)
+        if progressed and batch.notify:
+            self._batch_notifications.add((batch.notify, batch.id))
+            self.wake_task('flush_batch_notifications')
+
+    def flush_batch_notifications(self):
+        '''Tell the components waiting on batches which of their batches have new results.'''
+        notifications = self._batch_notifications
+        self._batch_notifications = set()
+        batch_ids = {}
+        for component, batch_id in notifications:
+            batch_ids.setdefault(component, []).append(batch_id)
+        for component, ids in batch_ids.iteritems():
+            try:
+                Cobalt.Proxy.ComponentProxy(component, retry=False).batch_progress(sorted(ids))
+            except:
+                _logger.debug("unable to notify the %s component of progress on batches %s", component, ids, exc_info=1)
+
+    flush_batch_notifications = automatic(flush_batch_notifications, 60)
+
+    def _unindex_pid(self, child):
+        if child.pid is not None and self._pids.get(child.pid) is child:
+            del self._pids[child.pid]
+
+    def _read_output(self, child, output_file, name):
+        '''
+        Read the output of a finished child in chunks, keeping at most MAX_OUTPUT_BYTES of it, and return it as a list of
+        lines.  A marker line is appended if the output was truncated.
+        '''
+        _logger.info("task %s: reading %s", child.label, name)
+        output_file.seek(0, 0)
+        chunks = []
+        remaining = self.MAX_OUTPUT_BYTES
+        while remaining > 0:
+            chunk = output_file.read(min(self.OUTPUT_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            chunks.append(chunk)
+            remaining -= len(chunk)
+        lines = [l.rstrip() for l in "".join(chunks).splitlines()]
+        if remaining <= 0 and output_file.read(1):
+            _logger.warning("%s: %s exceeded %s bytes; the remainder was discarded", child.label, name, self.MAX_OUTPUT_BYTES)
+            lines.append("[%s truncated after %s bytes]" % (name, self.MAX_OUTPUT_BYTES))
+        _logger.debug("task %s: %s:\n%s", child.label, name, "\n".join(lines))
+        return lines
+
     def _wait(self):
         """Call os.waitpid to status of dead processes.
         """
@@ -644,44 +934,45 @@ class BaseForker (Component):
             else:
                 _logger.info("pid %s died with status %s", pid, exit_status)
 
-            found = False
-            for child in self.children.itervalues():
-                if child.pid == pid:
-                    _logger.info("task %s: dead pid %s matches child %s", child.label, pid, child.id)
-                    child.exit_status = exit_status
-                    child.core_dump = core_dump
-                    child.signum = signum
-                    child.pid = None
-                    child.complete = True
-                    if self.marked_for_death.has_key(child.id):
-                        del self.marked_for_death[child.id]
-                    if child.return_output:
-                        try:
-                            if child.stdout_file:
-                                _logger.info("task %s: reading stdout", child.label)
-                                child.stdout_file.seek(0, 0)
-                                child.stdout_data = [l.rstrip() for l in child.stdout_file.readlines()]
-                                _logger.debug("task %s: stdout:\n%s", child.label, "\n".join(child.stdout_data))
-                        except (OSError, IOError), e:
-                            _logger.error("%s: unable to read stdout: %s", child.label, e)
-                        try:
-                            if child.stderr_file:
-                                _logger.info("task %s: reading stderr", child.label)
-                                child.stderr_file.seek(0, 0)
-                                child.stderr_data = [l.rstrip() for l in child.stderr_file.readlines()]
-                                _logger.debug("task %s: stderr:\n%s", child.label, "\n".join(child.stderr_data))
-                        except (OSError, IOError), e:
-                            _logger.error("%s: unable to read stderr: %s", child.label, e)
-                    found = True
-                    break
-            if not found:
+            child = self._pids.pop(pid, None)
+            if child is None:
                 _logger.warning("pid %s has no corresponding child object", pid)
-                for child_id in self.marked_for_death.keys():
-                    if self.marked_for_death[child_id].pid == pid:
-                        _logger.info("pid %s found in marked for death list", pid)
-                        del self.marked_for_death[child_id]
-                        break
-            
+                continue
+            if self.children.get(child.id) is not child:
+                _logger.warning("pid %s has no corresponding child object", pid)
+                if self.marked_for_death.has_key(child.id):
+                    _logger.info("pid %s found in marked for death list", pid)
+                    del self.marked_for_death[child.id]
+                child.pid = None
+                child.close_files()
+                continue
+
+            _logger.info("task %s: dead pid %s matches child %s", child.label, pid, child.id)
+            child.exit_status = exit_status
+            child.core_dump = core_dump
+            child.signum = signum
+            child.pid = None
+            child.complete = True
+            if self.marked_for_death.has_key(child.id):
+                del self.marked_for_death[child.id]
+            if child.return_output:
+                try:
+                    if child.stdout_file:
+                        child.stdout_data = self._read_output(child, child.stdout_file, "stdout")
+                except (OSError, IOError), e:
+                    _logger.error("%s: unable to read stdout: %s", child.label, e)
+                try:
+                    if child.stderr_file:
+                        child.stderr_data = self._read_output(child, child.stderr_file, "stderr")
+                except (OSError, IOError), e:
+                    _logger.error("%s: unable to read stderr: %s", child.label, e)
+            child.close_files()
+            self._changes.stamp(child)
+
+        now = time.time()
+        for batch in self.batches.values():
+            self._advance_batch(batch, now)
+
         # signal any children marked for death
         for child_id in self.marked_for_death.keys():
             child = self.marked_for_death[child_id]
@@ -690,6 +981,7 @@ class BaseForker (Component):
                     child.signal(signal.SIGTERM)
                 except OSError, e:
                     if e.errno == errno.ESRCH:
+                        self._unindex_pid(child)
                         del self.marked_for_death[child_id]
                 else:
                     child.death_timer = Timer(self.DEATH_TIMEOUT)
@@ -699,6 +991,7 @@ class BaseForker (Component):
                     child.signal(signal.SIGKILL)
                 except OSError, e:
                     if e.errno == errno.ESRCH:
+                        self._unindex_pid(child)
                         del self.marked_for_death[child_id]
                 else:
                     child.death_timer.max_time = child.death_timer.elapsed_time + self.DEATH_TIMEOUT
@@ -18,7 +18,7 @@ import Cobalt
 from Cobalt.Data import Data, DataDict
 from Cobalt.Exceptions import JobValidationError, ComponentLookupError, ResourceReservationFailure
 import Cobalt.Components.base
-from Cobalt.Components.base import Component, exposed, automatic, query, locking
+from Cobalt.Components.base import Component, exposed, automatic, query, locking, readonly
 import thread
 from Cobalt.Proxy import ComponentProxy
 from Cobalt.DataTypes.ProcessGroup import ProcessGroupDict
@@ -383,7 +383,7 @@ class BGBaseSystem (Component):
         self._partitions_lock.release()
 
         return partitions
-    get_partitions = exposed(query(get_partitions))
+    get_partitions = readonly(exposed(query(get_partitions)))
 
     def verify_locations(self, location_list):
         """Providing a system agnostic interface for making sure a 'location string' is valid"""
@@ -4,6 +4,10 @@ Classes:
 NodeCard -- node cards make up Partitions
 Block -- atomic set of nodes
 BlockDict -- default container for blocks
+BlockSnapshot -- scheduling view of a block
+BlockResourceIndex -- node card to block lookup for finding relatives
+BlockHardwareIndex -- hardware to block lookup for block state updates
+ResourceBitmap -- bit positions for hardware names
 ProcessGroup -- virtual process group running on the system
 ProcessGroupDict -- default container for process groups
 BGBaseSystem -- base system component
@@ -11,7 +15,7 @@ BGBaseSystem -- base system component
 
 import sys
 import time
-import copy
+import binascii
 import Cobalt
 import re
 import logging
@@ -21,17 +25,21 @@ import ConfigParser
 from Cobalt.Util import get_config_option
 from Cobalt.Data import Data, DataDict
 from Cobalt.Exceptions import JobValidationError
-from Cobalt.Components.base import Component, exposed, automatic, query, locking
+from Cobalt.Components.base import Component, exposed, automatic, query, locking, readonly
 from Cobalt.DataTypes.ProcessGroup import ProcessGroupDict
 from Cobalt.Components.bgq_io_block import IOBlockDict
 from Cobalt.Components.bgq_io_hardware import IONode
 
 
 __all__ = [
+    "ResourceBitmap",
     "Node",
     "NodeCard",
     "Block",
     "BlockDict",
+    "BlockSnapshot",
+    "BlockResourceIndex",
+    "BlockHardwareIndex",
     "BGBaseSystem",
 ]
 
@@ -46,6 +54,8 @@ CP = ConfigParser.ConfigParser()
 CP.read(Cobalt.CONFIG_FILES)
 
 MAX_DRAIN_HOURS = float(get_config_option('bgsystem', 'max_drain_hours', float(sys.maxint)))
+#number of jobs a single find_job_location call may place.  0 means no limit.
+MAX_JOBS_PER_PASS = int(get_config_option('bgsystem', 'max_jobs_per_pass', 1))
 
 #you'd think that this would be in the control system database somewhere, but it's not.
 #this generates the node locations for N00 in a midplane.  So far as I know (and I can 
@@ -196,6 +206,39 @@ def get_extents_from_size(size):
 
     return ret_extents
 
+class ResourceBitmap (object):
+    '''Hand out a bit position per hardware name, so that a set of hardware
+    can be held as an integer and compared with bitwise operations.
+
+    '''
+    def __init__(self):
+        self.positions = {}
+
+    def position(self, name):
+        try:
+            return self.positions[name]
+        except KeyError:
+            return self.positions.setdefault(name, len(self.positions))
+
+    def mask(self, names):
+        '''Return the integer with the bit for every name in names set.'''
+        positions = [self.position(name) for name in names]
+        if not positions:
+            return 0
+        bits = bytearray(max(positions) / 8 + 1)
+        for pos in positions:
+            bits[pos >> 3] |= 1 << (pos & 7)
+        bits.reverse()
+        return int(binascii.hexlify(bits), 16)
+
+    def names(self, mask):
+        '''Return the names whose bits are set in mask.'''
+        return [name for name, pos in self.positions.iteritems() if mask >> pos & 1]
+
+#shared by all blocks so that masks from different blocks can be compared
+node_card_bitmap = ResourceBitmap()
+node_bitmap = ResourceBitmap()
+
 class Wire (object):
     '''Encapsulate information about a wire in easily swallowable form.
 
@@ -400,6 +443,9 @@ class Block (Data):
         "block_type", "corner_node", "extents", "wire_list", "io_node_list",
     ]
 
+    # stamp blocks on change so scheduling snapshots only copy what changed
+    versioned = True
+
     def __init__ (self, spec):
         """Initialize a new block."""
         Data.__init__(self, spec)
@@ -491,6 +537,19 @@ class Block (Data):
         self.current_kernel_options = get_config_option('bgqsystem', 'cn_default_kernel_options', '')
         self.reboot_ions_for_kernel = False
 
+        self._update_resource_masks()
+
+    def _update_resource_masks(self):
+        '''Recompute the node card, passthrough and node bitmasks used for
+        overlap tests.  Call if node_cards, passthrough_node_cards or nodes
+        are changed.
+
+        '''
+        self._node_card_mask = node_card_bitmap.mask([nc.name for nc in self.node_cards])
+        self._passthrough_node_card_mask = node_card_bitmap.mask(
+                [nc.name for nc in self.passthrough_node_cards])
+        self._node_mask = node_bitmap.mask([node.name for node in self.nodes])
+
     def _update_node_cards(self):
         if self.state == "busy":
             for nc in self.node_cards:
@@ -576,15 +635,11 @@ class Block (Data):
         '''
         if self.name == block.name:
             return False #don't overlap with yourself.
-        b1_nc = self.node_cards
-        b2_nc = block.node_cards
-        if not (b1_nc & b2_nc):
+        if not (self._node_card_mask & block._node_card_mask):
             return False
-        if (len(b1_nc) == 1 and
-            len(b2_nc) == 1):
-            b1_nodes = self.nodes
-            b2_nodes = block.nodes
-            if not (b1_nodes & b2_nodes):
+        if (len(self.node_cards) == 1 and
+            len(block.node_cards) == 1):
+            if not (self._node_mask & block._node_mask):
                 return False
         return True
 
@@ -610,14 +665,12 @@ class Block (Data):
 
         if self.name == block.name:
             return False
-        b1_nc = self.node_cards
-        b2_nc = block.node_cards
-        if not (b1_nc >= b2_nc):
+        b1_nc = self._node_card_mask
+        b2_nc = block._node_card_mask
+        if b1_nc & b2_nc != b2_nc:
             return False
-        if len(b1_nc ^ b2_nc) == 0:
-            b1_nodes = self.nodes
-            b2_nodes = block.nodes
-            if not (b1_nodes >= b2_nodes):
+        if b1_nc == b2_nc:
+            if self._node_mask & block._node_mask != block._node_mask:
                 return False
         return True
 
@@ -638,18 +691,16 @@ class Block (Data):
         if self.name == block.name:
             return False
 
-        b1_nc = set(self.node_cards)
-        b2_nc = set(block.node_cards)
-        if (b1_nc.isdisjoint(b2_nc)):
+        b1_nc = self._node_card_mask
+        b2_nc = block._node_card_mask
+        if not (b1_nc & b2_nc):
             return False
         if (b1_nc & b2_nc == b2_nc):
-            if len(b1_nc) > 2:
+            if len(self.node_cards) > 2:
                 return True
             #have to handle single-nodecards differently
-        if len(b1_nc ^ b2_nc) == 0:
-            b1_nodes = set(self.nodes)
-            b2_nodes = set(block.nodes)
-            if b2_nodes.issubset(b1_nodes):
+        if b1_nc == b2_nc:
+            if block._node_mask & self._node_mask == block._node_mask:
                 return True
         return False
 
@@ -660,8 +711,8 @@ class Block (Data):
         Return: void
 
         """
-        if (self.node_cards.intersection(other.passthrough_node_cards) or
-                self.passthrough_node_cards.intersection(other.node_cards)):
+        if ((self._node_card_mask & other._passthrough_node_card_mask) or
+                (self._passthrough_node_card_mask & other._node_card_mask)):
             self._passthrough_blocks.add(other)
             other._passthrough_blocks.add(self)
 
@@ -692,6 +743,195 @@ class BlockDict (DataDict):
     key = "name"
 
 
+class BlockSnapshot (object):
+    """The scheduling-relevant view of a block.
+
+    find_job_location works on these rather than on a deep copy of the
+    blocks.  A snapshot is kept between scheduling passes and is only
+    refreshed when the version of the block it was taken from moves.
+
+    Relatives, parents, children and passthrough blocks refer to other
+    snapshots and are only relinked when the block relationships change.
+    """
+
+    fields = ["state", "backfill_time", "draining", "functional", "scheduled",
+              "size", "queue", "reserved_by", "reserved_until", "block_type"]
+
+    def __init__ (self, block):
+        self.name = block.name
+        self.version = None
+        self._relatives = set()
+        self._parents = set()
+        self._children = set()
+        self._passthrough_blocks = set()
+        self.parents = []
+        self.children = []
+        self.refresh(block)
+
+    def refresh (self, block):
+        """Copy the scheduling fields over from block."""
+        for field in self.fields:
+            setattr(self, field, getattr(block, field))
+        self.node_geometry = list(block.node_geometry)
+        self.version = block.__dict__.get('_version', 0)
+
+    def link (self, block, snapshots):
+        """Point the relationship sets at the snapshots of block's relatives."""
+        def _snapshots_of(blocks):
+            return set([snapshots[b.name] for b in blocks if b.name in snapshots])
+        self._relatives = _snapshots_of(block._relatives)
+        self._parents = _snapshots_of(block._parents)
+        self._children = _snapshots_of(block._children)
+        self._passthrough_blocks = _snapshots_of(block._passthrough_blocks)
+        self.parents = [name for name in block.parents if name in snapshots]
+        self.children = [name for name in block.children if name in snapshots]
+
+    relatives = property(lambda self: [r.name for r in self._relatives])
+    passthrough_blocks = property(lambda self: [b.name for b in self._passthrough_blocks])
+
+    def __str__ (self):
+        return self.name
+
+    def __repr__ (self):
+        return "<%s name=%r>" % (self.__class__.__name__, self.name)
+
+
+
+class BlockResourceIndex (object):
+    """Index of managed blocks by the node cards they use or pass through.
+
+    Two blocks can only overlap if they share a node card, and can only be
+    passthrough relatives if one passes through a node card of the other, so
+    update_relatives only has to test the blocks found here rather than every
+    managed block.
+    """
+
+    def __init__ (self):
+        self.users = {} # node card name -> blocks using that node card
+        self.passthrough = {} # node card name -> blocks passing through it
+        self.blocks = {} # block name -> indexed block
+
+    def add (self, block):
+        """Index a block by its node cards and passthrough node cards."""
+        self.remove(block.name)
+        self.blocks[block.name] = block
+        for nc in block.node_cards:
+            self.users.setdefault(nc.name, set()).add(block)
+        for nc in block.passthrough_node_cards:
+            self.passthrough.setdefault(nc.name, set()).add(block)
+
+    def remove (self, name):
+        """Drop a block from the index.  Return the block, or None if it was not indexed."""
+        block = self.blocks.pop(name, None)
+        if block is None:
+            return None
+        for index, node_cards in ((self.users, block.node_cards),
+                                  (self.passthrough, block.passthrough_node_cards)):
+            for nc in node_cards:
+                entry = index.get(nc.name)
+                if entry is not None:
+                    entry.discard(block)
+                    if not entry:
+                        del index[nc.name]
+        return block
+
+    def clear (self):
+        self.users.clear()
+        self.passthrough.clear()
+        self.blocks.clear()
+
+    def overlap_candidates (self, block):
+        """Blocks sharing at least one node card with block."""
+        candidates = set()
+        for nc in block.node_cards:
+            candidates.update(self.users.get(nc.name, ()))
+        candidates.discard(block)
+        return candidates
+
+    def passthrough_candidates (self, block):
+        """Blocks passing through block's node cards, or using node cards block passes through."""
+        candidates = set()
+        for nc in block.node_cards:
+            candidates.update(self.passthrough.get(nc.name, ()))
+        for nc in block.passthrough_node_cards:
+            candidates.update(self.users.get(nc.name, ()))
+        candidates.discard(block)
+        return candidates
+
+
+class BlockHardwareIndex (object):
+    """Index of managed blocks by the hardware their state depends on.
+
+    Keys are (kind, name) pairs for node cards, passthrough node cards,
+    switches, wires and midplanes.  A block is indexed under its own node
+    cards and passthrough node cards, its switches, wires and midplanes,
+    and, for a pseudoblock, the node cards of its subblock parent.  When the
+    state of a piece of hardware changes only the blocks found here have to
+    be rechecked.
+
+    Every key also gets a bit, and each block a mask of the bits of its
+    keys, so a block can be tested against a set of failed hardware with a
+    single bitwise and.
+    """
+
+    def __init__ (self):
+        self.hardware = {} # (kind, name) -> names of blocks depending on it
+        self.node_cards = {} # node card name -> indexed NodeCard
+        self.blocks = {} # block name -> keys the block is indexed under
+        self.masks = {} # block name -> mask of the block's keys
+        self.bitmap = ResourceBitmap()
+
+    def add (self, block, subblock_parent=None):
+        """Index a block by its hardware."""
+        self.remove(block.name)
+        node_cards = set(block.node_cards)
+        if subblock_parent is not None:
+            node_cards.update(subblock_parent.node_cards)
+        keys = set()
+        for kind, ncs in (('node_card', node_cards), ('passthrough_node_card', block.passthrough_node_cards)):
+            for nc in ncs:
+                self.node_cards[nc.name] = nc
+                keys.add((kind, nc.name))
+        keys.update([('switch', sw) for sw in block.switches])
+        keys.update([('wire', wire) for wire in block.wires])
+        keys.update([('midplane', mp) for mp in block.midplanes])
+        for key in keys:
+            self.hardware.setdefault(key, set()).add(block.name)
+        self.blocks[block.name] = keys
+        self.masks[block.name] = self.bitmap.mask(keys)
+
+    def remove (self, name):
+        """Drop a block from the index."""
+        keys = self.blocks.pop(name, None)
+        if keys is None:
+            return
+        del self.masks[name]
+        for key in keys:
+            entry = self.hardware.get(key)
+            if entry is not None:
+                entry.discard(name)
+                if not entry:
+                    del self.hardware[key]
+        for kind, nc_name in keys:
+            if (kind in ('node_card', 'passthrough_node_card') and
+                    ('node_card', nc_name) not in self.hardware and
+                    ('passthrough_node_card', nc_name) not in self.hardware):
+                self.node_cards.pop(nc_name, None)
+
+    def clear (self):
+        self.hardware.clear()
+        self.node_cards.clear()
+        self.blocks.clear()
+        self.masks.clear()
+        self.bitmap = ResourceBitmap()
+
+    def affected_blocks (self, keys):
+        """Names of the blocks depending on any of the given hardware."""
+        names = set()
+        for key in keys:
+            names.update(self.hardware.get(key, ()))
+        return names
+
 
 class BGProcessGroupDict(ProcessGroupDict):
     """ProcessGroupDict modified for Blue Gene systems"""
@@ -729,6 +969,8 @@ class BGBaseSystem (Component):
 
     """
 
+    max_jobs_per_pass = MAX_JOBS_PER_PASS
+
     def __init__ (self, *args, **kwargs):
         Component.__init__(self, *args, **kwargs)
         self._blocks = BlockDict()
@@ -742,6 +984,10 @@ class BGBaseSystem (Component):
         self.bridge_in_error = False
 
         self.cached_blocks = None
+        self._block_snapshots = {}
+        self._relatives_gen = 0
+        self._snapshot_relatives_gen = None
+        self._resource_index = BlockResourceIndex()
         self.offline_blocks = []
         self.available_block_geometries = set([])
 
@@ -786,7 +1032,8 @@ class BGBaseSystem (Component):
         self.logger.debug("%s", [block.name for block in blocks])
         self.logger.debug("%s", [b.name for b in block_dict.values()])
         self.logger.debug("%s", managed_set)
-        self.update_relatives()
+        if managed_set is self._managed_blocks:
+            self.update_relatives([block.name for block in blocks])
         return [block.name for block in blocks]
 
     @exposed
@@ -814,12 +1061,13 @@ class BGBaseSystem (Component):
 
         return blocks
 
+    @readonly
     @query
     @exposed
     def get_blocks (self, specs):
         '''Fetch block data on managed compute blocks'''
         return self._get_block_info(specs, self.blocks)
-    get_partitions = exposed(query(get_blocks))
+    get_partitions = readonly(exposed(query(get_blocks)))
 
     @query
     @exposed
@@ -855,7 +1103,8 @@ class BGBaseSystem (Component):
         self.available_block_geometries = new_geometries
         self._blocks_lock.release()
 
-        self.update_relatives()
+        if managed_list is self._managed_blocks:
+            self.update_relatives([block.name for block in blocks])
         return blocks
 
     @query
@@ -898,48 +1147,103 @@ class BGBaseSystem (Component):
     set_blocks = exposed(query(set_blocks))
     set_partitions = exposed(query(set_blocks))
 
-    def update_relatives(self):
+    def update_relatives(self, changed=None):
         """ Update a block's relatives.  A block is a relative of another 
         block iff it shares resources with the other block (nodecards, nodes, wires, &c.)
 
         This method should always be called when we change the contests of self._managed_blocks.
         Perhaps self._managed_blocks should be altered to always invoke this?
 
+        changed -- names of blocks just added to or removed from
+                   self._managed_blocks.  Only those blocks and the blocks
+                   sharing resources with them are updated.  If None, all
+                   relationships are rebuilt.
+
         """
         #TODO: This needs to be changed so that more overlapping 
         #resources can be determined. More granularity may be needed.
 
         #partial overlaps are being tracked, not sure what to do about paternity.
-        for b_name in self._managed_blocks:
-            b = self._blocks[b_name]
-            b._parents = set()
-            b._relatives = set()
-            b._children = set()
-            b._passthrough_blocks = set()
-
-        for b_name in self._managed_blocks:
-            b = self._blocks[b_name]
-
-            for other_name in self._managed_blocks:
-                if b.name == other_name:
-                    continue
-                if other_name not in self._managed_blocks:
-                    b._relatives.pop(other_name, None)
-                    self.logger.warning("Block %s not managed, removed from relatives.", other_name)
-                elif other_name in b._wiring_conflicts:
-                    b._relatives.add(self._blocks[other_name])
-                    self._blocks[other_name]._relatives.add(b)
-                else:
-                    overlap = b.mark_if_overlap(self._blocks[other_name])
-                    if not overlap:
-                        b.mark_if_passthrough(self._blocks[other_name])
+        if changed is None:
+            self._resource_index.clear()
+            managed = [self._blocks[b_name] for b_name in self._managed_blocks if b_name in self._blocks]
+            for b in managed:
+                b._parents = set()
+                b._relatives = set()
+                b._children = set()
+                b._passthrough_blocks = set()
+                self._resource_index.add(b)
+            for b in managed:
+                self._link_block(b)
+            for b in managed:
+                # only a child if the node-level resources are a proper subset of it's parent block.
+                b._parents.update([block for block in b._relatives if b.is_parent(block)])
+                b._children.update([block for block in b._relatives if b.is_child(block)])
+        else:
+            for b_name in changed:
+                self._unlink_block(b_name)
+            for b_name in changed:
+                if b_name in self._managed_blocks and b_name in self._blocks:
+                    self._resource_index.add(self._blocks[b_name])
+            for b_name in changed:
+                if b_name in self._resource_index.blocks:
+                    b = self._blocks[b_name]
+                    for block in self._link_block(b):
+                        if b.is_child(block):
+                            b._children.add(block)
+                        else:
+                            b._parents.add(block)
+                        if block.is_child(b):
+                            block._children.add(b)
+                        else:
+                            block._parents.add(b)
+        self._relatives_gen += 1
+
+    def _link_block(self, b):
+        '''Mark b and the indexed blocks sharing resources with it as relatives
+        or passthrough blocks of each other.
+
+        Return: set of blocks that became relatives of b
 
-            # only a child if the node-level resources are a proper subset of it's parent block.
-            b._parents.update([block for block in b._relatives if b.is_parent(block)])
-            b._children.update([block for block in b._relatives if b.is_child(block)])
-            #self.logger.debug('Block: %s:\nRelatives: %s', b.name, [block.name for block in b._relatives])
+        '''
+        new_relatives = set()
+        for other_name in b._wiring_conflicts:
+            other = self._resource_index.blocks.get(other_name, None)
+            if other is not None and other not in b._relatives:
+                b._relatives.add(other)
+                other._relatives.add(b)
+                new_relatives.add(other)
+        for other in self._resource_index.overlap_candidates(b):
+            if other.name in b._wiring_conflicts or other in b._relatives:
+                continue
+            if b.does_block_overlap(other):
+                b._relatives.add(other)
+                other._relatives.add(b)
+                new_relatives.add(other)
+        for other in self._resource_index.passthrough_candidates(b):
+            if other.name in b._wiring_conflicts or other in b._relatives:
+                continue
+            b.mark_if_passthrough(other)
+        return new_relatives
 
+    def _unlink_block(self, b_name):
+        '''Remove a block from the resource index and from the relationship
+        sets of every block it was related to.
 
+        '''
+        b = self._resource_index.remove(b_name)
+        if b is None:
+            return
+        for block in b._relatives:
+            block._relatives.discard(b)
+            block._parents.discard(b)
+            block._children.discard(b)
+        for block in b._passthrough_blocks:
+            block._passthrough_blocks.discard(b)
+        b._parents = set()
+        b._relatives = set()
+        b._children = set()
+        b._passthrough_blocks = set()
 
     def validate_job(self, spec):
         """validate a job for submission
@@ -1230,60 +1534,116 @@ class BGBaseSystem (Component):
                     break
 
         if self._locations_cache.has_key(q_name):
-            return self._locations_cache[q_name].get(desired_size, [])
+            return self._locations_cache[q_name].get(desired_size, {}).values()
         else:
             return []
 
-    def _build_locations_cache(self):
+    def _build_locations_cache(self, changed=None):
         '''Build three things: a pair of dictionaries keyed by queue names,
         and a set of block names which are not functional.
 
+        changed -- names of cached blocks that changed since the last call, as
+                   returned by _snapshot_blocks.  Only those blocks, and the
+                   relatives of blocks whose functional flag flipped, are
+                   re-examined.  If None, everything is rebuilt.
+
         Side Effects:
 
         self._defined_sizes: maps queue names to an ordered list of block sizes available in that queue
             for all schedulable blocks (even if currently offline and not functional)
-        self._locations_cache: maps queue names to dictionaries which map block sizes to block objects;
-            this structure will only contain blocks which are fully online, so we don't try to drain a
-            broken block
+        self._locations_cache: maps queue names to dictionaries which map block sizes to dictionaries of
+            block name to block; this structure will only contain blocks which are fully online, so we
+            don't try to drain a broken block
         self._not_functional_set: contains names of blocks which are not functional (either themselves, or
             a parent or child)
 
         '''
-        per_queue = {}
-        defined_sizes = {}
-        not_functional_set = set()
-        for target_block in self.cached_blocks.itervalues():
-            usable = True
-            if (target_block.name in self.offline_blocks or
-                    NOT_OFFLINE_RE.search(target_block.state) is None):
-                usable = False
+        offline = set(self.offline_blocks)
+        if changed is None:
+            self._location_entries = {}
+            self._defined_size_counts = {}
+            self._defined_sizes = {}
+            self._locations_cache = {}
+            self._not_functional_set = set()
+            dirty = set(self.cached_blocks.iterkeys())
+        else:
+            dirty = set(changed)
+            dirty.update(offline.symmetric_difference(self._offline_set))
+            for name in changed:
+                entry = self._location_entries.get(name, None)
+                block = self.cached_blocks.get(name, None)
+                if entry is not None and block is not None and entry[3] != block.functional:
+                    # whether the relatives are usable depends on our functional flag
+                    dirty.update([relative.name for relative in block._relatives])
+        self._offline_set = offline
+
+        touched_queues = set()
+        for name in dirty:
+            entry = self._location_entries.pop(name, None)
+            if entry is not None:
+                self._remove_location_entry(name, entry)
+                touched_queues.update(entry[0])
+            block = self.cached_blocks.get(name, None)
+            if block is not None:
+                entry = self._location_entry(block)
+                self._location_entries[name] = entry
+                self._add_location_entry(block, entry)
+                touched_queues.update(entry[0])
+
+        for q_name in touched_queues:
+            counts = self._defined_size_counts.get(q_name, {})
+            if counts:
+                self._defined_sizes[q_name] = sorted(counts.keys())
             else:
-                for part in self.cached_blocks.itervalues():
-                    if not part.functional:
-                        not_functional_set.add(part.name)
-                        if target_block in part._children or target_block in part._parents:
-                            usable = False
-                            not_functional_set.add(target_block.name)
-                            break
+                self._defined_sizes.pop(q_name, None)
 
-            for queue_name in target_block.queue.split(":"):
-                if not per_queue.has_key(queue_name):
-                    per_queue[queue_name] = {}
-                if not defined_sizes.has_key(queue_name):
-                    defined_sizes[queue_name] = set()
-                if target_block.scheduled:
-                    defined_sizes[queue_name].add(target_block.size)
-                if target_block.scheduled and target_block.functional and usable:
-                    if not per_queue[queue_name].has_key(target_block.size):
-                        per_queue[queue_name][target_block.size] = []
-                    per_queue[queue_name][target_block.size].append(target_block)
-
-        for q_name in defined_sizes:
-            defined_sizes[q_name] = sorted(defined_sizes[q_name])
-
-        self._defined_sizes = defined_sizes
-        self._locations_cache = per_queue
-        self._not_functional_set = not_functional_set
+    def _location_entry(self, block):
+        '''Work out what a block contributes to the locations cache.
+
+        A block is not usable if it is offline, or if any relative is not
+        functional.
+
+        Return: (queue names, size, scheduled, functional, online, relative not functional)
+
+        '''
+        online = not (block.name in self._offline_set or NOT_OFFLINE_RE.search(block.state) is None)
+        tainted = False
+        if online:
+            for relative in block._relatives:
+                if not relative.functional:
+                    tainted = True
+                    break
+        return (tuple(block.queue.split(":")), block.size, block.scheduled, block.functional, online, tainted)
+
+    def _add_location_entry(self, block, entry):
+        queues, size, scheduled, functional, online, tainted = entry
+        for queue_name in queues:
+            if scheduled:
+                counts = self._defined_size_counts.setdefault(queue_name, {})
+                counts[size] = counts.get(size, 0) + 1
+                if functional and online and not tainted:
+                    self._locations_cache.setdefault(queue_name, {}).setdefault(size, {})[block.name] = block
+        if not functional or (online and tainted):
+            self._not_functional_set.add(block.name)
+
+    def _remove_location_entry(self, name, entry):
+        queues, size, scheduled, functional, online, tainted = entry
+        for queue_name in queues:
+            if scheduled:
+                counts = self._defined_size_counts[queue_name]
+                counts[size] -= 1
+                if not counts[size]:
+                    del counts[size]
+                    if not counts:
+                        del self._defined_size_counts[queue_name]
+            by_size = self._locations_cache.get(queue_name, {})
+            if name in by_size.get(size, {}):
+                del by_size[size][name]
+                if not by_size[size]:
+                    del by_size[size]
+                    if not by_size:
+                        del self._locations_cache[queue_name]
+        self._not_functional_set.discard(name)
 
     @staticmethod
     def set_backfill_times(blocks, job_end_times, now, minimum_not_idle=300):
@@ -1338,9 +1698,68 @@ class BGBaseSystem (Component):
                     child.backfill_time = job_block.backfill_time
 
 
+    def _snapshot_blocks(self):
+        '''Bring the scheduling snapshots of the managed blocks up to date.
+
+        Only blocks whose version has moved since the last call are copied.
+        Must be called with _blocks_lock held.
+
+        Return: (dict of block name to BlockSnapshot, names of the snapshots
+                 that changed or None if the relationships were relinked)
+
+        '''
+        snapshots = self._block_snapshots
+        changed = set()
+        for name in snapshots.keys():
+            if name not in self._managed_blocks or name not in self._blocks:
+                del snapshots[name]
+                self._snapshot_relatives_gen = None
+        for name in self._managed_blocks:
+            block = self._blocks.get(name, None)
+            if block is None:
+                continue
+            snapshot = snapshots.get(name, None)
+            if snapshot is None:
+                snapshots[name] = BlockSnapshot(block)
+                self._snapshot_relatives_gen = None
+            elif snapshot.version != block.__dict__.get('_version', 0):
+                snapshot.refresh(block)
+                changed.add(name)
+        if self._snapshot_relatives_gen != self._relatives_gen:
+            for name, snapshot in snapshots.iteritems():
+                snapshot.link(self._blocks[name], snapshots)
+            self._snapshot_relatives_gen = self._relatives_gen
+            changed = None
+        return snapshots, changed
+
+    def _placement_limit_reached(self, best_block_dict):
+        '''True if find_job_location has placed as many jobs as it may in one call.'''
+        return self.max_jobs_per_pass > 0 and len(best_block_dict) >= self.max_jobs_per_pass
+
+    def _claim_block(self, block, job, now):
+        '''Mark a block picked for a job, and its relatives, as in use in the
+        scheduling snapshot so that later placements in the same call see it.
+
+        The touched snapshots are recopied from the real blocks on the next
+        call, whether or not the reservation goes through.
+
+        '''
+        end_time = now + 60 * float(job['walltime'])
+        block.state = 'allocated'
+        for relative in block._relatives:
+            if relative.state == 'idle':
+                relative.state = 'blocked'
+        for claimed in [block] + list(block._relatives):
+            if claimed.backfill_time < end_time:
+                claimed.backfill_time = end_time
+            claimed.version = None
+
     def find_job_location(self, arg_list, end_times, pt_blocking_locations=[]):
         ''' get the best location for a job.
 
+        Up to max_jobs_per_pass jobs are placed (all that fit if 0).  Each
+        placement is claimed in the snapshot before the next job is tried.
+
         '''
 
         best_block_dict = {}
@@ -1351,12 +1770,12 @@ class BGBaseSystem (Component):
 
         self._blocks_lock.acquire()
         try:
-            self.cached_blocks = copy.deepcopy(self.blocks)
+            self.cached_blocks, changed = self._snapshot_blocks()
             # build the cached_blocks structure first
             # Must be rebuilt while lock is held due to possible update race.
-            self._build_locations_cache()
+            self._build_locations_cache(changed)
         except:
-            self.logger.error("error in copy.deepcopy", exc_info=True)
+            self.logger.error("error in _snapshot_blocks", exc_info=True)
             return {}
         finally:
             self._blocks_lock.release()
@@ -1372,13 +1791,17 @@ class BGBaseSystem (Component):
         # first time through, try for starting jobs based on utility scores
         drain_blocks = set()
         jobs = {}
-
         for job in arg_list:
             jobs[job['jobid']] = job
+
+        for job in arg_list:
+            if self._placement_limit_reached(best_block_dict):
+                break
             block_name = self._find_job_location(job, drain_blocks)
             if block_name:
                 best_block_dict.update(block_name)
-                break
+                self._claim_block(self.cached_blocks[block_name[job['jobid']][0]], job, now)
+                continue
 
             #Keep pending reservations from collapsing the backfill window
             location = self._find_drain_block(job)
@@ -1414,16 +1837,21 @@ class BGBaseSystem (Component):
                     location.draining = True
 
         # the next time through, try to backfill, but only if we couldn't find anything to start
-        if not best_block_dict:
+        # or are placing more than one job at a time
+        if not self._placement_limit_reached(best_block_dict):
 
             # arg_list.sort(self._walltimecmp)
 
             for args in arg_list:
+                if self._placement_limit_reached(best_block_dict):
+                    break
+                if best_block_dict.has_key(args['jobid']):
+                    continue
                 block_name = self._find_job_location(args, backfilling=True)
                 if block_name:
                     self.logger.info("backfilling job %s" % args['jobid'])
                     best_block_dict.update(block_name)
-                    break
+                    self._claim_block(self.cached_blocks[block_name[args['jobid']][0]], args, now)
 
         # reserve the stuff in the best_block_dict, as those blocks are allegedly going to 
         # be running jobs very soon
@@ -1431,10 +1859,15 @@ class BGBaseSystem (Component):
         # also, this is the only part of finding a job location where we need to lock anything
         self._blocks_lock.acquire()
         try:
-            for p in self.blocks.itervalues():
+            for name, snapshot in self.cached_blocks.iteritems():
                 # push the backfilling info from the local cache back to the real objects
-                p.draining = self.cached_blocks[p.name].draining
-                p.backfill_time = self.cached_blocks[p.name].backfill_time
+                p = self._blocks[name]
+                untouched = snapshot.version == p.__dict__.get('_version', 0)
+                p.draining = snapshot.draining
+                p.backfill_time = snapshot.backfill_time
+                if untouched:
+                    # nothing else moved since the snapshot; don't recopy next pass
+                    snapshot.version = p.__dict__.get('_version', 0)
         except:
             self.logger.error("error in find_job_location", exc_info=True)
         self._blocks_lock.release()
@@ -1464,7 +1897,8 @@ class BGBaseSystem (Component):
         '''
 
         equiv = []
-        for part in self.blocks.itervalues():
+        blocks = self.blocks
+        for part in blocks.itervalues():
             if part.functional and part.scheduled:
                 part_active_queues = []
                 for q in part.queue.split(":"):
@@ -1478,13 +1912,13 @@ class BGBaseSystem (Component):
 
                 found_a_match = False
                 for e in equiv:
-                    if e['data'].intersection(part.node_card_names):
+                    if e['data'] & part._node_card_mask:
                         e['queues'].update(part_active_queues)
-                        e['data'].update(part.node_card_names)
+                        e['data'] |= part._node_card_mask
                         found_a_match = True
                         break
                 if not found_a_match:
-                    equiv.append( { 'queues': set(part_active_queues), 'data': set(part.node_card_names), 'reservations': set() } ) 
+                    equiv.append( { 'queues': set(part_active_queues), 'data': part._node_card_mask, 'reservations': set() } ) 
 
         real_equiv = []
         for eq_class in equiv:
@@ -1492,7 +1926,7 @@ class BGBaseSystem (Component):
             for e in real_equiv:
                 if e['queues'].intersection(eq_class['queues']):
                     e['queues'].update(eq_class['queues'])
-                    e['data'].update(eq_class['data'])
+                    e['data'] |= eq_class['data']
                     found_a_match = True
                     break
             if not found_a_match:
@@ -1504,18 +1938,18 @@ class BGBaseSystem (Component):
             for res_name in reservation_dict:
                 passthrough_blocking = res_name in passthrough_blocking_res_list
                 for b_name in reservation_dict[res_name].split(":"):
-                    b = self.blocks[b_name]
-                    if eq_class['data'].intersection(b.node_card_names):
+                    b = blocks[b_name]
+                    if eq_class['data'] & b._node_card_mask:
                         eq_class['reservations'].add(res_name)
                     for dep_name in b._wiring_conflicts:
-                        if self.blocks.has_key(dep_name):
-                            if eq_class['data'].intersection(self.blocks[dep_name].node_card_names):
+                        if blocks.has_key(dep_name):
+                            if eq_class['data'] & blocks[dep_name]._node_card_mask:
                                 eq_class['reservations'].add(res_name)
                                 break
 
+            del eq_class['data']
             for key in eq_class:
                 eq_class[key] = list(eq_class[key])
-            del eq_class['data']
 
         return equiv
     find_queue_equivalence_classes = exposed(find_queue_equivalence_classes)
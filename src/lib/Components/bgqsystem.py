@@ -24,7 +24,7 @@ import Cobalt
 import Cobalt.Data
 import Cobalt.Util
 from Cobalt.Util import get_config_option, disk_writer_thread 
-from Cobalt.Components.base import Component, exposed, automatic, query
+from Cobalt.Components.base import Component, exposed, automatic, query, readonly
 from Cobalt.Exceptions import ComponentLookupError, JobNotInteractive
 from Cobalt.Proxy import ComponentProxy
 from Cobalt.Statistics import Statistics
@@ -40,7 +40,8 @@ from Cobalt.Components.bgq_base_system import NODECARD_D_DIM_MASK
 from Cobalt.Components.bgq_base_system import A_DIM, B_DIM, C_DIM, D_DIM, E_DIM
 from Cobalt.Components.bgq_base_system import get_extents_from_size
 from Cobalt.Components.bgq_base_system import Wire
-from Cobalt.Components.bgq_base_system import NodeCard, BlockDict, BGProcessGroupDict, BGBaseSystem
+from Cobalt.Components.bgq_base_system import NodeCard, BlockDict, BlockResourceIndex, BGProcessGroupDict, BGBaseSystem
+from Cobalt.Components.bgq_base_system import BlockHardwareIndex
 
 #try:
     ##compatibiilty for older pythons, Check to see if this even matters for >= 2.6
@@ -174,6 +175,7 @@ class BGSystem (BGBaseSystem):
         self.compute_hardware_vec = None
         self.io_hardware_vec = None
         self.failed_io_midplane_cache = set()
+        self._init_block_state_cache()
         try:
             sim_xml_file = get_config_option("gravina","simulator_xml")
         except ConfigParser.NoOptionError:
@@ -239,10 +241,15 @@ class BGSystem (BGBaseSystem):
         self._blocks_lock = thread.allocate_lock()
         self.bridge_in_error = False
         self.cached_blocks = None
+        self._block_snapshots = {}
+        self._relatives_gen = 0
+        self._snapshot_relatives_gen = None
+        self._resource_index = BlockResourceIndex()
         self.offline_blocks = []
         self.compute_hardware_vec = None
         self.io_hardware_vec = None
         self.failed_io_midplane_cache = set()
+        self._init_block_state_cache()
         self.suspend_booting = False
         if state.has_key('suspend_booting'):
             self.suspend_booting = state['suspend_booting']
@@ -296,6 +303,21 @@ class BGSystem (BGBaseSystem):
         Component.save(self)
     save_me = automatic(save_me)
 
+    def _init_block_state_cache(self):
+        '''Forget the results of earlier block state passes, so that the next
+        pass recomputes every block.
+
+        '''
+        self._hardware_index = BlockHardwareIndex()
+        self._hardware_index_gen = None
+        self._hardware_status = {}
+        self._block_signatures = {}
+        self._block_state_cache = {} #block name: (state, offline)
+        self._reboot_blocked_ions = set()
+        self._failed_io_blocks_seen = set()
+        self._hardware_failures = {} #(kind, name): reason the hardware is unusable, or None
+        self._failed_hardware_mask = 0
+
     def _get_node_card(self, name, state="idle"):
         if not self.node_card_cache.has_key(name):
             self.node_card_cache[name] = NodeCard(name, state)
@@ -419,9 +441,7 @@ class BGSystem (BGBaseSystem):
                 continue
             if len(block.wires) == 0:
                 continue
-            block_nodeset = set(block.node_card_names)
-            other_nodeset = set(other.node_card_names)
-            if block_nodeset.isdisjoint(other_nodeset):
+            if not (block._node_card_mask & other._node_card_mask):
                 # we have no node-level hardware in common now check for
                 # wiring conflicts
                 bg_other = get_compute_block(other.name, True)
@@ -1138,7 +1158,8 @@ class BGSystem (BGBaseSystem):
 
     def _recompute_block_state(self, bg_cached_io_blocks=[]):
         '''Recompute the hardware and cleaning/allocated blockage for all
-        managed blocks.
+        managed blocks.  Blocks whose inputs have not changed since the last
+        pass are given the state computed for them then.
 
         Also handles IO Blocks
 
@@ -1191,208 +1212,303 @@ class BGSystem (BGBaseSystem):
             if boot.msg_type == 'initiate_boot':
                 self._blocks[boot.block_id].state = 'busy'
 
-        #Compute Block state update
-        for b in self._blocks.values():
-
-            if b.name not in self._managed_blocks:
-                continue
-
+        #Compute Block state update.  Only blocks whose own state, relatives or
+        #hardware changed since the last pass are recomputed; the rest keep the
+        #state they were given then.
+        managed = [b for b in self._blocks.values() if b.name in self._managed_blocks]
+        if self._update_hardware_index(managed):
+            self._block_state_cache = {}
+        signatures = dict([(b.name, (b.state, b.used_by, b.cleanup_pending)) for b in self._blocks.values()])
+        hardware_status = self._read_hardware_status()
+        self._update_hardware_failures(hardware_status)
+        dirty = self._find_dirty_blocks(managed, signatures, hardware_status, reboot_blocked_ions)
+        self.logger.log(1, "recompute_block_state: %d of %d blocks changed", len(dirty), len(managed))
+
+        for b in managed:
             if b.state == 'busy':
                 if not b.reserved_by:
                     b.reserved_until = False
+            if b.name not in dirty:
+                b.state, offline = self._block_state_cache[b.name]
+                if offline:
+                    self.offline_blocks.append(b.name)
+
+        for b in managed:
+            if b.name in dirty:
+                self._recompute_compute_block_state(b, reboot_blocked_ions)
+
+        offline = set(self.offline_blocks)
+        self._block_state_cache = dict([(b.name, (b.state, b.name in offline)) for b in managed])
+        self._block_signatures = signatures
+        self._hardware_status = hardware_status
+        self._reboot_blocked_ions = reboot_blocked_ions
+        self._failed_io_blocks_seen = set(self.failed_io_block_names)
+
+    def _update_hardware_index(self, managed):
+        '''Rebuild the hardware to block index if the managed blocks or their
+        relationships changed since it was built.  True if it was rebuilt.
 
-            if b.state != 'idle':
-                continue
+        '''
+        if self._hardware_index_gen == self._relatives_gen:
+            return False
+        self._hardware_index.clear()
+        subblock_parents = set()
+        for b in managed:
+            subblock_parent = None
+            if b.block_type == 'pseudoblock':
+                subblock_parent = self._blocks.get(b.subblock_parent, None)
+                if subblock_parent is not None:
+                    subblock_parents.add(subblock_parent)
+            self._hardware_index.add(b, subblock_parent)
+        #pseudoblocks check their parent's hardware too
+        for b in subblock_parents:
+            if b.name not in self._hardware_index.blocks:
+                self._hardware_index.add(b)
+        self._hardware_index_gen = self._relatives_gen
+        return True
 
-            if b.cleanup_pending:
-                b.state = 'cleanup'
-                continue
-            #failed diags/marked failed not in here
+    def _read_hardware_status(self):
+        '''Read the state of every indexed piece of hardware from the cached
+        bridge hardware vectors.
 
-            self.check_block_hardware(b, subblock_parent=b.has_subblocks)
-            if b.state != 'idle':
-                continue
+        '''
+        return dict([(key, self._read_hardware_key(key)) for key in self._hardware_index.hardware])
 
-            #check to see if our conencted IO block is about to become unusable
-            if not b.io_nodes.isdisjoint(reboot_blocked_ions):
-                b.state = 'blocked (Pending ION Reboot)'
-                continue
+    def _read_hardware_key(self, key):
+        '''Read the state of one piece of hardware.  Node card entries
+        include the block using the node card.
 
-            if b.used_by:
-                b.state = "allocated"
-                if b.block_type != "pseudoblock":
-                    continue
+        '''
+        kind, name = key
+        if kind == 'node_card':
+            nc_state = self.get_nodecard_state(name)
+            is_meta = self.get_nodecard_isMetaState(name)
+            error_node = None
+            if nc_state == pybgsched.Hardware.Error and is_meta:
+                error_node = self.get_node_in_error(name)
+            nc = self._hardware_index.node_cards.get(name, None)
+            return (nc_state, is_meta, error_node, getattr(nc, 'used_by', None))
+        elif kind == 'passthrough_node_card':
+            return (self.get_nodecard_state(name), self.get_nodecard_isMetaState(name))
+        elif kind == 'switch':
+            return self.get_switch_state(name)
+        elif kind == 'wire':
+            return self.get_wire_state(name)
+        else:
+            return (name in self.failed_io_midplane_cache,
+                    [(link.getState(), link.getIONodeState()) for link in self.io_link_to_mp_dict.get(name, [])])
 
-            #pseudoblock handling, busy isn't handled by the control system.
-            if b.block_type == "pseudoblock":
+    def _hardware_failure_reason(self, key, status):
+        '''Return the state a block using a piece of hardware is put in if
+        the hardware is not usable, None if it is.
 
-                if b.used_by:
-                    #mark busy if there is a related job
-                    block_jobs = self._get_jobs_on_block(b.subblock_parent)
-                    for job in block_jobs:
-                        if (job.getCorner() in [node.name for node in b.nodes] and
-                                job.getComputeNodesUsed() == b.size):
-                            #If I have a backend job on my nodes, then I'm busy.
-                            b.state = "busy"
-                            break
+        '''
+        kind, name = key
+        if kind == 'node_card':
+            nc_state, is_meta, error_node, used_by = status
+            if nc_state == pybgsched.Hardware.Available:
+                return None
+            if nc_state == pybgsched.Hardware.Error and is_meta:
+                #We have a nonzero number of nodes in error, the nodecard is actually fine
+                #take the first node that is in a non-software failure, non-available state
+                error_node_name, state_str = error_node
+                if error_node_name:
+                    return "hardware offline (%s): node %s" % (state_str, error_node_name)
+                return "hardware offline (%s): nodeboard %s" % ("SoftwareFailure", name)
+            return "hardware offline (%s): nodeboard %s" % (self.get_nodecard_state_str(name), name)
+        elif kind == 'passthrough_node_card':
+            nc_state, is_meta = status
+            if nc_state != pybgsched.Hardware.Available and not is_meta:
+                #the nodeboard itself is in error, nothing getting through.
+                return "hardware offline: passthrough nodeboard %s" % name
+        elif kind == 'switch':
+            if status != pybgsched.Hardware.Available:
+                return "hardware offline: switch %s" % name
+        elif kind == 'wire':
+            if status != pybgsched.Hardware.Available:
+                return "hardware offline: wire %s" % name
+        else:
+            if name in self.failed_io_midplane_cache:
+                return "Insufficient IO Links"
+            dead_ion_links = 0
+            for link in self.io_link_to_mp_dict.get(name, []):
+                if link.getState() != pybgsched.IOLink.Available:
+                    return "hardware offline (%s) IOLink %s" %(link.getStateString(), link.getDestinationLocation())
+                if link.getIONodeState() != pybgsched.Hardware.Available:
+                    dead_ion_links += 1
+                    if dead_ion_links > 4: #FIXME: make this configurable
+                        return "hardware offline (%s) IO Node %s" % (link.getIONodeStateString(),link.getDestinationLocation())
+        return None
 
-                if b.state != 'idle':
-                    #we are allocated/cleaning/otherwise occupied, do not let relatives run anything.
-                    for rel in b._relatives:
-                        if rel.state == 'idle':
-                            rel.state = "blocked (%s)" % b.name
-                    continue
+    def _update_hardware_failures(self, hardware_status):
+        '''Work out which indexed hardware is unusable this pass, once for
+        all of the blocks sharing it.
 
-                is_blocked = self.check_subblock_blocked(b)
-                if is_blocked:
-                    continue
+        '''
+        self._hardware_failures = dict([(key, self._hardware_failure_reason(key, status))
+                for key, status in hardware_status.iteritems()])
+        self._failed_hardware_mask = self._hardware_index.bitmap.mask(
+                [key for key, reason in self._hardware_failures.iteritems() if reason is not None])
 
-                # check the subblock parent to see if block is bootable,
-                # if the parent can't be booted, the pseudoblock is not
-                # going to be able to run anything
+    def _hardware_failure(self, key):
+        '''Return the reason a piece of hardware is unusable this pass, or
+        None.  Hardware not read at the start of the pass is read now.
 
-                subblock_parent_block = self._blocks[b.subblock_parent]
-                for nc in subblock_parent_block.node_cards:
-                    if nc.used_by:
-                        if (b.subblock_parent != nc.used_by or b.subblock_parent == b.name):
-                            b.state = "blocked (%s)" % nc.used_by
-                            break
-                if b.state != 'idle':
-                    continue
+        '''
+        try:
+            return self._hardware_failures[key]
+        except KeyError:
+            reason = self._hardware_failure_reason(key, self._read_hardware_key(key))
+            self._hardware_failures[key] = reason
+            return reason
 
-                self.check_block_hardware(subblock_parent_block, subblock_parent=True)
-                #if subblock_parent_block.state != 'idle':
-                #    b.state = subblock_parent_block.state
-                continue #do not process blocking.  Pseudoblock should be set by now.
+    def _find_dirty_blocks(self, managed, signatures, hardware_status, reboot_blocked_ions):
+        '''Return the names of the managed blocks whose state has to be
+        recomputed this pass.
 
+        signatures -- (state, used_by, cleanup_pending) of every block going into the pass
+        hardware_status -- the hardware states read this pass
 
-            #mark blocked in parent/child partition is allocated/cleaning
-            allocated = None
-            cleaning = None
-            for rel_block in b._relatives:
-                if rel_block.used_by or rel_block.state == 'busy':
-                    if rel_block.block_type != 'pseudoblock':
-                        allocated = rel_block
-                        break
-                    else:
-                        # if it is the subblock parent we're not really busy
-                        if b.name != rel_block.subblock_parent:
-                            allocated = rel_block
-                            break
-                if rel_block.cleanup_pending:
-                    cleaning = rel_block
-                    break
-            if cleaning:
-                b.state = 'blocked (%s)' % (cleaning.name,)
-            elif allocated:
-                b.state = "blocked (%s)" % (allocated.name,)
+        '''
+        if (reboot_blocked_ions != self._reboot_blocked_ions or
+                [name for name in self._block_signatures if name not in signatures]):
+            return set([b.name for b in managed])
+
+        dirty = set([b.name for b in managed if b.name not in self._block_state_cache])
+        #a block changing hands or cleaning up changes what its relatives may do
+        for name, signature in signatures.iteritems():
+            if self._block_signatures.get(name) != signature:
+                b = self._blocks[name]
+                dirty.add(name)
+                dirty.update([rel.name for rel in b._relatives])
+                dirty.update(b._wiring_conflicts)
+        changed_hardware = [key for key, key_status in hardware_status.iteritems()
+                if self._hardware_status.get(key) != key_status]
+        dirty.update(self._hardware_index.affected_blocks(changed_hardware))
+        dirty.update(self.failed_io_block_names ^ self._failed_io_blocks_seen)
+        #jobs on a pseudoblock and process groups on its parent are not
+        #tracked here, so those pseudoblocks and their relatives always go.
+        for b in managed:
+            if b.block_type != 'pseudoblock':
+                continue
+            parent = self._blocks.get(b.subblock_parent, None)
+            if b.used_by or (parent is not None and parent.state == 'busy'):
+                dirty.add(b.name)
+                dirty.update([rel.name for rel in b._relatives])
+        return dirty.intersection(self._managed_blocks)
 
+    def _recompute_compute_block_state(self, b, reboot_blocked_ions):
+        '''Recompute the hardware and cleaning/allocated blockage for a
+        single compute block.
 
-    def check_block_hardware(self, block, subblock_parent=False):
-        '''Check the cached hardware state and see if the block would
-        be blocked by failed hardware.
+        '''
+        if b.state != 'idle':
+            return
 
-        subblock_parent notes that this is a check for a pseudoblock's parent,
-        and, therefore, should ignore the blocked-busy detection, that must be
-        handled by the pseudoblock itself.
+        if b.cleanup_pending:
+            b.state = 'cleanup'
+            return
+        #failed diags/marked failed not in here
 
-        '''
+        self.check_block_hardware(b, subblock_parent=b.has_subblocks)
+        if b.state != 'idle':
+            return
 
-        def offline_if_not_available(block, nc):
-            '''Mark a block offline with an appropriate error indicator
-            if any of the block's nodecards are in a state other than A in
-            the control system. True if the block should be offlined.
+        #check to see if our conencted IO block is about to become unusable
+        if not b.io_nodes.isdisjoint(reboot_blocked_ions):
+            b.state = 'blocked (Pending ION Reboot)'
+            return
 
-            '''
-            if self.get_nodecard_state(nc.name) != pybgsched.Hardware.Available:
-                #if control system reports down, then we're really down.
-                block.state = "hardware offline (%s): nodeboard %s" % (self.get_nodecard_state_str(nc.name), nc.name)
-                self.offline_blocks.append(block.name)
-                if (self.get_nodecard_state(nc.name) == pybgsched.Hardware.Error and
-                        self.get_nodecard_isMetaState(nc.name)):
-                    #We have a nonzero number of nodes in error, the nodecard is actually fine
-                    #take the first node that is in a non-software failure, non-available state
-                    error_node_name, state_str = self.get_node_in_error(nc.name)
-                    if error_node_name:
-                        block.state = "hardware offline (%s): node %s" % (state_str, error_node_name)
-                        self.offline_blocks.append(block.name)
-                    else:
-                        block.state = "hardware offline (%s): nodeboard %s" % ("SoftwareFailure", nc.name)
-                        self.offline_blocks.append(block.name)
-                return True
-            return False
+        if b.used_by:
+            b.state = "allocated"
+            if b.block_type != "pseudoblock":
+                return
 
-        #Nodeboards in error
-        freeing_error_blocks = []
-        for nc in block.node_cards:
-            if not subblock_parent and nc.used_by and not block.block_type == 'pseudoblock':
-                #block if other stuff is running on our node cards.
-                #remember subblock jobs can violate this
-                block.state = "blocked (%s)" % nc.used_by
+        #pseudoblock handling, busy isn't handled by the control system.
+        if b.block_type == "pseudoblock":
 
-            offlined = offline_if_not_available(block, nc)
-            if offlined:
-               return
+            if b.used_by:
+                #mark busy if there is a related job
+                block_jobs = self._get_jobs_on_block(b.subblock_parent)
+                for job in block_jobs:
+                    if (job.getCorner() in [node.name for node in b.nodes] and
+                            job.getComputeNodesUsed() == b.size):
+                        #If I have a backend job on my nodes, then I'm busy.
+                        b.state = "busy"
+                        break
 
-        #Subblock parent with a nodeboard in error should cause all subblocks to become unavailable.
-        if block.block_type == 'pseudoblock':
-            subblock_parent_block = self._blocks[block.subblock_parent]
+            if b.state != 'idle':
+                #we are allocated/cleaning/otherwise occupied, do not let relatives run anything.
+                for rel in b._relatives:
+                    if rel.state == 'idle':
+                        rel.state = "blocked (%s)" % b.name
+                return
+
+            is_blocked = self.check_subblock_blocked(b)
+            if is_blocked:
+                return
+
+            # check the subblock parent to see if block is bootable,
+            # if the parent can't be booted, the pseudoblock is not
+            # going to be able to run anything
+
+            subblock_parent_block = self._blocks[b.subblock_parent]
             for nc in subblock_parent_block.node_cards:
-                offlined = offline_if_not_available(block, nc)
-                if offlined:
-                    return
+                if nc.used_by:
+                    if (b.subblock_parent != nc.used_by or b.subblock_parent == b.name):
+                        b.state = "blocked (%s)" % nc.used_by
+                        break
+            if b.state != 'idle':
+                return
 
-        #IOlink status
+            self.check_block_hardware(subblock_parent_block, subblock_parent=True)
+            #if subblock_parent_block.state != 'idle':
+            #    b.state = subblock_parent_block.state
+            return #do not process blocking.  Pseudoblock should be set by now.
 
-        if block.name in self.failed_io_block_names:
-            block.state = "Insufficient IO Links"
-            self.offline_blocks.append(block.name)
-            return
 
-        if block.midplanes.intersection(self.failed_io_midplane_cache):
-            block.state = "Insufficient IO Links"
-            self.offline_blocks.append(block.name)
-            return
+        #mark blocked in parent/child partition is allocated/cleaning
+        allocated = None
+        cleaning = None
+        for rel_block in b._relatives:
+            if rel_block.used_by or rel_block.state == 'busy':
+                if rel_block.block_type != 'pseudoblock':
+                    allocated = rel_block
+                    break
+                else:
+                    # if it is the subblock parent we're not really busy
+                    if b.name != rel_block.subblock_parent:
+                        allocated = rel_block
+                        break
+            if rel_block.cleanup_pending:
+                cleaning = rel_block
+                break
+        if cleaning:
+            b.state = 'blocked (%s)' % (cleaning.name,)
+        elif allocated:
+            b.state = "blocked (%s)" % (allocated.name,)
 
-        link_offline = False
-        for mp in block.midplanes:
-            dead_ion_links = 0
-            for link in self.io_link_to_mp_dict[mp]:
-                if link.getState() != pybgsched.IOLink.Available:
-                    block.state = "hardware offline (%s) IOLink %s" %(link.getStateString(), link.getDestinationLocation())
-                    self.offline_blocks.append(block.name)
-                    link_offline = True
-                    return
-                if link.getIONodeState() != pybgsched.Hardware.Available:
-                    dead_ion_links += 1
-                    if dead_ion_links > 4: #FIXME: make this configurable
-                        block.state = "hardware offline (%s) IO Node %s" % (link.getIONodeStateString(),link.getDestinationLocation())
-                        self.offline_blocks.append(block.name)
-                        link_offline = True
-                        return
-
-        #Block for passthrough
-        for nc in block.passthrough_node_cards:
-            if (self.get_nodecard_state(nc.name) != pybgsched.Hardware.Available and
-                    (not self.get_nodecard_isMetaState(nc.name))):
-                #the nodeboard itself is in error, nothing getting through.
-                block.state = "hardware offline: passthrough nodeboard %s" % nc.name
-                self.offline_blocks.append(block.name)
-                return
+    def check_block_hardware(self, block, subblock_parent=False):
+        '''Check the cached hardware state and see if the block would
+        be blocked by failed hardware.
 
-        #Block for dead switch
-        for sw in block.switches:
-            if self.get_switch_state(sw) != pybgsched.Hardware.Available:
-                block.state = "hardware offline: switch %s" % sw 
-                self.offline_blocks.append(block.name)
-                return
+        subblock_parent notes that this is a check for a pseudoblock's parent,
+        and, therefore, should ignore the blocked-busy detection, that must be
+        handled by the pseudoblock itself.
 
-        #Block for dead cables
-        for wire in block.wires:
-            if self.get_wire_state(wire) != pybgsched.Hardware.Available:
-                block.state = "hardware offline: wire %s" % wire
-                self.offline_blocks.append(block.name)
-                return
+        '''
+        if not subblock_parent and not block.block_type == 'pseudoblock':
+            for nc in block.node_cards:
+                if nc.used_by:
+                    #block if other stuff is running on our node cards.
+                    #remember subblock jobs can violate this
+                    block.state = "blocked (%s)" % nc.used_by
+
+        reason = self._block_hardware_failure(block)
+        if reason is not None:
+            block.state = reason
+            self.offline_blocks.append(block.name)
+            return
 
         #wiring conflicts are caught by parent/child
         for dep_name in block._wiring_conflicts:
@@ -1408,6 +1524,42 @@ class BGSystem (BGBaseSystem):
                 return
         return
 
+    def _block_hardware_failure(self, block):
+        '''Return the state a block is put in by failed hardware, or None if
+        all of its hardware is usable.  An indexed block none of whose
+        hardware failed this pass is passed on a single mask test.
+
+        '''
+        mask = self._hardware_index.masks.get(block.name, None)
+        if (mask is not None and not mask & self._failed_hardware_mask and
+                block.name not in self.failed_io_block_names):
+            return None
+
+        #Nodeboards in error.  A subblock parent with a nodeboard in error
+        #should cause all subblocks to become unavailable.
+        node_cards = list(block.node_cards)
+        if block.block_type == 'pseudoblock':
+            node_cards.extend(self._blocks[block.subblock_parent].node_cards)
+        for nc in node_cards:
+            reason = self._hardware_failure(('node_card', nc.name))
+            if reason is not None:
+                return reason
+
+        #IOlink status
+        if block.name in self.failed_io_block_names:
+            return "Insufficient IO Links"
+        if block.midplanes.intersection(self.failed_io_midplane_cache):
+            return "Insufficient IO Links"
+        hardware = [('midplane', mp) for mp in block.midplanes]
+        #Block for passthrough, dead switches and dead cables
+        hardware.extend([('passthrough_node_card', nc.name) for nc in block.passthrough_node_cards])
+        hardware.extend([('switch', sw) for sw in block.switches])
+        hardware.extend([('wire', wire) for wire in block.wires])
+        for key in hardware:
+            reason = self._hardware_failure(key)
+            if reason is not None:
+                return reason
+        return None
 
     def check_io_block_hardware(self, io_block):
         '''Check the state of an IO Block's hardware.  Return None if no offlne hardware, else return an error message.'''
@@ -1741,6 +1893,7 @@ class BGSystem (BGBaseSystem):
                         b.state = _get_state(block)
                         if b.state == 'idle' and b.freeing == True:
                             b.freeing = False
+                            self.notify_scheduler("block freed")
                         b._update_node_cards()
                         if b.reserved_until and now > b.reserved_until:
                             b.reserved_until = False
@@ -1749,6 +1902,7 @@ class BGSystem (BGBaseSystem):
                         new_blocks.append(block)
 
                 # remove the missing partitions and their wiring relations
+                relatives_changed = []
                 really_subblocks = []
                 for bname in missing_blocks:
                     if self._blocks[bname].size < 128 and self._blocks[bname].subblock_parent not in missing_blocks:
@@ -1761,6 +1915,7 @@ class BGSystem (BGBaseSystem):
                         self._blocks[dep_name]._wiring_conflicts.discard(b.name)
                     if b.name in self._managed_blocks:
                         self._managed_blocks.discard(b.name)
+                        relatives_changed.append(b.name)
                     del self._blocks[b.name]
 
                 for bname in really_subblocks:
@@ -1808,13 +1963,15 @@ class BGSystem (BGBaseSystem):
                         self._blocks.q_add([self._new_block_dict(new_block_info[0])])
                         b = self._blocks[block.getName()]
                         self._detect_wiring_deps(b)
+                        if b.name in self._managed_blocks:
+                            relatives_changed.append(b.name)
                     else:
                         self.logger.info("Block %s no longer in control system.  Block not added.", block.getName())
 
                 # if partitions were added or removed, then update the relationships between partitions
                 if len(missing_blocks) > 0 or len(new_blocks) > 0:
                     self.logger.debug("update_block_state updating relatives for new blocks.")
-                    self.update_relatives()
+                    self.update_relatives(relatives_changed)
                 block_modification_time.stop()
                 self.logger.log(1, "block_modification time: %f", block_modification_time.elapsed_time)
                 bf_end = time.time()
@@ -1839,6 +1996,7 @@ class BGSystem (BGBaseSystem):
                                 b.freeing = False
                                 self.logger.info("partition %s: cleaning complete",
                                         b.name)
+                                self.notify_scheduler("cleanup done")
                         else:
                             # check ongoing cleanup
                             busy = []
@@ -1859,6 +2017,7 @@ class BGSystem (BGBaseSystem):
                                 b.cleanup_pending = False
                                 b.freeing = False
                                 self.logger.info("partition %s: cleaning complete", b.name)
+                                self.notify_scheduler("cleanup done")
 
                     if b.state not in ["cleanup","cleanup-initiate"] and b.block_type != 'pseudoblock':
                         # Cleanup blocks that have had their jobs terminate early.
@@ -2420,7 +2579,7 @@ class BGSystem (BGBaseSystem):
     def get_process_groups (self, specs):
         '''Fetch the dictionary of the current process groups indexed by the process group id.'''
         return self.process_groups.q_get(specs)
-    get_process_groups = exposed(query(get_process_groups))
+    get_process_groups = readonly(exposed(query(get_process_groups)))
 
     def _get_exit_status (self):
         '''Get the exit status of a process group that has completed.
@@ -12,8 +12,8 @@ import math
 
 import Cobalt.Logging, Cobalt.Util
 from Cobalt.Data import Data, DataDict, ForeignData, ForeignDataDict, IncrID
-from Cobalt.Components.base import Component, exposed, automatic, query, locking
-from Cobalt.Proxy import ComponentProxy
+from Cobalt.Components.base import Component, exposed, automatic, query, locking, readonly
+from Cobalt.Proxy import ComponentProxy, MultiCall
 from Cobalt.Exceptions import ReservationError, DataCreationError, ComponentLookupError
 
 import Cobalt.SchedulerPolicies
@@ -442,6 +442,10 @@ class Job (ForeignData):
         'geometry'
     ]
 
+    # the fields schedule_jobs and friends query on every pass
+    indexed = ['jobid', 'queue', 'state', 'user', 'is_runnable',
+               'has_resources']
+
     def __init__ (self, spec):
         ForeignData.__init__(self, spec)
         spec = spec.copy()
@@ -475,6 +479,7 @@ class JobDict(ForeignDataDict):
     key = 'jobid'
     __oserror__ = Cobalt.Util.FailureMode("QM Connection (job)")
     __function__ = ComponentProxy("queue-manager").get_jobs
+    __changes__ = ComponentProxy("queue-manager").get_job_changes
     __fields__ = ['nodes', 'location', 'jobid', 'state', 'index',
                   'walltime', 'queue', 'user', 'submittime', 'starttime',
                   'project', 'is_runnable', 'is_active', 'has_resources',
@@ -549,6 +554,7 @@ class BGSched (Component):
         self.jobs = JobDict()
         self.started_jobs = {}
         self.sync_state = Cobalt.Util.FailureMode("Foreign Data Sync")
+        self.multicall = True
         self.active = True
 
         self.get_current_time = time.time
@@ -569,8 +575,9 @@ class BGSched (Component):
                 'active':self.active,
                 'next_res_id':self.id_gen.idnum+1, 
                 'next_cycle_id':self.cycle_id_gen.idnum+1, 
-                'msg_queue': dbwriter.msg_queue, 
-                'overflow': dbwriter.overflow})
+                'msg_queue': dbwriter.pending_messages(), 
+                'overflow': dbwriter.overflow,
+                'overflow_offset': dbwriter.overflow_offset})
         return state
 
     def __setstate__(self, state):
@@ -596,6 +603,7 @@ class BGSched (Component):
         self.jobs = JobDict()
         self.started_jobs = {}
         self.sync_state = Cobalt.Util.FailureMode("Foreign Data Sync")
+        self.multicall = True
 
         self.get_current_time = time.time
 
@@ -603,6 +611,7 @@ class BGSched (Component):
             dbwriter.msg_queue = state['msg_queue']
         if state.has_key('overflow') and (dbwriter.max_queued != None):
             dbwriter.overflow = state['overflow']
+            dbwriter.overflow_offset = state.get('overflow_offset', 0)
 
     # order the jobs with biggest utility first
     def utilitycmp(self, job1, job2):
@@ -696,7 +705,7 @@ class BGSched (Component):
 
         '''
         return self.reservations.q_get(specs)
-    get_reservations = exposed(query(get_reservations))
+    get_reservations = readonly(exposed(query(get_reservations)))
 
     def set_reservations(self, specs, updates, user_name):
         '''Exposed method for resetting reservation information from setres.
@@ -833,28 +842,77 @@ class BGSched (Component):
                 self.logger.error("failed to connect to system component")
                 best_partition_dict = {}
 
+            starts = []
             for jobid in best_partition_dict:
                 job = self.jobs[int(jobid)]
                 self.logger.info("Starting job %d/%s in reservation %s",
                         job.jobid, job.user, cur_res.name)
-                self._start_job(job, best_partition_dict[jobid], {str(job.jobid):cur_res.res_id})
+                starts.append((job, best_partition_dict[jobid], {str(job.jobid):cur_res.res_id}))
+            if starts:
+                self._start_jobs(starts)
 
     def _start_job(self, job, partition_list, resid=None):
         """Get the queue manager to start a job."""
+        self._start_jobs([(job, partition_list, resid)])
 
-        cqm = ComponentProxy("queue-manager")
+    def _start_jobs(self, starts):
+        """Get the queue manager to start several jobs in one request.
 
-        try:
+        starts -- list of (job, partition_list, resid) tuples
+        """
+        calls = []
+        for job, partition_list, resid in starts:
             self.logger.info("trying to start job %d on partition %r" % (job.jobid, partition_list))
-            cqm.run_jobs([{'tag':"job", 'jobid':job.jobid}], partition_list, None, resid, job.walltime)
+            calls.append(([{'tag':"job", 'jobid':job.jobid}], partition_list, None, resid, job.walltime))
+
+        try:
+            results = self._call_each("queue-manager", "run_jobs", calls)
         except ComponentLookupError:
             self.logger.error("failed to connect to queue manager")
             return
+        except xmlrpclib.Fault, fault:
+            self.logger.error("failed to start jobs: %s", fault.faultString)
+            return
 
-        self.started_jobs[job.jobid] = self.get_current_time()
+        for (job, partition_list, resid), result in zip(starts, results):
+            if isinstance(result, xmlrpclib.Fault):
+                self.logger.error("failed to start job %d: %s", job.jobid, result.faultString)
+                continue
+            self.started_jobs[job.jobid] = self.get_current_time()
 
 
 
+    def _call_each(self, component, method_name, calls):
+        '''Make a call to a component for each set of arguments in calls.
+
+        The calls are sent in one system.multicall request.  A component that
+        does not support system.multicall is remembered, and it and any other
+        component are then called once per set of arguments instead.
+
+        Returns the result of each call, or an xmlrpclib.Fault for each call
+        that failed.  Errors reaching the component are raised.
+        '''
+        proxy = ComponentProxy(component)
+        if self.multicall:
+            batch = MultiCall(proxy)
+            for args in calls:
+                getattr(batch, method_name)(*args)
+            try:
+                return batch()
+            except xmlrpclib.Fault, fault:
+                if 'system.multicall' not in fault.faultString:
+                    raise
+                # an older component; make the calls one at a time
+                self.logger.warning("%s does not support system.multicall; making calls individually", component)
+                self.multicall = False
+        results = []
+        for args in calls:
+            try:
+                results.append(getattr(proxy, method_name)(*args))
+            except xmlrpclib.Fault, fault:
+                results.append(fault)
+        return results
+
     def schedule_jobs (self):
         '''look at the queued jobs, and decide which ones to start
         This entire method completes prior to the job's timer starting
@@ -939,6 +997,9 @@ class BGSched (Component):
             self.logger.error("failed to connect to system component")
             return
 
+        # equivalence classes share no resources, so the placement for
+        # every class is asked for in one batch
+        placements = []
         for eq_class in equiv:
             # recall that is_runnable is True for certain types of holds
             temp_jobs = self.jobs.q_get([{'is_runnable':True, 'queue':queue.name} for queue in active_queues \
@@ -1029,21 +1090,47 @@ class BGSched (Component):
                         break
                 job_location_args.append(job_info)
 
-            try:
-                self.logger.debug("calling from main sched %s", eq_class)
-                best_partition_dict = ComponentProxy("system").find_job_location(job_location_args, end_times)
-            except:
-                self.logger.error("failed to connect to system component")
-                self.logger.debug("%s", traceback.format_exc())
-                best_partition_dict = {}
+            self.logger.debug("calling from main sched %s", eq_class)
+            placements.append((job_location_args, end_times))
 
+        if not placements:
+            return
+        try:
+            results = self._call_each("system", "find_job_location", placements)
+        except ComponentLookupError:
+            self.logger.error("failed to connect to system component")
+            results = []
+        except:
+            self.logger.error("failed to get job placements from the system component")
+            self.logger.debug("%s", traceback.format_exc())
+            results = []
+
+        starts = []
+        for best_partition_dict in results:
+            if isinstance(best_partition_dict, xmlrpclib.Fault):
+                self.logger.error("find_job_location failed: %s", best_partition_dict.faultString)
+                continue
             for jobid in best_partition_dict:
                 job = self.jobs[int(jobid)]
-                self._start_job(job, best_partition_dict[jobid])
+                starts.append((job, best_partition_dict[jobid], None))
+        if starts:
+            self._start_jobs(starts)
 
 
     schedule_jobs = locking(automatic(schedule_jobs,
-        float(get_bgsched_config('schedule_jobs_interval', 10))))
+        float(get_bgsched_config('schedule_jobs_interval', 10)),
+        float(get_bgsched_config('schedule_jobs_min_spacing', 1))))
+
+    def wake_scheduler(self, reason=None):
+        """Run a scheduling pass soon rather than waiting for the interval.
+
+        Called by cqm and the system component when jobs or resources
+        change.  Bursts of wakeups are coalesced into one pass, and passes
+        are kept schedule_jobs_min_spacing seconds apart.
+        """
+        self.logger.debug("scheduling pass requested: %s", reason)
+        self.wake_task('schedule_jobs')
+    wake_scheduler = locking(exposed(wake_scheduler))
 
     def enable(self, user_name):
         """Enable scheduling"""
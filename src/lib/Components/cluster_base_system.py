@@ -4,6 +4,7 @@ Classes:
 ClusterBaseSystem -- base system component
 """
 
+import bisect
 import time
 import sys
 import Cobalt
@@ -16,7 +17,7 @@ from Cobalt.Exceptions import  JobValidationError, NotSupportedError, ComponentL
 from Cobalt.DataTypes.ProcessGroup import ProcessGroupDict
 from Cobalt.Data import DataDict
 from Cobalt.Proxy import ComponentProxy
-from Cobalt.Components.base import Component, exposed, automatic
+from Cobalt.Components.base import Component, exposed, automatic, readonly, locking
 from Cobalt.Util import config_true_values
 
 __all__ = [
@@ -117,6 +118,100 @@ class ClusterNode(object):
         self.queues = queue_list
         #logger.info('node %s queues are now %s', self.name, " ".join(q for q in self.queues))
 
+class ClusterTopology(object):
+    '''Switch and rack layout of the nodes in a cluster.
+
+    The layout is read from the file named by the topology_file option in the
+    cluster_system section.  Each line holds a node name, the switch that the
+    node is attached to and, optionally, the rack holding that switch.  Text
+    after a # is ignored.  Nodes that are not listed share an unnamed switch.
+    Set topology_cls on the system component to a subclass to derive the layout
+    some other way.
+    '''
+
+    def __init__(self):
+        self.switches = {} # node name:switch name
+        self.racks = {} # switch name:rack name
+
+    def read(self, filename):
+        '''Add the nodes listed in a topology file.'''
+        topology_file = open(filename)
+        try:
+            for line in topology_file:
+                fields = line.split('#')[0].split()
+                if not fields:
+                    continue
+                if len(fields) not in (2, 3):
+                    raise ValueError("%s: expected \"node switch [rack]\", got \"%s\"" % (filename, line.strip()))
+                self.add_node(*fields)
+        finally:
+            topology_file.close()
+
+    def add_node(self, name, switch, rack=None):
+        self.switches[name] = switch
+        self.racks[switch] = rack
+
+    def select(self, candidates, count, node_order):
+        '''Choose count of the candidate nodes, spanning as few switches and
+        racks as possible and, within a switch, the most closely spaced nodes
+        in node_order (hostfile order).
+
+        A single switch is used if one has enough candidates; the one with the
+        fewest candidates that still fits is taken, leaving larger switches for
+        larger jobs.  Otherwise the job is packed into as few racks as possible,
+        and within those into as few switches as possible, in the same way.
+        Apart from sorting, the cost is linear in the number of candidates.
+        '''
+        by_switch = {}
+        for node in candidates:
+            by_switch.setdefault(self.switches.get(node), []).append(node)
+        by_rack = {}
+        for switch, nodes in by_switch.iteritems():
+            nodes.sort(key=lambda node: node_order.get(node, len(node_order)))
+            by_rack.setdefault(self.racks.get(switch), []).append(nodes)
+
+        def switch_key(nodes):
+            return (len(nodes), node_order.get(nodes[0], len(node_order)))
+        def rack_key(switches):
+            return (sum([len(nodes) for nodes in switches]), min([switch_key(nodes)[1] for nodes in switches]))
+        def take_from_switch(nodes, count):
+            return self._closest_nodes(nodes, count, node_order)
+        def take_from_rack(switches, count):
+            return self._pack(switches, count, switch_key, take_from_switch)
+
+        switches = [nodes for switch_list in by_rack.itervalues() for nodes in switch_list]
+        fits = [nodes for nodes in switches if len(nodes) >= count]
+        if fits:
+            return take_from_switch(min(fits, key=switch_key), count)
+        return self._pack(by_rack.values(), count, rack_key, take_from_rack)
+
+    def _pack(self, groups, count, key, take):
+        '''Take count nodes from as few groups as possible: the smallest group
+        that holds all that remain, or else all of the largest group.'''
+        groups = sorted(groups, key=key)
+        sizes = [key(group)[0] for group in groups]
+        selected = []
+        while count > 0 and groups:
+            fit = bisect.bisect_left(sizes, count)
+            if fit < len(groups):
+                selected.extend(take(groups[fit], count))
+                break
+            group = groups.pop()
+            size = sizes.pop()
+            selected.extend(take(group, size))
+            count -= size
+        return selected
+
+    def _closest_nodes(self, nodes, count, node_order):
+        '''Return the run of count nodes (already in node order) that spans the
+        fewest positions in node_order.'''
+        if count >= len(nodes):
+            return list(nodes)
+        positions = [node_order.get(node, len(node_order)) for node in nodes]
+        start = min(range(len(nodes) - count + 1), key=lambda i: positions[i + count - 1] - positions[i])
+        return nodes[start:start + count]
+
+
 class ClusterNodeDict(DataDict):
     '''default container for ClusterNode information
 
@@ -134,11 +229,14 @@ class ClusterBaseSystem (Component):
     del_partitions -- tell the system not to manage partitions (exposed, query)
     set_partitions -- change random attributes of partitions (exposed, query)
     update_relatives -- should be called when partitions are added and removed from the managed list
+    batch_progress -- run check_done_cleaning now; called by the forker as batched epilogues finish (exposed)
 
     """
 
     global cluster_hostfile
 
+    topology_cls = ClusterTopology
+
     def __init__ (self, *args, **kwargs):
         Component.__init__(self, *args, **kwargs)
         self.process_groups = ProcessGroupDict()
@@ -164,6 +262,7 @@ class ClusterBaseSystem (Component):
         self.cleaning_host_count = {} # jobid:count
         self.locations_by_jobid = {} #jobid:[locations]
         self.jobid_to_user = {} #jobid:username
+        self._init_cleanup_batches()
 
         self.alloc_timeout = int(get_cluster_system_config("allocation_timeout", 300))
         self.node_end_time_dict = {}
@@ -214,6 +313,7 @@ class ClusterBaseSystem (Component):
         self.cleaning_host_count = {} # jobid:count
         self.locations_by_jobid = {} #jobid:[locations]
         self.jobid_to_user = {} #jobid:username
+        self._init_cleanup_batches()
 
         self.alloc_timeout = int(get_cluster_system_config("allocation_timeout", 300))
         self.logger.info("allocation timeout set to %d seconds." % self.alloc_timeout)
@@ -225,6 +325,25 @@ class ClusterBaseSystem (Component):
         self.set_drain_mode(get_cluster_system_config("drain_mode", 'backfill'))
 
 
+    def _init_cleanup_batches(self):
+        '''Set up tracking for epilogues run as one forker batch per job.
+
+        In the default "per_host" cleanup mode, one epilogue is forked per
+        host and each is polled for separately.  In "fanout" mode, the
+        epilogues for all of a job's hosts are handed to the forker as a
+        single batch, run at most cleanup_max_running at a time, and the
+        forker calls batch_progress as hosts finish.
+        '''
+        self.cleanup_mode = get_cluster_system_config("cleanup_mode", "per_host")
+        if self.cleanup_mode not in ('per_host', 'fanout'):
+            self.logger.error("invalid cleanup_mode %s; using per_host", self.cleanup_mode)
+            self.cleanup_mode = 'per_host'
+        self.cleanup_max_running = int(get_cluster_system_config("cleanup_max_running", 64))
+        self.cleaning_batches = {} #batch_id:cleaning batch info
+        self.cleaning_batches_to_retry = []
+        self.cleaning_batch_acks = [] #[batch_id, host] results handled but not yet acknowledged to the forker
+        self.logger.info("node cleanup mode set to %s." % self.cleanup_mode)
+
     def save_me(self):
         '''Automatically write statefiles.'''
         Component.save(self)
@@ -339,10 +458,21 @@ class ClusterBaseSystem (Component):
             # do we have enough that are idle?  The job is smaller than our drain time.
             idle_nodes = available_nodes.difference(self.running_nodes)
             if len(idle_nodes) >= nodes:
-                selected_locations = set([idle_nodes.pop() for _ in range(nodes)])
+                selected_locations = self._select_nodes(idle_nodes, nodes)
                 ready_to_run = True
 
-        if drain_time == 0 and ready_to_run == False: #go ahead and select locations for draining.
+        if drain_time == 0 and ready_to_run == False and self.placement_mode == 'topology':
+            #collect every node free by the soonest time that enough are, then place the job among them.
+            drain_candidates = set()
+            ready_times = self.node_end_time_dict.keys()
+            ready_times.sort()
+            for ready_time in ready_times:
+                new_drain_time = ready_time
+                drain_candidates.update(available_nodes.intersection(self.node_end_time_dict[ready_time]))
+                if len(drain_candidates) >= nodes:
+                    break
+            selected_locations = self._select_nodes(drain_candidates, min(nodes, len(drain_candidates)))
+        elif drain_time == 0 and ready_to_run == False: #go ahead and select locations for draining.
             #choose the idle nodes, iterate over times adding nodes until we have enough with the shortest wait.
             remaining_node_count = nodes
             ready_times = self.node_end_time_dict.keys()
@@ -364,6 +494,15 @@ class ClusterBaseSystem (Component):
         #Jobid has to be a string or else xmlrpc has trouble with the dict. XMLRPC also doesn't like sets.
         return {str(job['jobid']): list(selected_locations)}, new_drain_time, ready_to_run
 
+    def _select_nodes(self, candidates, count):
+        '''Choose count nodes from a set of candidates according to the
+        placement mode.  The candidate set may be consumed.
+
+        '''
+        if self.placement_mode == 'topology':
+            return set(self.topology.select(candidates, count, self.node_order))
+        return set([candidates.pop() for _ in range(count)])
+
     def _get_available_nodes(self, args):
         '''Get all nodes required for a job, ignoring forbidden ones (i.e. reserved nodes).
 
@@ -838,7 +977,7 @@ class ClusterBaseSystem (Component):
             status_list.append( (node, status, self.node_order[node]) )
         status_list.sort(my_cmp)
         return status_list
-    get_node_status = exposed(get_node_status)
+    get_node_status = readonly(exposed(get_node_status))
 
     def get_queue_assignments(self):
         '''Fetch the node to queue mapping for display.'''
@@ -846,7 +985,7 @@ class ClusterBaseSystem (Component):
         for queues in self.queue_assignments:
             ret[queues] = list(self.queue_assignments[queues])
         return ret
-    get_queue_assignments = exposed(get_queue_assignments)
+    get_queue_assignments = readonly(exposed(get_queue_assignments))
 
     def set_queue_assignments(self, queue_names, node_list, user_name=None):
         '''Associate queues with nodes from an external client.'''
@@ -886,9 +1025,24 @@ class ClusterBaseSystem (Component):
     verify_locations = exposed(verify_locations)
 
     def configure(self, filename):
-        '''Add nodes from hostfile to Cobalt's configuration of tracked nodes.
+        '''Add nodes from hostfile to Cobalt's configuration of tracked nodes,
+        along with their switch and rack layout from the topology file.
 
         '''
+        self.topology = self.topology_cls()
+        topology_file = get_cluster_system_config("topology_file", None)
+        if topology_file is not None:
+            try:
+                self.topology.read(os.path.expandvars(topology_file))
+            except (IOError, ValueError), err:
+                self.logger.error("unable to load topology file; placing nodes without it: %s", err)
+                self.topology = self.topology_cls()
+
+        self.placement_mode = get_cluster_system_config("placement_mode", "any")
+        if self.placement_mode not in ('any', 'topology'):
+            self.logger.error("invalid placement_mode %s; using any", self.placement_mode)
+            self.placement_mode = 'any'
+
         hostfile = open(filename)
 
         counter = 0
@@ -952,6 +1106,10 @@ class ClusterBaseSystem (Component):
             group_name = ""
             self.logger.error("Job %s/%s: unable to determine group name for epilogue" % (user, jobid))
 
+        if self.cleanup_mode == 'fanout':
+            self._clean_nodes_batch(locations, user, jobid, group_name)
+            return
+
         self.cleaning_host_count[jobid] = 0
         for host in locations:
             h = host.split(":")[0]
@@ -987,8 +1145,58 @@ class ClusterBaseSystem (Component):
                 self.down_nodes.add(h)
                 self.running_nodes.discard(h)
 
-    def launch_script(self, config_option, host, jobid, user, group_name):
-        '''Start our script processes used for node prep and cleanup.
+    def _clean_nodes_batch(self, locations, user, jobid, group_name):
+        '''Start cleaning all of a job's hosts with a single forker batch.
+
+        '''
+        hosts = set([host.split(":")[0] for host in locations])
+        self.cleaning_host_count[jobid] = len(hosts)
+        cleaning_batch = {
+                "hosts": hosts,
+                "user": user,
+                "jobid": jobid,
+                "group": group_name,
+                }
+        self._launch_cleaning_batch(cleaning_batch)
+
+    def _launch_cleaning_batch(self, cleaning_batch):
+        '''Hand the epilogues for a cleaning batch to the forker.  If the
+        forker cannot be reached, the batch is retried by
+        retry_cleaning_scripts.
+
+        '''
+        user = cleaning_batch['user']
+        jobid = cleaning_batch['jobid']
+        commands = {}
+        for host in cleaning_batch['hosts']:
+            cmd = self._script_command("epilogue", host, jobid, user, cleaning_batch['group'])
+            if cmd == None:
+                #there was no script to run.
+                self.running_nodes.difference_update(cleaning_batch['hosts'])
+                self.cleaning_host_count[jobid] = 0
+                return
+            commands[host] = cmd
+        try:
+            batch_id = ComponentProxy("system_script_forker").fork_batch(commands, "system epilogue",
+                    "Job %s/%s" % (jobid, user), self.cleanup_max_running,
+                    float(get_cluster_system_config("epilogue_timeout", 60.0)), self.name)
+        except ComponentLookupError:
+            self.logger.warning("Job %s/%s: Error contacting forker "
+                    "component.  Will Retry until timeout." % (user, jobid))
+            self.cleaning_batches_to_retry.append(cleaning_batch)
+        except:
+            self.logger.error("Job %s/%s: Failed to run epilogue on hosts "
+                    "%s, marking nodes down", jobid, user,
+                    Cobalt.Util.merge_nodelist(cleaning_batch['hosts']), exc_info=True)
+            self.cleaning_host_count[jobid] -= len(cleaning_batch['hosts'])
+            self.down_nodes.update(cleaning_batch['hosts'])
+            self.running_nodes.difference_update(cleaning_batch['hosts'])
+        else:
+            self.cleaning_batches[batch_id] = cleaning_batch
+
+    def _script_command(self, config_option, host, jobid, user, group_name):
+        '''Build the command that runs a node prep or cleanup script for a
+        host, or return None if the script is not configured.
 
         '''
         script = get_cluster_system_config(config_option, None)
@@ -997,15 +1205,23 @@ class ClusterBaseSystem (Component):
                     "cluster_system section of the cobalt config file!",
                     user, jobid, config_option)
             return None
+        if (get_cluster_system_config("run_remote", 'true').lower() in config_true_values):
+            cmd = ["/usr/bin/ssh", host, script, str(jobid), user, group_name]
         else:
-            if (get_cluster_system_config("run_remote", 'true').lower() in config_true_values):
-                cmd = ["/usr/bin/ssh", host, script, str(jobid), user, group_name]
-            else:
-                cmd = script.split()
-                cmd.append(str(jobid))
-                cmd.append(user)
-                cmd.append(group_name)
-            return ComponentProxy("system_script_forker").fork(cmd, "system epilogue", "Job %s/%s" % (jobid, user))
+            cmd = script.split()
+            cmd.append(str(jobid))
+            cmd.append(user)
+            cmd.append(group_name)
+        return cmd
+
+    def launch_script(self, config_option, host, jobid, user, group_name):
+        '''Start our script processes used for node prep and cleanup.
+
+        '''
+        cmd = self._script_command(config_option, host, jobid, user, group_name)
+        if cmd == None:
+            return None
+        return ComponentProxy("system_script_forker").fork(cmd, "system epilogue", "Job %s/%s" % (jobid, user))
 
     def retry_cleaning_scripts(self):
         '''Continue retrying scripts in the event that we have lost contact
@@ -1037,6 +1253,10 @@ class ClusterBaseSystem (Component):
                     self.cleaning_host_count[cleaning_process['jobid']] -= 1
                     self.down_nodes.add(cleaning_process['host'])
                     self.running_nodes.discard(cleaning_process['host'])
+        cleaning_batches = self.cleaning_batches_to_retry
+        self.cleaning_batches_to_retry = []
+        for cleaning_batch in cleaning_batches:
+            self._launch_cleaning_batch(cleaning_batch)
 
     retry_cleaning_scripts = automatic(retry_cleaning_scripts,
             get_cluster_system_config("automatic_method_interval", 10.0))
@@ -1049,6 +1269,9 @@ class ClusterBaseSystem (Component):
 
         """
 
+        if self.cleaning_batches or self.cleaning_batch_acks:
+            self._check_done_cleaning_batches()
+
         if self.cleaning_processes == []:
             #don't worry if we have nothing to cleanup
             return
@@ -1107,6 +1330,7 @@ class ClusterBaseSystem (Component):
                 self.running_nodes.discard(cleaning_process["host"])
                 cleaning_process["completed"] = True
                 self.cleaning_host_count[jobid] -= 1
+                self.notify_scheduler("cleanup done")
             elif (exit_status != 0) and (exit_status != None):
                 #assume a nonzero status is a script-failure.
                 self.__mark_failed_cleaning(cleaning_process)
@@ -1139,18 +1363,88 @@ class ClusterBaseSystem (Component):
                             "host down" % (user, jobid, cleaning_process['host']))
 
             if self.cleaning_host_count[jobid] == 0:
-                self.del_process_groups(jobid)
-                #clean up other cleanup-monitoring stuff
-                self.logger.info("Job %s/%s: job finished on %s",
-                    user, jobid, Cobalt.Util.merge_nodelist(self.locations_by_jobid[jobid]))
-                del self.locations_by_jobid[jobid]
-                del self.jobid_to_user[jobid]
+                self.__finish_cleaning(jobid, user)
 
         self.cleaning_processes = [cleaning_process for cleaning_process in self.cleaning_processes
                                     if not cleaning_process["completed"]]
     check_done_cleaning = automatic(check_done_cleaning,
             get_cluster_system_config("automatic_method_interval", 10.0))
 
+    def _check_done_cleaning_batches(self):
+        '''Release hosts whose batched epilogues have finished, and mark
+        down the hosts whose epilogues failed, were lost or timed out.  The
+        forker interrupts timed out epilogues itself.
+
+        '''
+        try:
+            batches = ComponentProxy("system_script_forker").poll_batches(self.cleaning_batches.keys(),
+                    self.cleaning_batch_acks)
+        except ComponentLookupError:
+            self.logger.error("Could not communicate with "
+                            "forker component during cleanup")
+            return
+        self.cleaning_batch_acks = []
+
+        for batch in batches:
+            cleaning_batch = self.cleaning_batches[batch['id']]
+            user = cleaning_batch['user']
+            jobid = cleaning_batch['jobid']
+            for host, result in batch['finished'].iteritems():
+                self.cleaning_batch_acks.append([batch['id'], host])
+                if host not in cleaning_batch['hosts']:
+                    continue
+                cleaning_batch['hosts'].discard(host)
+                cleaning_process = {'user':user, 'jobid':jobid, 'host':host}
+                if result['lost_child']:
+                    self.logger.warning("Job %s/%s: the epilogue for host %s was lost",
+                            user, jobid, host)
+                    self.__mark_failed_cleaning(cleaning_process)
+                elif result['timed_out']:
+                    self.__mark_failed_cleaning(cleaning_process,
+                        "Job %s/%s: epilogue timed out on host %s, marking "
+                        "host down" % (user, jobid, host))
+                elif result['exit_status'] == 0:
+                    self.logger.info("Job %s/%s: cleanup completed for host: %s",
+                            user, jobid, host)
+                    self.running_nodes.discard(host)
+                    self.cleaning_host_count[jobid] -= 1
+                    self.notify_scheduler("cleanup done")
+                else:
+                    self.__mark_failed_cleaning(cleaning_process)
+                    self.logger.debug("Job %s/%s: stderr from epilogue on host %s: [%s]",
+                            user, jobid, host, "\n".join(result['stderr']))
+            if batch['lost']:
+                for host in cleaning_batch['hosts']:
+                    self.logger.warning("Job %s/%s: the epilogue for host %s was lost",
+                            user, jobid, host)
+                    self.__mark_failed_cleaning({'user':user, 'jobid':jobid, 'host':host})
+                cleaning_batch['hosts'] = set()
+            if not cleaning_batch['hosts']:
+                del self.cleaning_batches[batch['id']]
+            if self.cleaning_host_count[jobid] == 0:
+                self.__finish_cleaning(jobid, user)
+
+    def batch_progress(self, batch_ids):
+        '''Called by the forker as hosts in cleaning batches finish, so
+        that freed nodes return to service without waiting for the next
+        check_done_cleaning pass.
+
+        '''
+        self.logger.debug("progress on cleaning batches %s", batch_ids)
+        self.wake_task('check_done_cleaning')
+    batch_progress = locking(exposed(batch_progress))
+
+    def __finish_cleaning(self, jobid, user):
+        '''Finish up a job once all of its hosts have been cleaned.
+
+        '''
+        self.del_process_groups(jobid)
+        #clean up other cleanup-monitoring stuff
+        self.logger.info("Job %s/%s: job finished on %s",
+            user, jobid, Cobalt.Util.merge_nodelist(self.locations_by_jobid[jobid]))
+        del self.locations_by_jobid[jobid]
+        del self.jobid_to_user[jobid]
+
     def __mark_failed_cleaning(self, cleaning_process, msg=None):
         '''Mark that a node has failed cleanup and take the node out of service.
 
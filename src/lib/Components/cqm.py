@@ -86,15 +86,20 @@ import thread
 from threading import Thread, Lock
 import traceback
 import string
+import weakref
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 import Cobalt
 import Cobalt.Util
 from Cobalt.Util import Timer, pickle_data, unpickle_data, disk_writer_thread
 import Cobalt.Cqparse
-from Cobalt.Data import Data, DataList, DataDict, IncrID
+from Cobalt.Data import Data, DataList, DataDict, IncrID, ChangeLog, get_spec_fields
 from Cobalt.StateMachine import StateMachine
-from Cobalt.Components.base import Component, exposed, automatic, query, locking
+from Cobalt.Components.base import Component, exposed, automatic, query, locking, readonly
 from Cobalt.Proxy import ComponentProxy
 from Cobalt.Exceptions import (QueueError, ComponentLookupError, DataStateError, DataStateTransitionError, StateMachineError,
     StateMachineIllegalEventError, StateMachineNonexistentEventError, ThreadPickledAliveException, JobProcessingError,
@@ -515,6 +520,30 @@ def get_job_sm_seas(job):
             ('Job_Epilogue_Retry', 'Kill') : [job._sm_exit_common__kill],
             }
 
+def batched(utility_func):
+    '''Mark a utility function as scoring all of a queue's runnable jobs in one call.
+
+    A batched function sees each per-job variable as a column holding one
+    entry per job -- a numpy array for the numeric ones when numpy is
+    installed, a list otherwise -- and returns either a sequence of scores
+    in the same order or a single score shared by every job.  queue_priority
+    is the same for every job in a queue and is left a plain number.
+    '''
+    utility_func.batched = True
+    return utility_func
+
+# per-job utility function variables that are numbers, and so become numpy arrays for batched functions
+_numeric_utility_columns = ['queued_time', 'wall_time', 'wall_time_p', 'hold_time', 'total_etime', 'size', 'jobid',
+    'score']
+
+def _dependency_ids(dependencies):
+    '''Return the jobids in a job's all_dependencies, which set_jobs may
+    have set to a colon-separated string rather than a list.'''
+    if isinstance(dependencies, basestring):
+        return [dep for dep in dependencies.split(":") if dep]
+    return dependencies
+
+
 class Job (StateMachine):
     """
     The job tracks a job, driving it at a high-level.  Actual operations on the job, such as execution or termination, are
@@ -554,6 +583,9 @@ class Job (StateMachine):
     _initial_state = get_job_sm_initial_state()
     _events = get_job_sm_events() + StateMachine._events
 
+    # stamp jobs on change so the scheduler can fetch only what changed
+    versioned = True
+
     # return codes to improve typo detection.  by using the return codes in condition statements, a typo will result in a key
     # error rather than an incorrectly followed path.
     __rc_success = "success"
@@ -720,7 +752,7 @@ class Job (StateMachine):
     def __getstate__(self):
         data = {}
         for key, value in self.__dict__.iteritems():
-            if key not in ['log', 'comms', 'acctlog']:
+            if key not in ['log', 'comms', 'acctlog', '_version', '_index_owners']:
                 data[key] = value
         return data
 
@@ -2724,7 +2756,13 @@ class Job (StateMachine):
 
     def _sm_set_state(self, state):
         self._sm_log_info("transitioning to the '%s' state" % (state,))
+        old_state = StateMachine._state.__get__(self)
         StateMachine._state.__set__(self, state)
+        # let the job list holding this job keep its running counters current
+        for owner_ref in self.__dict__.get('_index_owners', []):
+            owner = owner_ref()
+            if owner is not None:
+                owner._index_move(self, '_sm_state', old_state, state)
 
     _sm_state = property(_sm_get_state, _sm_set_state)
     sm_state = property(_sm_get_state, _sm_set_state)
@@ -3161,13 +3199,203 @@ class Job (StateMachine):
         self.trigger_event('Task_End')
 
 
+class _RunningCounts(object):
+    '''Running job and node counts for the jobs in a JobList.
+
+    contrib -- what each job currently adds to the counts: (user, 1 if the job has resources, nodes if it is running)
+    users -- [jobs with resources, nodes running] for each user with jobs in the list
+    nodes -- nodes held by all of the running jobs
+    user_jobs -- the jobs of each user
+    dirty -- jobs added or changed since the last max_running_changes
+    limit -- the maxrunning limit applied by the last max_running_changes
+    over_limit -- the users that were at or over that limit
+    '''
+
+    def __init__(self):
+        self.contrib = {}
+        self.users = {}
+        self.nodes = 0
+        self.user_jobs = {}
+        self.dirty = set()
+        # equal to no limit, so that the first max_running_changes visits every job
+        self.limit = object()
+        self.over_limit = set()
+
+    def add(self, job):
+        if job in self.contrib:
+            self.discard(job)
+        user = job.user
+        if job.has_resources:
+            resources = 1
+        else:
+            resources = 0
+        if job._sm_state == 'Running':
+            nodes = int(job.nodes)
+        else:
+            nodes = 0
+        self.contrib[job] = (user, resources, nodes)
+        counts = self.users.setdefault(user, [0, 0])
+        counts[0] += resources
+        counts[1] += nodes
+        self.nodes += nodes
+        self.user_jobs.setdefault(user, set()).add(job)
+        self.dirty.add(job)
+
+    def discard(self, job):
+        user, resources, nodes = self.contrib.pop(job)
+        counts = self.users[user]
+        counts[0] -= resources
+        counts[1] -= nodes
+        self.nodes -= nodes
+        jobs = self.user_jobs[user]
+        jobs.discard(job)
+        if not jobs:
+            del self.user_jobs[user]
+            del self.users[user]
+        self.dirty.discard(job)
+
+
 class JobList(DataList):
+    '''The jobs in a queue.
+
+    Besides the jobs themselves, the list keeps per-user counts of the jobs
+    holding resources and the nodes of running jobs.  The counts are built
+    on first use and then updated as jobs are added, removed, or change
+    state, so restriction checks need not walk the queue.  Readonly methods
+    may run concurrently, so the first use is serialized by a lock; changes
+    to the list are made under the exclusive component lock.
+    '''
+
+    _running_build_lock = Lock()
+
     item_cls = Job
 
     def __init__(self, q):
         self.queue = q
         self.id_gen = cqm_id_gen
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # jobs do not carry their owner references across a pickle, so the
+        # counts are rebuilt on next use
+        state.pop('_running', None)
+        return state
+
+    def _running_counts(self):
+        running = self.__dict__.get('_running')
+        if running is not None:
+            return running
+        self._running_build_lock.acquire()
+        try:
+            running = self.__dict__.get('_running')
+            if running is None:
+                running = _RunningCounts()
+                for job in self:
+                    running.add(job)
+                    self._watch(job)
+                # published only once complete, so that other readers never see partial counts
+                self._running = running
+            return running
+        finally:
+            self._running_build_lock.release()
+
+    def _running_insert(self, job):
+        self._running.add(job)
+        self._watch(job)
+
+    def _watch(self, job):
+        '''Have the job report its state changes to this list.'''
+        owners = job.__dict__.setdefault('_index_owners', [])
+        for owner_ref in owners:
+            if owner_ref() is self:
+                break
+        else:
+            owners.append(weakref.ref(self))
+
+    def _running_discard(self, job):
+        self._running.discard(job)
+        owners = job.__dict__.get('_index_owners', [])
+        for owner_ref in owners[:]:
+            if owner_ref() is self or owner_ref() is None:
+                owners.remove(owner_ref)
+
+    def _index_move(self, job, field, old_value, new_value):
+        '''Called by a job in the list when its state changes.'''
+        if self.__dict__.get('_running') is not None and job in self._running.contrib:
+            self._running.discard(job)
+            self._running.add(job)
+
+    def append(self, job):
+        DataList.append(self, job)
+        if self.__dict__.get('_running') is not None:
+            self._running_insert(job)
+
+    def extend(self, jobs):
+        jobs = list(jobs)
+        DataList.extend(self, jobs)
+        if self.__dict__.get('_running') is not None:
+            for job in jobs:
+                self._running_insert(job)
+
+    def remove(self, job):
+        DataList.remove(self, job)
+        if self.__dict__.get('_running') is not None:
+            self._running_discard(job)
+
+    def __setitem__(self, index, job):
+        DataList.__setitem__(self, index, job)
+        self._running = None
+
+    def __delitem__(self, index):
+        DataList.__delitem__(self, index)
+        self._running = None
+
+    def __setslice__(self, i, j, jobs):
+        DataList.__setslice__(self, i, j, jobs)
+        self._running = None
+
+    def __delslice__(self, i, j):
+        DataList.__delslice__(self, i, j)
+        self._running = None
+
+    def user_resource_jobs(self, user):
+        '''Return the number of the user's jobs holding resources.'''
+        return self._running_counts().users.get(user, [0, 0])[0]
+
+    def running_nodes(self, user=None):
+        '''Return the nodes used by the running jobs, or by the running jobs of one user.'''
+        running = self._running_counts()
+        if user is None:
+            return running.nodes
+        return running.users.get(user, [0, 0])[1]
+
+    def resource_jobs(self):
+        '''Return the number of jobs holding resources.'''
+        return sum([counts[0] for counts in self._running_counts().users.itervalues()])
+
+    def max_running_changes(self, limit):
+        '''Return the jobs whose maxrunning hold may be out of date under limit, and the users at or over limit.
+
+        Only jobs added or changed since the last call, and the jobs of users who have crossed the limit since then, are
+        returned unless the limit itself has changed.  A limit of None means the queue has no maxrunning restriction.
+
+        '''
+        running = self._running_counts()
+        if limit is None:
+            over_limit = set()
+        else:
+            over_limit = set([user for user, counts in running.users.iteritems() if counts[0] >= limit])
+        if limit != running.limit:
+            jobs = list(self)
+        else:
+            jobs = set(running.dirty)
+            for user in over_limit.symmetric_difference(running.over_limit):
+                jobs.update(running.user_jobs.get(user, ()))
+        running.limit = limit
+        running.over_limit = over_limit
+        running.dirty.clear()
+        return jobs, over_limit
+
     def q_add (self, specs, callback = None, cargs = {}):
         for spec in specs:
             if "jobid" not in spec or spec['jobid'] == "*":
@@ -3265,11 +3493,11 @@ class Restriction (Data):
             retstr = "Group could not be verified for queue restriction."
         return retval, retstr
 
-    def maxuserjobs(self, job, queuestate=None):
-        '''limits how many jobs each user can run by checking queue state
-        with potential job added'''
-        userjobs = [j for j in queuestate if j.user == job.user and j.has_resources and j.queue == job['queue']]
-        if len(userjobs) >= int(self.value):
+    def maxuserjobs(self, job, _=None):
+        '''limits how many jobs each user can run, using the queue's running
+        counts'''
+        userjobs = self.queue.jobs.user_resource_jobs(job['user'])
+        if userjobs >= int(self.value):
             return (False, "Maxuserjobs limit reached")
         else:
             return (True, "")
@@ -3298,25 +3526,18 @@ class Restriction (Data):
             return (True, "")
 
 
-    def maxusernodes(self, job, queuestate=None):
+    def maxusernodes(self, job, _=None):
         '''limits how many nodes a single user can have running'''
-        usernodes = 0
-        for j in [qs for qs in queuestate if qs.user == job['user']
-                  and qs.state == 'running'
-                  and qs.queue == job.queue]:
-            usernodes = usernodes + int(j.nodes)
+        usernodes = self.queue.jobs.running_nodes(job['user'])
         if usernodes + int(job['nodes']) > int(self.value):
             return (False, "Job exceeds MaxUserNodes limit")
         else:
             return (True, "")
 
-    def maxtotalnodes(self, job, queuestate=None):
+    def maxtotalnodes(self, job, _=None):
         '''limits how many total nodes can be used by jobs running in
         this queue'''
-        totalnodes = 0
-        for j in [qs for qs in queuestate if qs.state == 'running'
-                  and qs.queue == job['queue']]:
-            totalnodes = totalnodes + int(j.nodes)
+        totalnodes = self.queue.jobs.running_nodes()
         if totalnodes + int(job['nodes']) > int(self.value):
             return (False, "Job exceeds MaxTotalNodes limit")
         else:
@@ -3367,6 +3588,8 @@ class Queue (Data):
 
     fields = Data.fields + ["cron", "name", "state", "adminemail", "policy", "maxuserjobs",] + Restriction.__checks__.keys()
     explicit = Restriction.__checks__.keys()
+    # computed from the jobs in the queue; returned when asked for by name, but never set
+    computed = ["running_jobs", "running_nodes"]
 
     def __init__(self, spec):
         Data.__init__(self, spec)
@@ -3409,33 +3632,19 @@ class Queue (Data):
 
     def update_max_running(self):
         '''In order to keep the max_running property of jobs up to date, this function needs
-        to be called when a job starts running, or a new job appears in a queue.'''
+        to be called when a job starts running, or a new job appears in a queue.  Only the jobs
+        whose hold may have changed since the last call are visited.'''
 
-        if not self.restrictions.has_key("maxrunning"):
+        if self.restrictions.has_key("maxrunning"):
+            limit = int(self.restrictions["maxrunning"].value)
+        else:
             # if it *was* there and was removed, we better clean up
-            for job in self.jobs:
-                if job.max_running:
-                    logger.info("Job %s/%s: max_running set to False", job.jobid, job.user)
-                    dbwriter.log_to_db(None, "maxrun_hold_release", "job_prog", JobProgMsg(job))
+            limit = None
+        jobs, over_limit = self.jobs.max_running_changes(limit)
 
-                    if job.no_holds_left():
-                        dbwriter.log_to_db(None, "all_holds_clear", "job_prog", JobProgMsg(job))
-                job.max_running = False
-
-            return
-        unum = dict()
-        for job in self.jobs.q_get([{'has_resources':True}]):
-            if job.user not in unum:
-                unum[job.user] = 1
-            else:
-                unum[job.user] = unum[job.user] + 1
-
-        for job in self.jobs:
+        for job in jobs:
             old = job.max_running
-            job.max_running = False
-            if unum.get(job.user, 0) >= int(self.restrictions["maxrunning"].value):
-                if not job.has_resources:
-                    job.max_running = True
+            job.max_running = job.user in over_limit and not job.has_resources
             if old != job.max_running:
                 logger.info("Job %s/%s: max_running set to %s", job.jobid, job.user, job.max_running)
                 if job.max_running:
@@ -3445,6 +3654,14 @@ class Queue (Data):
                     if job.no_holds_left():
                         dbwriter.log_to_db(None, "all_holds_clear", "job_prog", JobProgMsg(job))
 
+    def _get_running_jobs(self):
+        return self.jobs.resource_jobs()
+    running_jobs = property(_get_running_jobs)
+
+    def _get_running_nodes(self):
+        return self.jobs.running_nodes()
+    running_nodes = property(_get_running_nodes)
+
 class QueueDict(DataDict):
     item_cls = Queue
     key = "name"
@@ -3514,9 +3731,14 @@ class QueueManager(Component):
 
     __statefields__ = ['Queues']
 
+    # scores are bumped on every queued job each scheduling pass
+    journal_delta_fields = {'jobs':['score']}
+
     def __init__(self, *args, **kwargs):
         Component.__init__(self, *args, **kwargs)
         self.Queues = QueueDict()
+        self.job_changes = ChangeLog()
+        self._dependents = None
         self.prevdate = time.strftime("%m-%d-%y", time.localtime())
         self.cqp = Cobalt.Cqparse.CobaltLogParser()
         use_db_jobid_generator = get_cqm_config("use_db_jobid_generator", "False").lower() in Cobalt.Util.config_true_values
@@ -3554,14 +3776,17 @@ class QueueManager(Component):
                 'Queues':self.Queues,
                 'next_job_id':self.id_gen.idnum+1,
                 'next_run_id':self.run_id_gen.idnum+1,
-                'msg_queue':dbwriter.msg_queue,
-                'overflow': dbwriter.overflow})
+                'msg_queue':dbwriter.pending_messages(),
+                'overflow': dbwriter.overflow,
+                'overflow_offset': dbwriter.overflow_offset})
         return state
 
     def __setstate__(self, state):
         Component.__setstate__(self, state)
 
         self.Queues = state['Queues']
+        self.job_changes = ChangeLog()
+        self._dependents = None
         use_db_jobid_generator = get_cqm_config("use_db_jobid_generator", "False").lower() in Cobalt.Util.config_true_values
         self.id_gen = IncrID(use_database = use_db_jobid_generator)
         self.id_gen.set(state['next_job_id'], override = True)
@@ -3602,7 +3827,64 @@ class QueueManager(Component):
             dbwriter.msg_queue = state["msg_queue"]
         if state.has_key('overflow') and (dbwriter.max_queued != None):
             dbwriter.overflow = state['overflow']
+            dbwriter.overflow_offset = state.get('overflow_offset', 0)
+
+
+    def journal_collections(self):
+        return {'jobs':dict([(job.jobid, job) for queue in self.Queues.itervalues()
+                             for job in queue.jobs])}
+
+    def replay_journal(self):
+        # journal_replace finds jobs through this index of their places in the queues.  A removed job leaves a
+        # placeholder so that the indexes of the jobs after it stay valid; the queues are compacted once replay is done.
+        self._journal_index = {}
+        self._journal_vacated = set()
+        for queue in self.Queues.itervalues():
+            for index, job in enumerate(queue.jobs):
+                self._journal_index[job.jobid] = (queue, index)
+        try:
+            return Component.replay_journal(self)
+        finally:
+            for queue_name in self._journal_vacated:
+                queue = self.Queues[queue_name]
+                queue.jobs[:] = [job for job in queue.jobs if job is not None]
+            self._journal_index = None
+            self._journal_vacated = None
+
+    def journal_replace(self, collection, key, item):
+        self._dependents = None
+        location = self._journal_index.pop(key, None)
+        if location is not None:
+            queue, index = location
+            if item is not None and queue.name == item.queue:
+                queue.jobs[index] = item
+                self._journal_index[key] = location
+                return
+            queue.jobs[index] = None
+            self._journal_vacated.add(queue.name)
+        if item is None:
+            return
+        if item.queue not in self.Queues:
+            logger.error("Job %s: journaled in missing queue %s; dropping", key, item.queue)
+            return
+        queue = self.Queues[item.queue]
+        queue.jobs.append(item)
+        self._journal_index[key] = (queue, len(queue.jobs) - 1)
 
+    def journal_extra(self):
+        return {'next_job_id':self.id_gen.idnum+1,
+                'next_run_id':self.run_id_gen.idnum+1,
+                'msg_queue':dbwriter.pending_messages(),
+                'overflow':dbwriter.overflow,
+                'overflow_offset':dbwriter.overflow_offset}
+
+    def journal_restore_extra(self, extra):
+        self.id_gen.set(extra['next_job_id'], override = True)
+        self.run_id_gen.set(extra['next_run_id'])
+        dbwriter.msg_queue = extra['msg_queue']
+        if dbwriter.max_queued != None:
+            dbwriter.overflow = extra['overflow']
+            dbwriter.overflow_offset = extra.get('overflow_offset', 0)
 
     def __save_me(self):
         Component.save(self)
@@ -3672,9 +3954,10 @@ class QueueManager(Component):
         #
         # NOTE: this assumes that the system component will return a non-zero exit status if the task was killed by a signal.
         # 'None' is considered to be non-zero and thus would be a valid exit status if the task was terminated.
+        dependents = self._pop_dependents(job)
         if job.exit_status == 0:
-            for waiting_job in self.Queues.get_jobs([{'state':"dep_hold"}]):
-                if str(job.jobid) in waiting_job.all_dependencies:
+            for waiting_job in dependents:
+                if waiting_job.state == "dep_hold" and str(job.jobid) in waiting_job.all_dependencies:
                     waiting_job.satisfied_dependencies = waiting_job.satisfied_dependencies[:] + [str(job.jobid)]
                     waiting_job.update_dep_state()
                     if not waiting_job.dep_hold:
@@ -3697,6 +3980,15 @@ class QueueManager(Component):
                             waiting_job.score = max(waiting_job.score, new_score)
                         else:
                             waiting_job.score = max(waiting_job.score, 0.0)
+        else:
+            # the dependency can no longer be satisfied; flag its dependents
+            # now rather than on the next check_dep_fail pass
+            for waiting_job in dependents:
+                if str(job.jobid) in waiting_job.all_dependencies and \
+                        str(job.jobid) not in waiting_job.satisfied_dependencies and \
+                        not waiting_job.dep_fail:
+                    waiting_job.dep_fail = True
+                    dbwriter.log_to_db(None, "dep_fail", "job_prog", JobProgMsg(waiting_job))
 
         # remove the job from the queue
         #
@@ -3704,6 +3996,8 @@ class QueueManager(Component):
         # could "job.queue.jobs.remove(job)" be used instead or would that make an inappropriate assumption about the
         # implementation of the JobList/DataList?
         self.Queues[job.queue].jobs.q_del([{'jobid':job.jobid}])
+        self.job_changes.record_deleted([job.jobid])
+        self._index_dependencies(job, job.all_dependencies, [])
 
         # update state of jobs held because the user exceeded the maximum number of running jobs allowed by the queue
         self.Queues[job.queue].update_max_running()
@@ -3711,6 +4005,35 @@ class QueueManager(Component):
         #The job has well-and-truly ended.  As such, send a message that the
         #job has terminated. Should remove all ambiguity. --PMR
         dbwriter.log_to_db(None, "terminated", "job_prog", JobProgMsg(job))
+        self.notify_scheduler("job ended")
+
+    def _dependency_index(self):
+        '''Return the map from a jobid (as a string) to the jobs that depend
+        on it, building it from the queues if need be.'''
+        if self._dependents is None:
+            self._dependents = {}
+            for queue in self.Queues.itervalues():
+                for job in queue.jobs:
+                    self._index_dependencies(job, [], job.all_dependencies)
+        return self._dependents
+
+    def _index_dependencies(self, job, old_dependencies, new_dependencies):
+        '''Move job from the index entries of old_dependencies to those of
+        new_dependencies.'''
+        if self._dependents is None:
+            return
+        for dep in _dependency_ids(old_dependencies):
+            dependents = self._dependents.get(dep)
+            if dependents is not None:
+                dependents.discard(job)
+                if not dependents:
+                    del self._dependents[dep]
+        for dep in _dependency_ids(new_dependencies):
+            self._dependents.setdefault(dep, set()).add(job)
+
+    def _pop_dependents(self, job):
+        '''Return the jobs depending on job, dropping them from the index.'''
+        return list(self._dependency_index().pop(str(job.jobid), ()))
 
     def __add_job_terminal_action(self, job, args):
         '''add the terminal action handler to the each job added to the queue'''
@@ -3800,12 +4123,24 @@ class QueueManager(Component):
             raise QueueError, failure_msg
 
         response = self.Queues.add_jobs(specs, self.__add_job_terminal_action)
+        for job in response:
+            self._index_dependencies(job, [], job.all_dependencies)
+        if response:
+            self.notify_scheduler("job added")
         return response
     add_jobs = exposed(query(add_jobs))
 
     def get_jobs(self, specs):
         return self.Queues.get_jobs(specs)
-    get_jobs = exposed(query(get_jobs))
+    get_jobs = readonly(exposed(query(get_jobs)))
+
+    def get_job_changes(self, specs, epoch, version):
+        '''Get the jobs matching specs that were added or changed, and the
+        jobids of jobs that were removed, since version in epoch.  Pass an
+        epoch of None to get every job.'''
+        return self.job_changes.get_changes_since(self.Queues.get_jobs(specs), 'jobid', epoch, version,
+                get_spec_fields(specs))
+    get_job_changes = readonly(exposed(get_job_changes))
 
     def set_jobs(self, specs, updates, user_name=None):
         joblist = self.Queues.get_jobs(specs)
@@ -3824,9 +4159,11 @@ class QueueManager(Component):
                     raise QueueError, "job %d is running; it cannot be moved" % job.jobid   
 
 
+        jobids = None
         for job in joblist:
 
             old_q_name = job.queue
+            old_dependencies = job.all_dependencies
             test = job.to_rx()
             test.update(updates)
             #if we are requesting a change in hold:
@@ -3869,7 +4206,10 @@ class QueueManager(Component):
                         message = "[]"
                     logger.info("Job %s/%s: dependencies set to %s", job.jobid, job.user, message)
                     job.update_dep_state()
-                self.check_dep_fail()
+                if jobids is None:
+                    jobids = set([queued_job.jobid for queue in self.Queues.itervalues()
+                                  for queued_job in queue.jobs])
+                self._update_dep_fail(job, jobids)
 
                 # only do this if the new queue can accept this job
                 if new_q_name:
@@ -3879,7 +4219,12 @@ class QueueManager(Component):
                     new_q.update_max_running()
                 if not only_hold:
                     dbwriter.log_to_db(user_name, "modifying", "job_data", JobDataMsg(job))
+            if job.all_dependencies != old_dependencies:
+                self._index_dependencies(job, old_dependencies, job.all_dependencies)
 
+        if joblist and (updates.get('user_hold', None) == False or
+                updates.get('admin_hold', None) == False):
+            self.notify_scheduler("hold released")
         return joblist
     set_jobs = exposed(query(set_jobs))
 
@@ -3958,18 +4303,22 @@ class QueueManager(Component):
     def add_queues(self, specs, user_name=None):
         if user_name:
             logger.info("%s adding queue %s", user_name, specs)
+        self.journal_snapshot()
         return self.Queues.add_queues(specs)
     add_queues = exposed(query(add_queues))
 
     def get_queues(self, specs):
         return self.Queues.get_queues(specs)
-    get_queues = exposed(query(get_queues))
+    get_queues = readonly(exposed(query(get_queues)))
 
     def can_queue(self, job_spec):
         return self.Queues.can_queue(job_spec)
     can_queue = exposed(can_queue)
 
     def set_queues(self, specs, updates, user_name=None):
+        computed = [key for key in updates if key in Queue.computed]
+        if computed:
+            raise QueueError("%s cannot be set" % ", ".join(computed))
         def _setQueues(queue, newattr):
             if 'priority' in newattr:
                 if newattr['priority'] is None:
@@ -3987,14 +4336,19 @@ class QueueManager(Component):
                     elif newattr[key] is not None:
                         queue.restrictions[key] = Restriction({'name':key, 'value':newattr[key]}, queue)
         logger.info("%s calling set_queues on %s with updates %s", user_name, specs, updates)
+        self.journal_snapshot()
         return self.Queues.get_queues(specs, _setQueues, updates)
     set_queues = exposed(query(set_queues))
 
     def del_queues(self, specs, force=False, user_name=None):
         '''Delete queue(s), but check if there are still jobs in the queue'''
+        self.journal_snapshot()
         if force:
             logger.info("%s requested force delete of queue %s", user_name, specs)
-            return self.Queues.del_queues(specs)
+            response = self.Queues.del_queues(specs)
+            self.job_changes.record_deleted([job.jobid for queue in response for job in queue.jobs])
+            self._dependents = None
+            return response
 
         logger.info("%s requested delete of queue %s", user_name, specs)
         queues = self.Queues.get_queues(specs)
@@ -4050,7 +4404,7 @@ class QueueManager(Component):
             self.logger.error("Problem compiling utility function definitions.", exc_info=True)
             return
 
-        globals = {'math':math, 'time':time}
+        globals = {'math':math, 'time':time, 'batched':batched}
         locals = {}
         try:
             exec code in globals, locals
@@ -4107,49 +4461,44 @@ class QueueManager(Component):
             val = 1.0
             return val
 
-        self.builtin_utility_functions["default"] = default
-        self.builtin_utility_functions["high_prio"] = high_prio
+        self.builtin_utility_functions["default"] = batched(default)
+        self.builtin_utility_functions["high_prio"] = batched(high_prio)
 
 
     def compute_utility_scores (self):
         '''Evaluate score functions for a job based on the job's queue.
 
         This will increment the job's score based on the score function
-        of each job's queue.
+        of each job's queue.  Functions marked as batched are called once
+        for all of a queue's runnable jobs; any other function is called
+        once per job.
 
         '''
         current_time = time.time()
 
         queued_jobs = self.Queues.get_jobs([{'is_runnable':True}])
+        queue_jobs = {}
         for job in queued_jobs:
-            utility_name = self.Queues[job.queue].policy
-            args = {'queued_time':current_time - float(job.submittime),
-                    'wall_time': 60*float(job.walltime),
-                    'wall_time_p': 60*float(job.walltime_p),
-                    'hold_time' : job.hold_time,
-                    'total_etime' : job.total_etime,
-                    'size': float(job.nodes),
-                    'user_name': job.user,
-                    'project': job.project,
-                    'queue_priority': int(self.Queues[job.queue].priority),
-                    #'machine_size': max_nodes,
-                    'jobid': int(job.jobid),
-                    'score': job.score,
-                    'state': job.state,
-                    }
+            queue_jobs.setdefault(job.queue, []).append(job)
+
+        for queue_name, jobs in queue_jobs.iteritems():
+            queue = self.Queues[queue_name]
+            utility_name = queue.policy
             try:
                 if utility_name in self.builtin_utility_functions:
                     utility_func = self.builtin_utility_functions[utility_name]
                 else:
                     utility_func = self.user_utility_functions[utility_name]
-                utility_func.func_globals.update(args)
-                score = utility_func()
+                if getattr(utility_func, 'batched', False):
+                    scores = self._batched_utility_scores(utility_func, queue, jobs, current_time)
+                else:
+                    scores = [self._job_utility_score(utility_func, queue, job, current_time) for job in jobs]
             except KeyError:
                 # do something sensible when the requested utility function doesn't exist
                 # probably go back to the "default" one
 
                 # and if we get here, try to fix it and throw away this scheduling iteration
-                self.logger.error("cannot find utility function '%s' named by queue '%s'", utility_name, job.queue)
+                self.logger.error("cannot find utility function '%s' named by queue '%s'", utility_name, queue_name)
                 self.user_utility_functions[utility_name] = self.builtin_utility_functions["default"]
                 self.logger.error("falling back to 'default' policy to replace '%s'", utility_name)
                 return
@@ -4158,16 +4507,17 @@ class QueueManager(Component):
                 # probably go back to the "default" one
 
                 # and if we get here, try to fix it and throw away this scheduling iteration
-                self.logger.error("error while executing utility function '%s' named by queue '%s'", utility_name, job.queue,
+                self.logger.error("error while executing utility function '%s' named by queue '%s'", utility_name, queue_name,
                     exc_info=True)
                 self.user_utility_functions[utility_name] = self.builtin_utility_functions["default"]
                 self.logger.error("falling back to 'default' policy to replace '%s'", utility_name)
                 return
 
             try:
-                job.score += score
+                for job, score in zip(jobs, scores):
+                    job.score += score
             except Exception:
-                self.logger.error("utility function '%s' named by queue '%s' returned a non-number", utility_name, job.queue,
+                self.logger.error("utility function '%s' named by queue '%s' returned a non-number", utility_name, queue_name,
                     exc_info=True)
                 self.user_utility_functions[utility_name] = self.builtin_utility_functions["default"]
                 self.logger.error("falling back to 'default' policy to replace '%s'", utility_name)
@@ -4175,7 +4525,7 @@ class QueueManager(Component):
 
         if self.score_timestamp:
             dt = current_time - self.score_timestamp
-            queued_jobs.sort( lambda left, right: -cmp(left.score, right.score) )
+            queued_jobs.sort(key=lambda job: job.score, reverse=True)
             core_hours = 0.0
             for job in queued_jobs:
                 if job.priority_core_hours is None:
@@ -4188,31 +4538,89 @@ class QueueManager(Component):
 
     compute_utility_scores = automatic(compute_utility_scores, float(get_cqm_config('compute_utility_interval', 10)))
 
+    def _job_utility_score(self, utility_func, queue, job, current_time):
+        '''Evaluate a utility function for a single job.'''
+        args = {'queued_time':current_time - float(job.submittime),
+                'wall_time': 60*float(job.walltime),
+                'wall_time_p': 60*float(job.walltime_p),
+                'hold_time' : job.hold_time,
+                'total_etime' : job.total_etime,
+                'size': float(job.nodes),
+                'user_name': job.user,
+                'project': job.project,
+                'queue_priority': int(queue.priority),
+                #'machine_size': max_nodes,
+                'jobid': int(job.jobid),
+                'score': job.score,
+                'state': job.state,
+                }
+        utility_func.func_globals.update(args)
+        return utility_func()
+
+    def _batched_utility_scores(self, utility_func, queue, jobs, current_time):
+        '''Evaluate a batched utility function once for all of a queue's jobs.
+
+        Returns a list holding the score for each job.
+
+        '''
+        columns = {'queued_time': [current_time - float(job.submittime) for job in jobs],
+                   'wall_time': [60*float(job.walltime) for job in jobs],
+                   'wall_time_p': [60*float(job.walltime_p) for job in jobs],
+                   'hold_time': [job.hold_time for job in jobs],
+                   'total_etime': [job.total_etime for job in jobs],
+                   'size': [float(job.nodes) for job in jobs],
+                   'user_name': [job.user for job in jobs],
+                   'project': [job.project for job in jobs],
+                   'jobid': [int(job.jobid) for job in jobs],
+                   'score': [job.score for job in jobs],
+                   'state': [job.state for job in jobs],
+                   }
+        if numpy is not None:
+            for name in _numeric_utility_columns:
+                columns[name] = numpy.array(columns[name])
+        columns['queue_priority'] = int(queue.priority)
+        utility_func.func_globals.update(columns)
+        scores = utility_func()
+        if hasattr(scores, 'tolist'):
+            # numpy arrays and numpy scalars
+            scores = scores.tolist()
+        if isinstance(scores, (list, tuple)):
+            if len(scores) != len(jobs):
+                raise ValueError("utility function returned %d scores for %d jobs" % (len(scores), len(jobs)))
+            return scores
+        return [scores] * len(jobs)
+
     def check_dep_fail(self):
         queued_jobs = self.Queues.get_jobs([{'jobid': '*'}])
-        already_failed = False
+        jobids = set([job.jobid for job in queued_jobs])
         for job in queued_jobs:
-            already_failed = job.dep_fail
-            job.dep_fail = False
-            pending = set(job.all_dependencies).difference(set(job.satisfied_dependencies))
-            for jobid_str in pending:
-                try:
-                    jobid = int(jobid_str)
-                except:
-                    job.dep_fail = True
-                    break
-
-                if not self.Queues.get_jobs([{'jobid': jobid}]):
-                    job.dep_fail = True
-                    break
-            if (job.dep_fail and (not already_failed)):
-                dbwriter.log_to_db(None, "dep_fail", "job_prog", JobProgMsg(job))
-            if ((not job.dep_fail) and already_failed and 
-                (job.no_holds_left())):
-                dbwriter.log_to_db(None, "all_holds_clear", "job_prog", 
-                                   JobProgMsg(job))
+            self._update_dep_fail(job, jobids)
     check_dep_fail = automatic(check_dep_fail, period=60)
 
+    def _update_dep_fail(self, job, jobids):
+        '''Set dep_fail on a job if one of its pending dependencies is not
+        among jobids, the ids of the jobs still in the queues.'''
+        already_failed = job.dep_fail
+        dep_fail = False
+        pending = set(job.all_dependencies).difference(set(job.satisfied_dependencies))
+        for jobid_str in pending:
+            try:
+                jobid = int(jobid_str)
+            except:
+                dep_fail = True
+                break
+
+            if jobid not in jobids:
+                dep_fail = True
+                break
+        job.dep_fail = dep_fail
+        if (job.dep_fail and (not already_failed)):
+            dbwriter.log_to_db(None, "dep_fail", "job_prog", JobProgMsg(job))
+        if ((not job.dep_fail) and already_failed and 
+            (job.no_holds_left())):
+            dbwriter.log_to_db(None, "all_holds_clear", "job_prog", 
+                               JobProgMsg(job))
+
     def get_next_id(self):
         '''get the next id, the generator will throw.  Useful for recovery.'''
         return self.id_gen.idnum + 1
@@ -4,6 +4,8 @@
 
 import ConfigParser
 import copy
+import heapq
+import itertools
 import logging
 import math
 import os
@@ -117,6 +119,10 @@ class SimEvent (Data):
 class EventSimulator(Component):
     """Event Simulator. Manages time stamps, events, and the advancing of the clock
 
+    Pending events are kept in a heap ordered by time, events with the same
+    time coming out in the order they were added.  Advancing the clock pops
+    the next event, and past events are not kept.
+
     Definition of an event, which is a dictionary of following keys:
         machine -- 0, 1, 2 ... represent the system (e.g. Intrepid or Eureka) where the event occurs
         type -- I (init), Q (submit job), S (start job), E (end job),
@@ -132,8 +138,14 @@ class EventSimulator(Component):
     def __init__(self, *args, **kwargs):
 
         Component.__init__(self, *args, **kwargs)
-        self.event_list = [{'unixtime':0}]
+        # pending events, as (unixtime, sequence number, event) tuples
+        self.events = []
+        self.event_seq = itertools.count()
+        self.current_event = {'unixtime':0}
         self.time_stamp = 0
+        # the earliest and latest events ever added
+        self.first_event = None
+        self.last_event = None
 
         self.finished = False
 
@@ -153,35 +165,51 @@ class EventSimulator(Component):
     get_go_next = exposed(get_go_next)
 
     def events_length(self):
-        return len(self.event_list)
-
-    def add_event(self, ev_spec):
-        '''insert time stamps in the same order'''
+        '''return the number of pending events'''
+        return len(self.events)
 
+    def _make_event(self, ev_spec):
+        '''return the heap entry for an event, or None if it has no time'''
         time_sec = ev_spec.get('unixtime')
         if time_sec == None:
             print "insert time stamp error: no unix time provided"
-            return -1
+            return None
 
         if not ev_spec.has_key('jobid'):
             ev_spec['jobid'] = 0
         if not ev_spec.has_key('location'):
             ev_spec['location'] = []
 
-        pos  = self.events_length()
-
-        while time_sec < self.event_list[pos-1].get('unixtime'):
-            pos = pos - 1
+        if self.first_event is None or time_sec < self.first_event['unixtime']:
+            self.first_event = ev_spec
+        if self.last_event is None or time_sec >= self.last_event['unixtime']:
+            self.last_event = ev_spec
+        return (time_sec, self.event_seq.next(), ev_spec)
 
-        self.event_list.insert(pos, ev_spec)
-        #print "insert time stamp ", ev_spec, " at pos ", pos
-        return pos
+    def add_event(self, ev_spec):
+        '''insert time stamps in the same order; returns the event's sequence number'''
+        entry = self._make_event(ev_spec)
+        if entry is None:
+            return -1
+        heapq.heappush(self.events, entry)
+        return entry[1]
     add_event = exposed(add_event)
 
+    def add_events(self, ev_specs):
+        '''insert many time stamps at once'''
+        entries = [entry for entry in [self._make_event(ev_spec) for ev_spec in ev_specs] if entry is not None]
+        if len(entries) < len(self.events):
+            for entry in entries:
+                heapq.heappush(self.events, entry)
+        else:
+            self.events.extend(entries)
+            heapq.heapify(self.events)
+    add_events = exposed(add_events)
+
     def get_time_span(self):
         '''return the whole time span'''
-        starttime = self.event_list[1].get('unixtime')
-        endtime = self.event_list[-1].get('unixtime')
+        starttime = self.first_event.get('unixtime')
+        endtime = self.last_event.get('unixtime')
         timespan = endtime - starttime
         return timespan
     get_time_span = exposed(get_time_span)
@@ -192,40 +220,40 @@ class EventSimulator(Component):
 
     def get_current_time(self):
         '''return current unix time'''
-        return self.event_list[self.time_stamp].get('unixtime')
+        return self.current_event.get('unixtime')
     get_current_time = exposed(get_current_time)
 
     def get_current_date_time(self):
         '''return current date time'''
-        return self.event_list[self.time_stamp].get('datetime')
+        return self.current_event.get('datetime')
     get_current_date_time = exposed(get_current_date_time)
 
     def get_current_event_type(self):
         '''return current event type'''
-        return self.event_list[self.time_stamp].get('type')
+        return self.current_event.get('type')
     get_current_event_type = exposed(get_current_event_type)
 
     def get_current_event_job(self):
         '''return current event job'''
-        return self.event_list[self.time_stamp].get('jobid')
+        return self.current_event.get('jobid')
     get_current_event_job = exposed(get_current_event_job)
 
     def get_current_event_location(self):
-        return self.event_list[self.time_stamp].get('location')
+        return self.current_event.get('location')
     get_current_event_location = exposed(get_current_event_location)
 
     def get_current_event_machine(self):
         '''return machine which the current event belongs to'''
-        return self.event_list[self.time_stamp].get('machine')
+        return self.current_event.get('machine')
 
     def get_current_event_all(self):
         '''return current event'''
-        return self.event_list[self.time_stamp]
+        return self.current_event
 
     def get_next_event_time_sec(self):
         '''return the next event time'''
-        if self.time_stamp < len(self.event_list) - 1:
-            return self.event_list[self.time_stamp + 1].get('unixtime')
+        if self.events:
+            return self.events[0][0]
         else:
             return -1
     get_next_event_time_sec = exposed(get_next_event_time_sec)
@@ -237,7 +265,8 @@ class EventSimulator(Component):
 
     def clock_increment(self):
         '''the current time stamp increments by 1'''
-        if self.time_stamp < len(self.event_list) - 1:
+        if self.events:
+            self.current_event = heapq.heappop(self.events)[2]
             self.time_stamp += 1
             if SHOW_SCREEN_LOG:
                 print str(self.get_current_date_time()) + \
@@ -251,6 +280,7 @@ class EventSimulator(Component):
     def add_init_events(self, jobspecs, machine_id):   ###EVSIM change here
         """add initial submission events based on input jobs and machine id"""
 
+        evspecs = []
         for jobspec in jobspecs:
             evspec = {}
             evspec['machine'] = machine_id
@@ -259,18 +289,20 @@ class EventSimulator(Component):
             evspec['datetime'] = sec_to_date(float(jobspec.get('submittime')))
             evspec['jobid'] = jobspec.get('jobid')
             evspec['location'] = []
-            self.add_event(evspec)
+            evspecs.append(evspec)
+        self.add_events(evspecs)
 
     add_init_events = exposed(add_init_events)
 
     def init_unhold_events(self, machine_id):
         """add unholding event"""
-        if not self.event_list:
+        if self.first_event is None:
             return
 
-        first_time_sec = self.event_list[1]['unixtime']
-        last_time_sec = self.event_list[-1]['unixtime']
+        first_time_sec = self.first_event['unixtime']
+        last_time_sec = self.last_event['unixtime']
 
+        evspecs = []
         unhold_point = first_time_sec + UNHOLD_INTERVAL + machine_id
         while unhold_point < last_time_sec:
             evspec = {}
@@ -278,28 +310,31 @@ class EventSimulator(Component):
             evspec['type'] = "C"
             evspec['unixtime'] = unhold_point
             evspec['datetime'] = sec_to_date(unhold_point)
-            self.add_event(evspec)
+            evspecs.append(evspec)
 
             unhold_point += UNHOLD_INTERVAL + machine_id
+        self.add_events(evspecs)
     init_unhold_events = exposed(init_unhold_events)
 
     def init_mmon_events(self):
         """add metrics monitor points into time stamps"""
-        if not self.event_list:
+        if self.first_event is None:
             return
 
-        first_time_sec = self.get_first_mmon_point(self.event_list[1]['datetime'])
-        last_time_sec = self.event_list[-1]['unixtime']
+        first_time_sec = self.get_first_mmon_point(self.first_event['datetime'])
+        last_time_sec = self.last_event['unixtime']
         machine_id = MMON
 
+        evspecs = []
         mmon_point = first_time_sec + MMON_INTERVAL
         while mmon_point < last_time_sec:
             evspec = {}
             evspec['machine'] = machine_id
             evspec['unixtime'] = mmon_point
             evspec['datetime'] = sec_to_date(mmon_point)
-            self.add_event(evspec)
+            evspecs.append(evspec)
             mmon_point += MMON_INTERVAL
+        self.add_events(evspecs)
     init_mmon_events = exposed(init_mmon_events)
 
     def get_first_mmon_point(self, date_time):
@@ -311,13 +346,9 @@ class EventSimulator(Component):
         return new_epoch
 
     def print_events(self):
-        print "total events:", len(self.event_list)
-        i = 0
-        for event in self.event_list:
+        print "pending events:", len(self.events)
+        for _, _, event in heapq.nsmallest(25, self.events):
             print event
-            i += 1
-            if i == 25:
-                break
 
     def event_driver(self):
         """core part that drives the clock"""
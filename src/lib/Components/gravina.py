@@ -31,7 +31,7 @@ from Cobalt.Components.base import Component, exposed, automatic, query
 #This is definitely going away. import Cobalt.bridge
 #from Cobalt.bridge import BridgeException
 from Cobalt.Exceptions import ProcessGroupCreationError, ComponentLookupError
-from Cobalt.Components.bgq_base_system import NodeCard, BlockDict, BGProcessGroupDict, BGBaseSystem, JobValidationError
+from Cobalt.Components.bgq_base_system import NodeCard, BlockDict, BlockResourceIndex, BGProcessGroupDict, BGBaseSystem, JobValidationError
 from Cobalt.Proxy import ComponentProxy
 from Cobalt.Statistics import Statistics
 from Cobalt.DataTypes.ProcessGroup import ProcessGroup
@@ -155,6 +155,10 @@ class BGSystem (BGBaseSystem):
         self.pending_script_waits = set()
         self.bridge_in_error = False
         self.cached_blocks = None
+        self._block_snapshots = {}
+        self._relatives_gen = 0
+        self._snapshot_relatives_gen = None
+        self._resource_index = BlockResourceIndex()
         self.offline_blocks = []
         self.compute_hardware_vec = None
         
@@ -750,6 +754,7 @@ class BGSystem (BGBaseSystem):
 
                 
                 # remove the missing partitions and their wiring relations
+                relatives_changed = []
                 for bname in missing_blocks:
                     if self._blocks[bname].size < 128 and self._blocks[bname].subblock_parent not in missing_blocks:
                         continue
@@ -760,6 +765,7 @@ class BGSystem (BGBaseSystem):
                         self._blocks[dep_name]._wiring_conflicts.discard(b.name)
                     if b.name in self._managed_blocks:
                         self._managed_blocks.discard(b.name)
+                        relatives_changed.append(b.name)
                     del self._blocks[b.name]
 
                 bp_cache = {}
@@ -778,10 +784,12 @@ class BGSystem (BGBaseSystem):
                     self._blocks.q_add([self._new_block_dict(new_block_info)])
                     b = self._blocks[block.getName()]
                     self._detect_wiring_deps(b, wiring_cache)
+                    if b.name in self._managed_blocks:
+                        relatives_changed.append(b.name)
 
                 # if partitions were added or removed, then update the relationships between partitions
                 if len(missing_blocks) > 0 or len(new_blocks) > 0:
-                    self.update_relatives()
+                    self.update_relatives(relatives_changed)
                 
                 for b in self._blocks.values():
                     
@@ -7,6 +7,11 @@ import random
 import warnings
 import sys
 import socket
+import weakref
+import itertools
+import collections
+import os
+import xmlrpclib
 
 import Cobalt.Util
 from Cobalt.Exceptions import DataCreationError, IncrIDError, DataStateError, DataStateTransitionError
@@ -14,6 +19,13 @@ from Cobalt.Exceptions import DataCreationError, IncrIDError, DataStateError, Da
 DB_SECTION = "cdbwriter"
 DB_COMMON_SCHEMA = "COMMON"
 
+# marker for an indexed field that has not been set on an item
+_UNSET = object()
+
+# process-wide modification counter for versioned Data items.  Versions are
+# only comparable within one epoch; a new epoch starts with every process.
+_version_gen = itertools.count(1)
+
 def get_spec_fields (specs):
     """Given a list of specs, return the set of all fields used."""
     fields = set()
@@ -170,6 +182,10 @@ class Data (object):
     inherent -- a list of fields that cannot be included in the spec
     required -- a list of fields required in the spec
     explicit -- fields that are only returned when explicitly listed in the spec
+    indexed -- fields that a DataDict should keep a secondary index on; these
+               must be plain attributes (not properties) with hashable values
+    versioned -- stamp the item with a new version whenever an attribute
+                 changes, for use with ChangeLog
 
     Attributes:
     tag -- Misc. label.
@@ -184,6 +200,8 @@ class Data (object):
     inherent = []
     required = []
     explicit = []
+    indexed = []
+    versioned = False
 
     def __init__ (self, spec):
         
@@ -203,6 +221,31 @@ class Data (object):
             raise DataCreationError, "Specified inherent field %s" \
                   % (":".join(inherent))
 
+    def __setattr__ (self, name, value):
+        """Set an attribute, keeping the indexes of any owning DataDict current."""
+        if self.versioned and self.__dict__.get(name, _UNSET) != value:
+            self.__dict__['_version'] = _version_gen.next()
+        if name not in self.indexed or '_index_owners' not in self.__dict__:
+            object.__setattr__(self, name, value)
+            return
+        old_value = getattr(self, name, _UNSET)
+        object.__setattr__(self, name, value)
+        owners = self.__dict__['_index_owners']
+        for owner_ref in owners[:]:
+            owner = owner_ref()
+            if owner is None:
+                owners.remove(owner_ref)
+            else:
+                owner._index_move(self, name, old_value, value)
+
+    def __getstate__ (self):
+        state = self.__dict__.copy()
+        # index membership is rebuilt by the owning containers, and versions
+        # mean nothing outside of the process that issued them
+        state.pop('_index_owners', None)
+        state.pop('_version', None)
+        return state
+
     def match (self, spec):
         """True if every field in spec == the same field on the entity.
         
@@ -404,6 +447,11 @@ class DataDict (dict):
     
     """A Python dict with the Cobalt query interface.
     
+    If item_cls declares indexed fields, q_get answers the exact-match part
+    of each spec from secondary indexes on those fields and only calls match
+    on the resulting candidates.  The indexes are built on first use and kept
+    current as items are added, removed, or have an indexed field set.
+    
     Class attributes:
     item_cls -- the class used to construct new items
     key -- attribute name to use as a key in the dictionary
@@ -449,11 +497,20 @@ class DataDict (dict):
         cargs -- a tuple of arguments to pass to callback after the item
         """
         matched_items = set()
-        for item in self.itervalues():
+        if self.item_cls.indexed:
             for spec in specs:
-                if item.match(spec):
-                    matched_items.add(item)
-                    break
+                candidates = self._index_candidates(spec)
+                if candidates is None:
+                    candidates = self.itervalues()
+                for item in candidates:
+                    if item not in matched_items and item.match(spec):
+                        matched_items.add(item)
+        else:
+            for item in self.itervalues():
+                for spec in specs:
+                    if item.match(spec):
+                        matched_items.add(item)
+                        break
         if callback:
             for item in matched_items:
                 callback(item, cargs)
@@ -476,6 +533,132 @@ class DataDict (dict):
     def copy (self):
         return self.__class__((key, value) for key, value in self.iteritems())
 
+    def __getstate__ (self):
+        state = self.__dict__.copy()
+        # items do not carry their owner references across a pickle, so
+        # the index is rebuilt on the next q_get
+        state.pop('_index', None)
+        return state
+
+    def __setstate__ (self, state):
+        self.__dict__.update(state)
+
+    def __setitem__ (self, key, item):
+        if self.__dict__.get('_index') is not None:
+            if key in self:
+                self._index_discard(dict.__getitem__(self, key))
+            self._index_insert(item)
+        dict.__setitem__(self, key, item)
+
+    def __delitem__ (self, key):
+        if self.__dict__.get('_index') is not None and key in self:
+            self._index_discard(dict.__getitem__(self, key))
+        dict.__delitem__(self, key)
+
+    def update (self, *args, **kwargs):
+        if self.__dict__.get('_index') is None:
+            dict.update(self, *args, **kwargs)
+            return
+        for key, item in dict(*args, **kwargs).iteritems():
+            self[key] = item
+
+    def pop (self, key, *default):
+        if self.__dict__.get('_index') is not None and key in self:
+            self._index_discard(dict.__getitem__(self, key))
+        return dict.pop(self, key, *default)
+
+    def clear (self):
+        if self.__dict__.get('_index') is not None:
+            for item in self.itervalues():
+                self._index_discard(item)
+        dict.clear(self)
+
+    def _index_candidates (self, spec):
+        """Return the set of items that can match spec according to the
+        indexes, or None if spec has no usable indexed field."""
+        index = self.__dict__.get('_index')
+        if index is None:
+            index = self._index_build()
+        lookups = []
+        for field, value in spec.iteritems():
+            if field not in index or value == "*":
+                continue
+            buckets, unhashable = index[field]
+            try:
+                bucket = buckets.get(value, ())
+            except TypeError:
+                continue
+            lookups.append((len(bucket) + len(unhashable), bucket, unhashable))
+        if not lookups:
+            return None
+        lookups.sort(key=lambda lookup: lookup[0])
+        _, bucket, unhashable = lookups[0]
+        candidates = set(bucket)
+        candidates.update(unhashable)
+        for _, bucket, unhashable in lookups[1:]:
+            if not candidates:
+                break
+            candidates = set([item for item in candidates
+                              if item in bucket or item in unhashable])
+        return candidates
+
+    def _index_build (self):
+        """Build the indexes for item_cls.indexed from the current items."""
+        index = dict([(field, ({}, set())) for field in self.item_cls.indexed])
+        self._index = index
+        for item in self.itervalues():
+            self._index_insert(item)
+        return index
+
+    def _index_insert (self, item):
+        """Add item to the indexes and register for its field updates."""
+        for field in self._index:
+            self._index_add_value(field, getattr(item, field, _UNSET), item)
+        owners = item.__dict__.setdefault('_index_owners', [])
+        for owner_ref in owners:
+            if owner_ref() is self:
+                break
+        else:
+            owners.append(weakref.ref(self))
+
+    def _index_discard (self, item):
+        """Remove item from the indexes and stop tracking its updates."""
+        for field in self._index:
+            self._index_remove_value(field, getattr(item, field, _UNSET), item)
+        owners = item.__dict__.get('_index_owners', [])
+        for owner_ref in owners[:]:
+            if owner_ref() is self or owner_ref() is None:
+                owners.remove(owner_ref)
+
+    def _index_move (self, item, field, old_value, new_value):
+        """Called by an item when one of its indexed fields is set."""
+        if field in self._index:
+            self._index_remove_value(field, old_value, item)
+            self._index_add_value(field, new_value, item)
+
+    def _index_add_value (self, field, value, item):
+        if value is _UNSET:
+            return
+        buckets, unhashable = self._index[field]
+        try:
+            buckets.setdefault(value, set()).add(item)
+        except TypeError:
+            unhashable.add(item)
+
+    def _index_remove_value (self, field, value, item):
+        if value is _UNSET:
+            return
+        buckets, unhashable = self._index[field]
+        try:
+            bucket = buckets.get(value)
+        except TypeError:
+            unhashable.discard(item)
+            return
+        if bucket is not None:
+            bucket.discard(item)
+            if not bucket:
+                del buckets[value]
+
 
 class ForeignData (Data):
     
@@ -492,32 +675,157 @@ class ForeignData (Data):
                 setattr(self, key, value)
 
 
+class ChangeLog (object):
+    
+    """Feed of changes to a collection of versioned Data items.
+    
+    Versioned items are stamped on every attribute change, so the items
+    changed since a given version can be picked out by their stamps.  The
+    change log remembers the keys of removed items for a bounded window, and
+    hands out a fresh epoch each time the process starts so that clients
+    holding versions from an earlier run fall back to a full update.
+    
+    Methods:
+    stamp -- mark an unversioned item as changed
+    record_deleted -- note the keys of items removed from the collection
+    get_changes_since -- report the changes after a client's version
+    """
+    
+    def __init__ (self, max_deleted=10000):
+        self.max_deleted = max_deleted
+        self.__start_epoch()
+
+    def __getstate__ (self):
+        return {'max_deleted':self.max_deleted}
+
+    def __setstate__ (self, state):
+        self.__dict__.update(state)
+        self.__start_epoch()
+
+    def __start_epoch (self):
+        self.epoch = "%s:%s:%s" % (socket.gethostname(), os.getpid(), time.time())
+        self.deleted = collections.deque()
+        # oldest version for which the deletion record is complete
+        self.horizon = _version_gen.next()
+
+    def stamp (self, item):
+        """Mark an item that is not a versioned Data object as changed."""
+        item.__dict__['_version'] = _version_gen.next()
+
+    def record_deleted (self, keys):
+        """Remember that the items with the given keys were removed."""
+        for key in keys:
+            self.deleted.append((_version_gen.next(), key))
+        while len(self.deleted) > self.max_deleted:
+            self.horizon = self.deleted.popleft()[0]
+
+    def get_changes_since (self, items, key, epoch, version, fields=None):
+        """Return the changes a client at epoch/version has not yet seen.
+        
+        Arguments:
+        items -- all items currently in the collection
+        key -- attribute name that identifies an item
+        epoch -- epoch of the client's last update (None for a full update)
+        version -- version of the client's last update, as a string
+        fields -- fields to marshal for updated items (default all)
+        
+        Returns a dictionary with the current epoch and version, whether the
+        update is full (the client must drop items it is not sent), the
+        marshalled updated items, the keys of deleted items, and the number
+        of items in the collection.
+        """
+        # versions travel as strings; they soon outgrow XML-RPC integers
+        version = int(version)
+        current = _version_gen.next()
+        full = (epoch != self.epoch or version < self.horizon)
+        if full:
+            updated = items
+            deleted = []
+        else:
+            updated = [item for item in items
+                       if item.__dict__.get('_version', 0) > version]
+            present = set([getattr(item, key) for item in updated])
+            deleted = [item_key for (item_version, item_key) in self.deleted
+                       if item_version > version and item_key not in present]
+        return {'epoch':self.epoch, 'version':str(current), 'full':full,
+                'updated':[item.to_rx(fields) for item in updated],
+                'deleted':deleted, 'count':len(items)}
+
+
+def _method_name (method):
+    '''Return the remote name of a proxy method, or the name of a function.'''
+    for attribute in ('_func_name', '_Method__name', '__name__'):
+        name = getattr(method, attribute, None)
+        if name is not None:
+            return name
+    return None
+
+
 class ForeignDataDict(DataDict):
     __oserror__ = Cobalt.Util.FailureMode("ForeignData connection")
     __function__ = lambda x:[]
+    __changes__ = None
     __procedure__ = None
     __fields__ = []
+
+    # position in the foreign component's change feed, when __changes__ is set
+    _sync_epoch = None
+    _sync_version = "0"
     
     def Sync(self):
         spec = dict([(field, "*") for field in self.__fields__])
+        if self.__changes__ is not None:
+            try:
+                changes = self.__changes__([spec], self._sync_epoch, self._sync_version)
+            except xmlrpclib.Fault, fault:
+                if fault.faultString != _method_name(self.__changes__):
+                    self.__oserror__.Fail()
+                    return
+                # the foreign component predates the change feed
+                self.__changes__ = None
+            except:
+                self.__oserror__.Fail()
+                return
+            else:
+                self.__oserror__.Pass()
+                self.SyncChanges(changes)
+                return
         try:
             foreign_data = self.__function__([spec])
         except:
             self.__oserror__.Fail()
             return
         self.__oserror__.Pass()
-        
-        local_ids = [getattr(item, self.key) for item in self.itervalues()]
-        foreign_ids = [item_dict[self.key] for item_dict in foreign_data]
+        self.SyncItems(foreign_data, full=True)
+
+    def SyncChanges(self, changes):
+        """Apply an update from a foreign ChangeLog."""
+        for key in changes['deleted']:
+            if key in self:
+                del self[key]
+        self.SyncItems(changes['updated'], full=changes['full'])
+        if len(self) == changes['count']:
+            self._sync_epoch = changes['epoch']
+            self._sync_version = changes['version']
+        else:
+            # a deletion slipped past the change log; start over
+            self._sync_epoch = None
+            self._sync_version = "0"
+
+    def SyncItems(self, foreign_data, full=False):
+        """Add or update local items from a list of foreign item dicts.  A
+        full list also removes local items that are missing from it."""
+        foreign_ids = set([item_dict[self.key] for item_dict in foreign_data])
         
         # sync removed items
-        for item in local_ids:
-            if item not in foreign_ids:
-                del self[item]
+        if full:
+            for item in self.keys():
+                if item not in foreign_ids:
+                    del self[item]
         
         # sync new items
         for item_dict in foreign_data:
-            if item_dict[self.key] not in local_ids:
+            if item_dict[self.key] not in self:
                 self.q_add([item_dict])
         
         # sync all items
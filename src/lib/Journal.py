@@ -0,0 +1,142 @@
+"""Append-only journal of component state changes.
+
+A component saving through a journal writes a full snapshot of itself only
+now and then, and in between appends just the changes made since its last
+save.  On startup the journal is replayed on top of the snapshot.
+
+Classes:
+StateJournal -- the journal file for one statefile
+
+Functions:
+read_journal -- load the batches recorded in a journal file
+"""
+
+import os
+import time
+import struct
+import zlib
+import cPickle
+import cStringIO
+import logging
+
+logger = logging.getLogger("Cobalt.Journal")
+
+# when to fsync the journal: after every batch, at most every sync_interval
+# seconds, or never (left to the operating system)
+SYNC_POLICIES = ['always', 'interval', 'never']
+
+# each frame is the length and CRC-32 of a pickled batch, then the batch
+_frame_header = struct.Struct("!Ii")
+
+
+def read_journal (path, persistent_load=None):
+    """Read the batches recorded in a journal.
+
+    Returns the snapshot generation the journal belongs to and the list of
+    batches, each a list of records.  A frame cut short or garbled by a
+    crash ends the replay; everything before it is returned.  A missing
+    journal yields (None, []).
+
+    Arguments:
+    path -- the journal file
+    persistent_load -- resolves the references written by the journal's
+                       persistent_id (optional)
+    """
+    try:
+        journal = open(path, "rb")
+    except IOError:
+        return None, []
+    try:
+        generation = None
+        batches = []
+        while True:
+            header = journal.read(_frame_header.size)
+            if not header:
+                break
+            if len(header) < _frame_header.size:
+                logger.warning("%s: ignoring truncated frame header", path)
+                break
+            length, crc = _frame_header.unpack(header)
+            data = journal.read(length)
+            if len(data) < length or zlib.crc32(data) != crc:
+                logger.warning("%s: ignoring damaged frame after %d batches", path, len(batches))
+                break
+            unpickler = cPickle.Unpickler(cStringIO.StringIO(data))
+            if persistent_load is not None:
+                unpickler.persistent_load = persistent_load
+            batch = unpickler.load()
+            if generation is None:
+                generation = batch.get('generation')
+            else:
+                batches.append(batch)
+        return generation, batches
+    finally:
+        journal.close()
+
+
+class StateJournal (object):
+
+    """The journal file kept next to a component statefile.
+
+    The first frame of the file names the generation of the snapshot the
+    journal applies to; every frame after it holds one batch of records.
+    Objects for which persistent_id returns an id are written as references
+    rather than pickled, which keeps records that point back at the
+    component from dragging all of its state into the journal.
+
+    Methods:
+    reset -- start an empty journal for a new snapshot
+    append -- add a batch of records
+    close -- close the journal file
+
+    Properties:
+    size -- bytes in the journal file
+    """
+
+    def __init__ (self, path, sync='interval', sync_interval=5.0, persistent_id=None):
+        if sync not in SYNC_POLICIES:
+            raise ValueError("unknown journal sync policy %r" % (sync, ))
+        self.path = path
+        self.persistent_id = persistent_id
+        self.sync = sync
+        self.sync_interval = sync_interval
+        self.size = 0
+        self._file = None
+        self._last_sync = 0
+
+    def reset (self, generation):
+        """Truncate the journal and mark it as following the given snapshot."""
+        self.close()
+        self._file = open(self.path, "wb")
+        self.size = 0
+        self._write({'generation':generation})
+        self._sync(True)
+
+    def append (self, records):
+        """Add a batch of records to the journal."""
+        if self._file is None:
+            raise IOError("journal %s has not been reset" % self.path)
+        self._write(records)
+        self._sync(self.sync == 'always')
+
+    def close (self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _write (self, batch):
+        buf = cStringIO.StringIO()
+        pickler = cPickle.Pickler(buf, cPickle.HIGHEST_PROTOCOL)
+        if self.persistent_id is not None:
+            pickler.persistent_id = self.persistent_id
+        pickler.dump(batch)
+        data = buf.getvalue()
+        self._file.write(_frame_header.pack(len(data), zlib.crc32(data)) + data)
+        self._file.flush()
+        self.size += _frame_header.size + len(data)
+
+    def _sync (self, force):
+        now = time.time()
+        if force or (self.sync == 'interval' and now - self._last_sync >= self.sync_interval):
+            os.fsync(self._file.fileno())
+            self._last_sync = now
@@ -2,11 +2,13 @@
 __revision__ = '$Revision: 2154 $'
 
 # import lxml.etree
+import collections
 import copy
 import fcntl
 import logging
 import logging.handlers
 import math
+import itertools
 import os.path
 import socket
 import struct
@@ -21,6 +23,7 @@ import threading
 import time
 import Queue
 import traceback
+import xmlrpclib
 
 import Cobalt.JSONEncoders
 import Cobalt.Proxy
@@ -296,8 +299,22 @@ def log_to_syslog (logger_name, level=SYSLOG_LEVEL, format='%(name)s[%(process)d
 # Log-to-database utilities are below.
 class dbwriter(object):
 
-    """I am intending this to involve a singleton IO thread going to the
-    database"""
+    """Deliver log messages to the database writer component.
+
+    Messages are encoded on the caller's thread and queued; a delivery
+    thread sends them to cdbwriter in batches.  Once max_queued messages are
+    waiting, further messages are appended to the overflow file instead, and
+    the file is read back from the point delivery has reached, then removed
+    once all of it has been sent.
+    """
+
+    # most messages sent to the writer component in one request
+    batch_size = 100
+    # seconds between attempts to reach an unavailable writer component
+    retry_interval = 10.0
+    # deliver from a background thread; if false, messages are delivered on
+    # the thread that logs them
+    threaded = True
 
     def __init__(self, logger, queue=None, overflow_filename=None, max_queued=None):
 
@@ -305,20 +322,45 @@ class dbwriter(object):
         self.enabled = False
         self.cdbwriter_alive = False
         self.cdbwriter = None
-        self.flushing = False
+        # false once the writer component turns out to lack add_messages
+        self.bulk = True
+        self.last_connect = 0
 
         self.overflow = False
         self.overflow_filename = overflow_filename
+        self.overflow_offset = 0
         self.overflow_file = None
-        self.clearing_overflow = False
         self.max_queued = max_queued
 
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        self.delivering = threading.Lock()
+        self.delivery_thread = None
+
         if queue:
             self.msg_queue = queue
         else:
             self.msg_queue = []
 
+    def _get_msg_queue(self):
+        return self._msg_queue
+
+    def _set_msg_queue(self, messages):
+        self.lock.acquire()
+        try:
+            self._msg_queue = collections.deque(messages)
+        finally:
+            self.lock.release()
+
+    msg_queue = property(_get_msg_queue, _set_msg_queue)
 
+    def pending_messages(self):
+        '''Return a copy of the messages waiting in memory, for saving with a component's state.'''
+        self.lock.acquire()
+        try:
+            return list(self._msg_queue)
+        finally:
+            self.lock.release()
 
     def connect(self):
         '''Establish connection.  Should attempt succeed, mark communication as alive to prevent needless connection retries.
@@ -331,9 +373,11 @@ class dbwriter(object):
             self.logger.warning("Attempted to connect to cdbwriter when a conenction already exists.")
             return
 
+        self.last_connect = time.time()
         try:
             self.cdbwriter = Cobalt.Proxy.ComponentProxy('cdbwriter', defer=False)
             self.cdbwriter_alive = True
+            self.bulk = True
         except:
             self.logger.warning("Unable to connect to cdbwriter")
             self.logger.warning(traceback.format_exc())
@@ -346,127 +390,185 @@ class dbwriter(object):
         if not self.enabled:
             return
 
-        #if a queue gets too large, save messages to disk for later writiing.
-        if ((self.max_queued != None) and 
-            (len(self.msg_queue) >= self.max_queued) and 
-            not self.clearing_overflow):
-            self.overflow = True
-            self.open_overflow('a')
-            if self.overflow_file == None:
-                #we have too many messages and cannot write to disk
-                #This message has to be dropped.
-                #Of course, a lot of somethings would have to go critically
-                #wrong to need this.  The logfile message may fail as well.
-
-                try:
-                    message = Cobalt.JSONEncoders.ReportObject(user, event, msg_type, obj, timestamp).encode()
-                except Exception as e:
-                    self.logger.error("Error encoding message to send to cdbwriter.")
-                    self.logger.error(traceback.format_exc())
-                else:
-                    #done just about all I can.  At this point, I don't have much choice (out of disk, for instance).
-                    self.logger.critical("MESSAGE DROPPED: %s" % message)
-            else:
-                self.queue_to_overflow()
-                self.close_overflow()
-
-        #end queue overflow handling
-
         try:
             message = Cobalt.JSONEncoders.ReportObject(user, event, 
                                                            msg_type, obj, timestamp).encode()
         except Exception as e:
             self.logger.error("Error encoding message to send to cdbwriter.")
             self.logger.debug(traceback.format_exc())
+            return
 
-        else:
-            self.msg_queue.append(message)
+        self.queue_message(message)
 
+    def queue_message(self, message):
+        '''Queue an encoded message for delivery, spilling it to the overflow file if too many are waiting.'''
+        self.lock.acquire()
+        try:
+            if self.overflow or ((self.max_queued != None) and (len(self._msg_queue) >= self.max_queued)):
+                self.spill(message)
+            else:
+                self._msg_queue.append(message)
+        finally:
+            self.lock.release()
         self.flush_queue()
 
     def flush_queue(self):
-        """send a series of messages to the writer component."""
-        if not (self.enabled or self.flushing or self.clearing_overflow):
+        """Have queued messages sent to the writer component."""
+        if not self.enabled:
+            return
+        if not self.threaded:
+            self.deliver()
             return
 
-        self.flushing = True
-        if not self.cdbwriter_alive:
-            self.connect()
-
-        #we're connected and have an "overflow file", we should flush 
-        #that first.
-        if self.overflow and self.cdbwriter_alive:
-            self.clearing_overflow = True
-            #Shove out as many to the writer component as we can.  Save the rest.
-            self.open_overflow('r')
-            if self.overflow_file:
-                #we prepend to the message queue.
-                overflow_queue = [line for line in self.overflow_file]
-                overflow_queue.extend(self.msg_queue)
-                self.msg_queue = overflow_queue
+        self.lock.acquire()
+        try:
+            if self.delivery_thread is None:
+                self.delivery_thread = threading.Thread(target=self._delivery_loop, name="dbwriter")
+                self.delivery_thread.setDaemon(True)
+                self.delivery_thread.start()
+            self.wakeup.notify()
+        finally:
+            self.lock.release()
+
+    def _delivery_loop(self):
+        while True:
+            try:
+                self.deliver()
+            except Exception:
+                self.logger.error("dbwriter: unexpected error delivering messages", exc_info=True)
+            self.lock.acquire()
+            try:
+                if not (self.cdbwriter_alive and (self._msg_queue or self.overflow)):
+                    self.wakeup.wait(self.retry_interval)
+            finally:
+                self.lock.release()
+
+    def deliver(self):
+        """Send the queued messages, then those in the overflow file, to the writer component.
+
+        Returns once everything has been sent or the writer component cannot be reached.
+        """
+        self.delivering.acquire()
+        try:
+            if not self.cdbwriter_alive:
+                if time.time() - self.last_connect < self.retry_interval:
+                    return
+                self.connect()
+            while self.cdbwriter_alive:
+                batch, offsets = self._next_batch()
+                if not batch:
+                    break
+                sent = self._send(batch)
+                self.lock.acquire()
+                try:
+                    if offsets is None:
+                        for _ in xrange(sent):
+                            self._msg_queue.popleft()
+                    elif sent:
+                        self.overflow_offset = offsets[sent - 1]
+                finally:
+                    self.lock.release()
+                if sent < len(batch):
+                    self.logger.error("dbwriter.deliver: Unable to contact "\
+                            "database writer when sending message.")
+                    self.cdbwriter_alive = False
+        finally:
+            self.delivering.release()
+
+    def _next_batch(self):
+        '''Return the next messages to send and, for messages read from the overflow file, the file offset following
+        each of them.'''
+        self.lock.acquire()
+        try:
+            if self._msg_queue:
+                return list(itertools.islice(self._msg_queue, self.batch_size)), None
+            if not self.overflow:
+                return [], None
+            messages, offsets = self.read_overflow()
+            if not messages:
+                # the whole overflow file has been delivered
                 self.close_overflow()
-                self.del_overflow() #Now that it is back in memory, we dump if needed.
+                self.del_overflow()
                 self.overflow = False
-
-        #drain the queue, if we have one.
-        while self.msg_queue and self.cdbwriter_alive:
-            msg = self.msg_queue[0]
+                self.overflow_offset = 0
+            return messages, offsets
+        finally:
+            self.lock.release()
+
+    def _send(self, batch):
+        '''Send a batch of messages, returning how many of them the writer component accepted.'''
+        if self.bulk:
             try:
-                self.cdbwriter.add_message(msg)
+                self.cdbwriter.add_messages(batch)
+                return len(batch)
+            except xmlrpclib.Fault, fault:
+                if 'add_messages' not in fault.faultString:
+                    return 0
+                # an older writer component; send the messages one call at a time
+                self.bulk = False
             except:
-                self.logger.error("dbwriter.flush_queue: Unable to contact "\
-                        "database writer when sending message.")
-                self.cdbwriter_alive = False
-
-                #if the cdbwriter falls over while dealing with overflow.
-                if ((self.max_queued != None) and
-                    (len(self.msg_queue) >= self.max_queued)):
-                    self.overflow = True
-                    self.open_overflow('a')
-                    if self.overflow_file != None:
-                        self.queue_to_overflow()
-                        self.close_overflow()
+                return 0
+        calls = Cobalt.Proxy.MultiCall(self.cdbwriter)
+        for msg in batch:
+            calls.add_message(msg)
+        try:
+            results = calls()
+        except:
+            results = []
+        sent = 0
+        for result in results:
+            if isinstance(result, xmlrpclib.Fault):
                 break
-            else:
-                try:
-                    self.msg_queue.pop(0)
-                except IndexError:
-                    self.logger.error("dbwriter.flush_queue: Queue already empty.")
+            sent += 1
+        return sent
+
+    def spill(self, message):
+        '''Append a message to the overflow file.  Called with the lock held.'''
+        try:
+            if self.overflow_file is None:
+                self.overflow_file = open(self.overflow_filename, 'a')
+            self.overflow_file.write(message + '\n')
+            self.overflow_file.flush()
+        except (IOError, TypeError):
+            self.logger.critical("Unable to write overflow file!  Information to database will be lost!")
+            #done just about all I can.  At this point, I don't have much choice (out of disk, for instance).
+            self.logger.critical("MESSAGE DROPPED: %s" % message)
+            self.close_overflow()
+            return
+        self.overflow = True
 
-        self.clearing_overflow = False
-        self.flushing = False
+    def read_overflow(self):
+        '''Read the next batch of messages from the overflow file, starting at overflow_offset.
 
-    def open_overflow(self, mode):
+        Returns the messages and the file offset following each one.  A final line still being written is left for
+        the next read.
+        '''
+        messages = []
+        offsets = []
         try:
-            self.overflow_file = open(self.overflow_filename, mode)
-        except:
+            overflow = open(self.overflow_filename, 'r')
+        except (IOError, TypeError):
             self.logger.critical("Unable to open overflow file!  Information to database will be lost!")
+            return messages, offsets
+        try:
+            overflow.seek(self.overflow_offset)
+            while len(messages) < self.batch_size:
+                line = overflow.readline()
+                if not line.endswith('\n'):
+                    break
+                messages.append(line[:-1])
+                offsets.append(overflow.tell())
+        finally:
+            overflow.close()
+        return messages, offsets
 
     def close_overflow(self):
-        if self.overflow and self.overflow_file:
+        if self.overflow_file:
             self.overflow_file.close()
             self.overflow_file = None
 
     def del_overflow(self):
-        os.remove(self.overflow_filename)
-
-    def queue_to_overflow(self):
-        elements_written = 0
-        if len(self.msg_queue) == 0:
-            return
-
-        while self.msg_queue:
-            msg = self.msg_queue.pop(0)
-            try:
-                self.overflow_file.write(msg+'\n')
-                elements_written += 1
-            except IOError:
-                self.logger.error('Could only partially empty queue, %d messages written' % \
-                             elements_written)
-                self.msg_queue.insert(0, msg)
-
-        if elements_written > 0:
-            del self.msg_queue[0:elements_written-1] #empty the queue of what we have written
-
-        return len(self.msg_queue)
-
+        try:
+            os.remove(self.overflow_filename)
+        except (OSError, TypeError):
+            pass
@@ -19,12 +19,16 @@ import urlparse
 import httplib
 import ssl
 import os.path
+import threading
+import urllib
+import json
+import zlib
 
 import Cobalt
 from Cobalt.Exceptions import ComponentLookupError, ComponentOperationError
 
 __all__ = [
-    "ComponentProxy", "ComponentLookupError", "RetryMethod",
+    "ComponentProxy", "ComponentLookupError", "RetryMethod", "MultiCall",
     "register_component", "find_configured_servers",
 ]
 
@@ -200,8 +204,137 @@ class SSLHTTPConnection(httplib.HTTPConnection):
         self.sock.closeSocket = True
 
 
+# Alternative response encoding.  A client that sends the
+# X-Cobalt-Accept-Encoding header (for instance "json, zlib") may get its
+# response back as compact JSON, optionally zlib-compressed, with the
+# encoding named in the X-Cobalt-Encoding response header.  Requests are
+# always XML-RPC, and servers that do not know the header answer in XML.
+ACCEPT_ENCODING_HEADER = "X-Cobalt-Accept-Encoding"
+ENCODING_HEADER = "X-Cobalt-Encoding"
+# responses smaller than this are not worth compressing
+COMPRESS_THRESHOLD = 16384
+
+def dumps_json_response(response, accept_encoding):
+    """Encode a method response (a value or a Fault) as JSON.
+
+    Returns the body and the encoding to name in the response header, or
+    (None, None) when the client did not ask for JSON or the response holds
+    values JSON cannot carry, in which case XML should be sent instead.
+    """
+    accepted = [name.strip() for name in (accept_encoding or "").split(",")]
+    if 'json' not in accepted:
+        return None, None
+    if isinstance(response, Fault):
+        wrapped = {'fault':{'faultCode':response.faultCode,
+                            'faultString':response.faultString}}
+    else:
+        wrapped = {'result':response}
+    try:
+        body = json.dumps(wrapped, separators=(',', ':'))
+    except (TypeError, ValueError, UnicodeDecodeError):
+        return None, None
+    if 'zlib' in accepted and len(body) > COMPRESS_THRESHOLD:
+        return zlib.compress(body, 1), 'json+zlib'
+    return body, 'json'
+
+def _stringify_json(value):
+    # xmlrpclib hands back plain strings for ASCII text; do the same
+    value_type = type(value)
+    if value_type is unicode:
+        try:
+            return value.encode('ascii')
+        except UnicodeError:
+            return value
+    elif value_type is list:
+        return [_stringify_json(item) for item in value]
+    return value
+
+def _stringify_json_object(pairs):
+    return dict([(_stringify_json(key), _stringify_json(value))
+                 for key, value in pairs])
+
+def loads_json_response(body, encoding):
+    """Decode a response from dumps_json_response.
+
+    Returns the result as a one-element tuple, as xmlrpclib does, or raises
+    the Fault it carries.
+    """
+    if encoding == 'json+zlib':
+        body = zlib.decompress(body)
+    elif encoding != 'json':
+        raise xmlrpclib.ResponseError("unknown response encoding %s" % encoding)
+    wrapped = json.loads(body, object_pairs_hook=_stringify_json_object)
+    if 'fault' in wrapped:
+        raise Fault(wrapped['fault']['faultCode'], wrapped['fault']['faultString'])
+    return (_stringify_json(wrapped['result']),)
+
+
+class ConnectionPool(object):
+    """Per-process pool of idle HTTP/1.1 connections.
+
+    Connections are keyed by the host they talk to and the SSL parameters
+    they were made with.  A connection is checked out for the length of a
+    single request, so callers in different threads never share one.
+    """
+
+    def __init__(self, max_idle=4, idle_timeout=5.0):
+        self.max_idle = max_idle
+        # servers drop connections idle for their timeout (10s by default);
+        # let ours go before that happens
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        self.idle = {}
+
+    def get(self, key):
+        """Return an idle connection for key, or None."""
+        expired = []
+        self.lock.acquire()
+        try:
+            connections = self.idle.get(key, [])
+            while connections:
+                connection, released = connections.pop()
+                if time.time() - released < self.idle_timeout:
+                    return connection
+                expired.append(connection)
+            return None
+        finally:
+            self.lock.release()
+            for connection in expired:
+                connection.close()
+
+    def put(self, key, connection):
+        """Return a connection after a successful request."""
+        self.lock.acquire()
+        try:
+            connections = self.idle.setdefault(key, [])
+            if len(connections) < self.max_idle:
+                connections.append((connection, time.time()))
+                return
+        finally:
+            self.lock.release()
+        connection.close()
+
+    def clear(self):
+        """Close every idle connection."""
+        self.lock.acquire()
+        try:
+            idle = self.idle
+            self.idle = {}
+        finally:
+            self.lock.release()
+        for connections in idle.itervalues():
+            for connection, released in connections:
+                connection.close()
+
+connection_pool = ConnectionPool()
+
+
 class XMLRPCTransport(xmlrpclib.Transport):
-    def __init__(self, key=None, cert=None, ca=None, scns=None, use_datetime=0, timeout=90):
+    # bytes read from the socket at a time when parsing a response
+    read_size = 65536
+
+    def __init__(self, key=None, cert=None, ca=None, scns=None, use_datetime=0, timeout=90,
+                 accept_encoding=None):
         if hasattr(xmlrpclib.Transport, '__init__'):
             xmlrpclib.Transport.__init__(self, use_datetime)
         self.key = key
@@ -209,6 +342,7 @@ class XMLRPCTransport(xmlrpclib.Transport):
         self.ca = ca
         self.scns = scns
         self.timeout = timeout
+        self.accept_encoding = accept_encoding
 
     def make_connection(self, host):
         #this is a hack
@@ -222,18 +356,75 @@ class XMLRPCTransport(xmlrpclib.Transport):
                                  scns=self.scns, timeout=self.timeout)
             https = httplib.HTTP()
             https._setup(http)
-        else:
-            host, self._extra_headers, x509 = self.get_host_info(host)
-            http = SSLHTTPConnection(host, key=self.key, cert=self.cert, ca=self.ca,
+            return https
+        # python 2.7: a persistent connection, checked out of the pool
+        chost, self._extra_headers, x509 = self.get_host_info(host)
+        pool_key = (chost, self.key, self.cert, self.ca)
+        http = connection_pool.get(pool_key)
+        if http is None:
+            http = SSLHTTPConnection(chost, key=self.key, cert=self.cert, ca=self.ca,
                                  scns=self.scns, timeout=self.timeout)
-            self._connection = host, http
-            https = self._connection[1]
-            https = httplib.HTTP()
-            https._setup(http)
-        return https
+            http.reused = False
+        else:
+            http.reused = True
+        http.pool_key = pool_key
+        return http
 
     def request(self, host, handler, request_body, verbose=0):
         """Send request to server and return response."""
+        if not hasattr(xmlrpclib.Transport, 'single_request'):
+            return self._unpooled_request(host, handler, request_body, verbose)
+        while True:
+            h = self.make_connection(host)
+            try:
+                h.putrequest("POST", handler, skip_accept_encoding=True)
+                self.send_host(h, host)
+                self.send_user_agent(h)
+                if self.accept_encoding:
+                    h.putheader(ACCEPT_ENCODING_HEADER, self.accept_encoding)
+                self.send_content(h, request_body)
+                response = h.getresponse(buffering=True)
+                if response.status != 200:
+                    if response.getheader("content-length", 0):
+                        response.read()
+                    h.close()
+                    raise xmlrpclib.ProtocolError(host + handler, response.status,
+                            response.reason, response.msg)
+                self.verbose = verbose
+                result = self.parse_response(response)
+            except (socket.error, httplib.HTTPException), err:
+                h.close()
+                # a pooled connection may have been dropped by the server (for
+                # instance on restart) before it read our request; retry that
+                # once on a fresh connection, but never retry a timeout
+                if h.reused and not (isinstance(err, socket.timeout) or
+                        'timed out' in str(err)):
+                    continue
+                forget_location(host)
+                raise
+            except:
+                h.close()
+                raise
+            connection_pool.put(h.pool_key, h)
+            return result
+
+    def parse_response(self, response):
+        """Parse a response in whichever encoding the server chose."""
+        encoding = response.getheader(ENCODING_HEADER)
+        if encoding is not None:
+            return loads_json_response(response.read(), encoding)
+        if response.getheader("Content-Encoding", "") == "gzip":
+            return xmlrpclib.Transport.parse_response(self, response)
+        p, u = self.getparser()
+        while True:
+            data = response.read(self.read_size)
+            if not data:
+                break
+            p.feed(data)
+        p.close()
+        return u.close()
+
+    def _unpooled_request(self, host, handler, request_body, verbose=0):
         h = self.make_connection(host)
         self.send_request(h, handler, request_body)
         self.send_host(h, host)
@@ -256,7 +447,7 @@ class XMLRPCTransport(xmlrpclib.Transport):
         p, u = self.getparser()
 
         while recvd < length:
-            rlen = min(length - recvd, 1024)
+            rlen = min(length - recvd, self.read_size)
             response = fd.read(rlen)
             recvd += len(response)
             if not response:
@@ -275,6 +466,104 @@ def register_component (component):
     local_components[component.name] = component
 
 
+_communication_settings = None
+_located = dict()
+_located_lock = threading.Lock()
+
+def get_communication_settings():
+    """Read and cache the [communication] settings used by every proxy.
+
+    Returns a tuple of (password, key path, cert path, ca path, seconds to
+    cache service-location lookups, response encodings to ask for).
+    """
+    global _communication_settings
+    if _communication_settings is None:
+        try:
+            config = SafeConfigParser()
+            config.read(Cobalt.CONFIG_FILES)
+            passwd = config.get('communication', 'password')
+            keypath = os.path.expandvars(config.get('communication', 'key'))
+            certpath = os.path.expandvars(config.get('communication', 'cert'))
+            capath = os.path.expandvars(config.get('communication', 'ca'))
+        except:
+            passwd = 'default'
+            keypath = None
+            certpath = None
+            capath = None
+        try:
+            locate_ttl = float(config.get('communication', 'locate_cache_ttl'))
+        except:
+            locate_ttl = 60.0
+        try:
+            accept_encoding = config.get('communication', 'response_encoding')
+        except:
+            accept_encoding = 'json, zlib'
+        if accept_encoding.strip() in ('', 'xml'):
+            accept_encoding = None
+        try:
+            connection_pool.max_idle = int(config.get('communication', 'max_idle_connections'))
+        except:
+            pass
+        try:
+            connection_pool.idle_timeout = float(config.get('communication', 'idle_connection_timeout'))
+        except:
+            pass
+        _communication_settings = (passwd, keypath, certpath, capath, locate_ttl,
+                accept_encoding)
+    return _communication_settings
+
+def locate(component_name, ttl):
+    """Find a component through service-location, caching the answer for
+    ttl seconds."""
+    now = time.time()
+    _located_lock.acquire()
+    try:
+        cached = _located.get(component_name)
+    finally:
+        _located_lock.release()
+    if cached is not None and cached[1] > now:
+        return cached[0]
+    try:
+        slp = ComponentProxy("service-location")
+    except ComponentLookupError:
+        raise ComponentLookupError(component_name)
+    try:
+        address = slp.locate(component_name)
+    except:
+        raise ComponentLookupError(component_name)
+    if not address:
+        raise ComponentLookupError(component_name)
+    _located_lock.acquire()
+    try:
+        _located[component_name] = (address, now + ttl)
+    finally:
+        _located_lock.release()
+    return address
+
+def forget_location(host):
+    """Drop cached service-location answers pointing at host, after a
+    connection to it failed."""
+    host = urllib.splituser(host)[1]
+    _located_lock.acquire()
+    try:
+        for component_name, (address, expires) in _located.items():
+            if urlparse.urlparse(address)[1] == host:
+                del _located[component_name]
+    finally:
+        _located_lock.release()
+
+def clear_proxy_caches():
+    """Forget cached settings, locations and idle connections."""
+    global _communication_settings
+    _communication_settings = None
+    _located_lock.acquire()
+    try:
+        _located.clear()
+    finally:
+        _located_lock.release()
+    connection_pool.clear()
+
+
 def ComponentProxy(component_name, **kwargs):
     
     """Constructs proxies to components.
@@ -291,20 +580,11 @@ def ComponentProxy(component_name, **kwargs):
         return DeferredProxy(component_name, enable_retry)
 
     user = 'root'
-    try:
-        config = SafeConfigParser()
-        config.read(Cobalt.CONFIG_FILES)
-        passwd = config.get('communication', 'password')
-        keypath = os.path.expandvars(config.get('communication', 'key'))
-        certpath = os.path.expandvars(config.get('communication', 'cert'))
-        capath = os.path.expandvars(config.get('communication', 'ca'))
-    except:
-        passwd = 'default'
-        keypath = None
-        certpath = None
-        capath = None
+    passwd, keypath, certpath, capath, locate_ttl, accept_encoding = \
+            get_communication_settings()
 
-    ssl_trans = XMLRPCTransport(keypath, certpath, capath, timeout=90)    
+    ssl_trans = XMLRPCTransport(keypath, certpath, capath, timeout=90,
+            accept_encoding=accept_encoding)
     
     if component_name in local_components:
         return LocalProxy(local_components[component_name])
@@ -315,16 +595,7 @@ def ComponentProxy(component_name, **kwargs):
             return RetryServerProxy(newurl, allow_none=True, transport=ssl_trans)
         return ServerProxy(newurl, allow_none=True, transport=ssl_trans)
     elif component_name != "service-location":
-        try:
-            slp = ComponentProxy("service-location")
-        except ComponentLookupError:
-            raise ComponentLookupError(component_name)
-        try:
-            address = slp.locate(component_name)
-        except:
-            raise ComponentLookupError(component_name)
-        if not address:
-            raise ComponentLookupError(component_name)
+        address = locate(component_name, locate_ttl)
         method, path = urlparse.urlparse(address)[:2]
         newurl = "%s://%s:%s@%s" % (method, user, passwd, path)
         if enable_retry:
@@ -335,7 +606,6 @@ def ComponentProxy(component_name, **kwargs):
 
 
 
-
 class LocalProxy (object):
     
     """Proxy-like filter for inter-component communication.
@@ -393,14 +663,70 @@ class DeferredProxyMethod (object):
         return func(*args)
 
 
+class MultiCall (object):
+
+    """Collect calls to one component and send them in a single request.
+
+    >>> batch = MultiCall(ComponentProxy("cdbwriter"))
+    >>> batch.add_message(msg1)
+    >>> batch.add_message(msg2)
+    >>> results = batch()
+
+    The component runs the calls in order under one acquisition of its
+    lock.  Calling the batch returns a list holding the result of each
+    call, or an xmlrpclib.Fault for each call that failed; errors reaching
+    the component are raised as they would be for a single call.
+    """
+
+    def __init__ (self, proxy):
+        self._proxy = proxy
+        self._calls = []
+
+    def __getattr__ (self, attribute):
+        return MultiCallMethod(self, attribute)
+
+    def __len__ (self):
+        return len(self._calls)
+
+    def __call__ (self):
+        if not self._calls:
+            return []
+        proxy = self._proxy
+        if isinstance(proxy, DeferredProxy):
+            proxy = ComponentProxy(proxy._component_name, retry=proxy.retry, defer=False)
+        if isinstance(proxy, LocalProxy):
+            responses = proxy._component._dispatch_multicall(self._calls, dict())
+        else:
+            responses = getattr(proxy, "system.multicall")(self._calls)
+        results = []
+        for response in responses:
+            if isinstance(response, dict):
+                results.append(Fault(response['faultCode'], response['faultString']))
+            else:
+                results.append(response[0])
+        return results
+
+
+class MultiCallMethod (object):
+
+    def __init__ (self, multicall, func_name):
+        self._multicall = multicall
+        self._func_name = func_name
+
+    def __call__ (self, *args):
+        self._multicall._calls.append({'methodName':self._func_name, 'params':args})
+
+
 def find_configured_servers (config_files=None):
     """Read associated config files into the module.
     
     Arguments:
     config_files -- a list of paths to config files.
     """
+    global _communication_settings
     if not config_files:
         config_files = Cobalt.CONFIG_FILES
+    _communication_settings = None
     config = SafeConfigParser()
     config.read(config_files)
     try:
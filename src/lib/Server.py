@@ -9,6 +9,8 @@ __all__ = [
 
 import sys
 import os
+import errno
+import select
 import xmlrpclib
 import socket
 import SocketServer
@@ -22,9 +24,11 @@ import urlparse
 import threading
 import time
 import ssl
+import Queue
 
 import Cobalt
-from Cobalt.Proxy import ComponentProxy
+from Cobalt.Proxy import ComponentProxy, dumps_json_response, \
+        ACCEPT_ENCODING_HEADER, ENCODING_HEADER
 
 class ForkedChild(Exception):
     pass
@@ -66,7 +70,15 @@ class CobaltXMLRPCDispatcher (SimpleXMLRPCServer.SimpleXMLRPCDispatcher):
         self.allow_none = allow_none
         self.encoding = encoding
 
-    def _marshaled_dispatch (self, data):
+    def _marshaled_dispatch (self, data, caller=None):
+        return self._encoded_dispatch(data, caller)[0]
+
+    def _encoded_dispatch (self, data, caller=None, accept_encoding=None):
+        """Dispatch an XML-RPC request.
+
+        Returns the response body and the encoding used for it: None for
+        XML-RPC, or one of the encodings offered in accept_encoding.
+        """
         method_func = None
         params, method = xmlrpclib.loads(data)
         #print method, "\n" ,params
@@ -74,21 +86,34 @@ class CobaltXMLRPCDispatcher (SimpleXMLRPCServer.SimpleXMLRPCDispatcher):
         try:
             #print "%s: %s being poked" % (time.ctime(), method)
             #time.sleep(120)
-            response = self.instance._dispatch(method, params, self.funcs)
+            if method == 'system.multicall' and \
+                    hasattr(self.instance, '_dispatch_multicall'):
+                response = self.instance._dispatch_multicall(params[0],
+                        self.funcs, caller)
+            else:
+                response = self.instance._dispatch(method, params, self.funcs,
+                        caller)
+        except xmlrpclib.Fault, fault:
+            response = fault
+        except:
+            # report exception back to server
+            response = xmlrpclib.Fault(1, "%s:%s" % (sys.exc_type, sys.exc_value))
+
+        if accept_encoding:
+            raw_response, encoding = dumps_json_response(response, accept_encoding)
+            if raw_response is not None:
+                return raw_response, encoding
+        if not isinstance(response, xmlrpclib.Fault):
             response = (response,)
+        try:
             raw_response = xmlrpclib.dumps(response, methodresponse=1,
                                            allow_none=self.allow_none,
                                            encoding=self.encoding)
-        except xmlrpclib.Fault, fault:
-            raw_response = xmlrpclib.dumps(fault,
-                                           allow_none=self.allow_none,
-                                           encoding=self.encoding)
         except:
-            # report exception back to server
             raw_response = xmlrpclib.dumps(
                 xmlrpclib.Fault(1, "%s:%s" % (sys.exc_type, sys.exc_value)),
                 allow_none=self.allow_none, encoding=self.encoding)
-        return raw_response
+        return raw_response, None
 
 
 
@@ -105,6 +130,8 @@ class SSLServer (SocketServer.TCPServer, object):
     """
 
     allow_reuse_address = True
+    # when False, the SSL handshake is left to whoever handles the request
+    handshake_on_accept = True
     logger = logging.getLogger("Cobalt.Server.TCPServer")
 
     def __init__(self, server_address, RequestHandlerClass, keyfile=None,
@@ -167,7 +194,8 @@ class SSLServer (SocketServer.TCPServer, object):
         sock.settimeout(self.timeout)
         sslsock = ssl.wrap_socket(sock, server_side=True, certfile=self.certfile,
                                   keyfile=self.keyfile, cert_reqs=self.mode,
-                                  ca_certs=self.ca, ssl_version=self.ssl_protocol)
+                                  ca_certs=self.ca, ssl_version=self.ssl_protocol,
+                                  do_handshake_on_connect=self.handshake_on_accept)
         return sslsock, sockinfo
 
     def close_request(self, request):
@@ -202,6 +230,9 @@ class XMLRPCRequestHandler (SimpleXMLRPCServer.SimpleXMLRPCRequestHandler):
     
     require_auth = True
     credentials = {'root':'default'}
+    # clients may keep connections open between calls; servers that handle
+    # one request at a time close them after each response
+    protocol_version = "HTTP/1.1"
     try:
         config = SafeConfigParser()
         config.read(Cobalt.CONFIG_FILES)
@@ -230,6 +261,23 @@ class XMLRPCRequestHandler (SimpleXMLRPCServer.SimpleXMLRPCRequestHandler):
         if password != valid_password:
             raise self.CouldNotAuthenticate("invalid password for %s" % username)
     
+    def handle_one_request (self):
+        """Extends handle_one_request.
+
+        A client that keeps its connection open between calls may let it
+        time out or close it while we wait for the next request; that just
+        ends the connection.
+        """
+        waiting = getattr(self, 'requests_handled', 0) > 0
+        try:
+            SimpleXMLRPCServer.SimpleXMLRPCRequestHandler.handle_one_request(self)
+        except socket.error:
+            if not waiting:
+                raise
+            self.close_connection = 1
+            return
+        self.requests_handled = getattr(self, 'requests_handled', 0) + 1
+
     def parse_request (self):
         """Extends parse_request.
         
@@ -243,6 +291,7 @@ class XMLRPCRequestHandler (SimpleXMLRPCServer.SimpleXMLRPCRequestHandler):
                 self.authenticate()
             except self.CouldNotAuthenticate, e:
                 self.logger.error("Authentication failed: %s" % e.args[0])
+                self.close_connection = 1
                 code = 401
                 message, explanation = self.responses[401]
                 self.send_error(code, message)
@@ -261,22 +310,37 @@ class XMLRPCRequestHandler (SimpleXMLRPCServer.SimpleXMLRPCRequestHandler):
                 size_remaining -= len(L[-1])
             data = ''.join(L)
 
-            response = self.server._marshaled_dispatch(data)
+            accept_encoding = self.headers.get(ACCEPT_ENCODING_HEADER)
+            if hasattr(self.server, '_encoded_dispatch'):
+                response, encoding = self.server._encoded_dispatch(data,
+                        self.client_address[0], accept_encoding)
+            else:
+                response, encoding = self.server._marshaled_dispatch(data,
+                        self.client_address[0]), None
         except: 
             raise
             self.send_response(500)
             self.end_headers()
         else:
             # got a valid XML RPC response
+            if not getattr(self.server, 'keep_alive', False):
+                self.close_connection = 1
             self.send_response(200)
-            self.send_header("Content-type", "text/xml")
+            if encoding is None:
+                self.send_header("Content-type", "text/xml")
+            else:
+                self.send_header("Content-type", "application/json")
+                self.send_header(ENCODING_HEADER, encoding)
             self.send_header("Content-length", str(len(response)))
+            if self.close_connection:
+                self.send_header("Connection", "close")
             self.end_headers()
             self.wfile.write(response)
-
-            # shut down the connection
             self.wfile.flush()
-            self.connection.shutdown(1)
+
+            # shut down the connection unless the client will reuse it
+            if self.close_connection:
+                self.connection.shutdown(1)
    
 
 class BaseXMLRPCServer (SSLServer, CobaltXMLRPCDispatcher, object):
@@ -298,6 +362,10 @@ class BaseXMLRPCServer (SSLServer, CobaltXMLRPCDispatcher, object):
     require_auth -- the request handler is requiring authorization
     credentials -- valid credentials being used for authentication
     """
+
+    # requests are handled one at a time, so an idle persistent connection
+    # would stall every other client
+    keep_alive = False
     
     def __init__ (self, server_address, RequestHandlerClass=None,
                   keyfile=None, certfile=None,
@@ -396,7 +464,10 @@ class BaseXMLRPCServer (SSLServer, CobaltXMLRPCDispatcher, object):
                         self.instance.do_tasks()
                 except:
                     self.logger.error("Unexpected task failure", exc_info=1)
-                Cobalt.Util.sleep(self.timeout)
+                if self.instance and hasattr(self.instance, 'wait_for_tasks'):
+                    self.instance.wait_for_tasks(self.timeout)
+                else:
+                    Cobalt.Util.sleep(self.timeout)
         except:
             self.logger.error("tasks_thread failed", exc_info=1)
     
@@ -437,7 +508,11 @@ class BaseXMLRPCServer (SSLServer, CobaltXMLRPCDispatcher, object):
         try:
             while self.serve:
                 try:
-                    self.handle_request()
+                    wakeup_fd = getattr(self.instance, 'wakeup_fd', None)
+                    if wakeup_fd is None:
+                        self.handle_request()
+                    else:
+                        self._handle_request_or_wakeup(wakeup_fd)
                 except socket.timeout:
                     pass
                 except:
@@ -460,6 +535,25 @@ class BaseXMLRPCServer (SSLServer, CobaltXMLRPCDispatcher, object):
         finally:
             self.logger.info("serve_forever() [stop]")
     
+    def _handle_request_or_wakeup (self, wakeup_fd):
+        """Wait for a request or for the instance's wakeup fd, whichever comes first.
+
+        Components with work that is triggered outside of XML-RPC (the forkers
+        reaping children on SIGCHLD) expose a readable wakeup_fd and a wakeup()
+        method, so that the work is done straight away instead of on the next
+        pass of the loop.
+        """
+        try:
+            readable = select.select([self, wakeup_fd], [], [], self.timeout)[0]
+        except select.error, e:
+            if e.args[0] != errno.EINTR:
+                raise
+            readable = []
+        if self in readable:
+            self._handle_request_noblock()
+        if wakeup_fd in readable:
+            self.instance.wakeup()
+
     def shutdown (self):
         """Signal that automatic service should stop."""
         self.serve = False
@@ -474,6 +568,8 @@ class BaseXMLRPCServer (SSLServer, CobaltXMLRPCDispatcher, object):
 
 
 class XMLRPCServer (SocketServer.ThreadingMixIn, BaseXMLRPCServer): 
+
+    keep_alive = True
     
     def __init__ (self, server_address, RequestHandlerClass=None,
                   keyfile=None, certfile=None,
@@ -518,7 +614,10 @@ class XMLRPCServer (SocketServer.ThreadingMixIn, BaseXMLRPCServer):
                         self.instance.do_tasks()
                 except:
                     self.logger.error("Unexpected task failure", exc_info=1)
-                Cobalt.Util.sleep(self.timeout)
+                if self.instance and hasattr(self.instance, 'wait_for_tasks'):
+                    self.instance.wait_for_tasks(self.timeout)
+                else:
+                    Cobalt.Util.sleep(self.timeout)
         except:
             self.logger.error("tasks_thread failed", exc_info=1)
     
@@ -543,4 +642,109 @@ class XMLRPCServer (SocketServer.ThreadingMixIn, BaseXMLRPCServer):
                                       exc_info=1)
         finally:
             self.logger.info("serve_forever() [stop]")
-    
+
+
+class PooledXMLRPCServer (XMLRPCServer):
+
+    """Component XMLRPCServer handling requests on a fixed pool of threads.
+
+    Accepted connections wait in a queue of at most backlog entries for one
+    of the worker threads.  While the queue is full no further connections
+    are accepted, so new clients wait in the listen queue instead of each
+    getting a thread of its own.  A connection left waiting longer than
+    queue_timeout seconds is dropped unanswered, as its client has most
+    likely given up on it.  The SSL handshake is done by the worker, so a
+    slow client only holds up its own request.  Automatic tasks run on a
+    thread of their own, as for XMLRPCServer.
+    """
+
+    handshake_on_accept = False
+
+    def __init__ (self, server_address, RequestHandlerClass=None,
+                  keyfile=None, certfile=None,
+                  timeout=10,
+                  logRequests=False,
+                  register=True, allow_none=True, encoding=None, cafile=None,
+                  workers=8, backlog=None, queue_timeout=60):
+
+        XMLRPCServer.__init__(self, server_address, RequestHandlerClass, keyfile,
+                              certfile, timeout, logRequests, register, allow_none,
+                              encoding, cafile=cafile)
+        if backlog is None:
+            backlog = 4 * workers
+        self.workers = workers
+        self.backlog = backlog
+        self.queue_timeout = queue_timeout
+        self.worker_threads = []
+        self._requests = Queue.Queue(backlog)
+        self._idle_lock = threading.Lock()
+        self._idle_workers = 0
+
+    def _get_keep_alive (self):
+        # a persistent connection ties up a worker between requests, so only
+        # allow one while another worker is free to take new clients
+        return self._idle_workers > 0
+    keep_alive = property(_get_keep_alive)
+
+    def _get_queued_requests (self):
+        return self._requests.qsize()
+    queued_requests = property(_get_queued_requests)
+
+    def process_request (self, request, client_address):
+        """Queue an accepted connection for the worker threads."""
+        item = (request, client_address, time.time())
+        while True:
+            try:
+                self._requests.put(item, True, self.timeout)
+                return
+            except Queue.Full:
+                if not self.serve:
+                    self.close_request(request)
+                    return
+                self.logger.warning("all %d workers busy and %d requests queued",
+                                    self.workers, self.backlog)
+
+    def _set_idle (self, change):
+        self._idle_lock.acquire()
+        try:
+            self._idle_workers += change
+        finally:
+            self._idle_lock.release()
+
+    def _worker_thread (self):
+        while self.serve:
+            self._set_idle(1)
+            try:
+                request, client_address, queued = self._requests.get(True, self.timeout)
+            except Queue.Empty:
+                self._set_idle(-1)
+                continue
+            self._set_idle(-1)
+            try:
+                waited = time.time() - queued
+                if waited > self.queue_timeout:
+                    self.logger.warning("dropping request from %s after %.1f seconds in queue",
+                                        client_address[0], waited)
+                else:
+                    request.do_handshake()
+                    self.finish_request(request, client_address)
+            except:
+                self.logger.error("Got unexpected error handling request from %s",
+                                  client_address[0], exc_info=1)
+            self.close_request(request)
+
+    def serve_forever (self):
+        """Serve requests on the worker threads until (self.serve == False)."""
+        self.serve = True
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._worker_thread,
+                                      name="worker-%d" % index)
+            thread.setDaemon(True)
+            thread.start()
+            self.worker_threads.append(thread)
+        try:
+            XMLRPCServer.serve_forever(self)
+        finally:
+            self.serve = False
+            for thread in self.worker_threads:
+                thread.join()
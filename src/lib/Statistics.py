@@ -1,3 +1,7 @@
+import math
+import threading
+import time
+
 
 class Statistic(object):
     def __init__(self, name, initial_value):
@@ -21,13 +25,180 @@ class Statistic(object):
 class Statistics(object):
     def __init__(self):
         self.data = dict()
+        self.lock = threading.Lock()
 
     def add_value(self, name, value):
-        if name not in self.data:
-            self.data[name] = Statistic(name, value)
-        else:
-            self.data[name].add_value(value)
+        self.lock.acquire()
+        try:
+            if name not in self.data:
+                self.data[name] = Statistic(name, value)
+            else:
+                self.data[name].add_value(value)
+        finally:
+            self.lock.release()
 
     def display(self):
         return dict([value.get_value() for value in self.data.values()])
             
+
+class LatencyHistogram(object):
+    '''Fixed-size log-scale histogram of durations in seconds.
+
+    Bucket i counts values up to floor * growth**i, so memory use does not
+    depend on how many values are added.  Percentiles are reported as the
+    upper edge of the bucket they fall in, capped at the largest value seen;
+    the last bucket also holds everything larger and reports that maximum.
+    '''
+    floor = 1e-5
+    growth = 2 ** 0.5
+    bucket_count = 56
+
+    def __init__(self):
+        self.buckets = [0] * self.bucket_count
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add_value(self, value):
+        if value <= self.floor:
+            index = 0
+        else:
+            index = min(int(math.ceil(math.log(value / self.floor, self.growth))),
+                    self.bucket_count - 1)
+        self.buckets[index] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        for index, count in enumerate(other.buckets):
+            self.buckets[index] += count
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None or other.max > self.max):
+            self.max = other.max
+
+    def percentile(self, fraction):
+        if not self.count:
+            return 0.0
+        rank = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank and count:
+                if index == self.bucket_count - 1:
+                    break
+                return min(self.floor * self.growth ** index, self.max)
+        return self.max
+
+    def summary(self):
+        if not self.count:
+            return {'count':0}
+        return {'count':self.count, 'total':self.total, 'min':self.min,
+                'max':self.max, 'ave':self.total / self.count,
+                'p50':self.percentile(0.5), 'p90':self.percentile(0.9),
+                'p99':self.percentile(0.99)}
+
+class ProfileSlot(object):
+    '''Everything recorded by a CallProfile during one slot of its window.'''
+    def __init__(self, start):
+        self.start = start
+        self.calls = {}
+        self.callers = {}
+        self.lock_wait = {}
+        self.lock_held = {}
+
+class CallProfile(object):
+    '''Per-method latency, caller and component lock profile over a sliding
+    window.
+
+    The window is split into slots; recording goes to the newest slot and
+    slots older than the window are dropped, so memory is bounded by the
+    number of distinct method and caller names.  Lock wait time is charged
+    to the method that held the lock while the caller waited, and lock hold
+    time to the method that held it.  CallProfile has its own lock and may
+    be used without holding the component lock.
+    '''
+    def __init__(self, window=300, slots=10):
+        self.window = float(window)
+        self.slot_length = self.window / slots
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.lock.acquire()
+        try:
+            self.slots = [ProfileSlot(time.time())]
+        finally:
+            self.lock.release()
+
+    def _current_slot(self, now):
+        '''Get the slot for now, rotating out expired slots.  Call with
+        self.lock held.'''
+        slot = self.slots[-1]
+        if now - slot.start >= self.slot_length:
+            slot = ProfileSlot(now)
+            self.slots.append(slot)
+            self.slots = [s for s in self.slots if now - s.start < self.window]
+        return slot
+
+    def _add(self, table, name, value):
+        self.lock.acquire()
+        try:
+            histograms = getattr(self._current_slot(time.time()), table)
+            if name not in histograms:
+                histograms[name] = LatencyHistogram()
+            histograms[name].add_value(value)
+        finally:
+            self.lock.release()
+
+    def add_call(self, method, elapsed, caller=None):
+        self.lock.acquire()
+        try:
+            slot = self._current_slot(time.time())
+            if method not in slot.calls:
+                slot.calls[method] = LatencyHistogram()
+            slot.calls[method].add_value(elapsed)
+            key = (str(caller), method)
+            slot.callers[key] = slot.callers.get(key, 0) + 1
+        finally:
+            self.lock.release()
+
+    def add_lock_wait(self, holder, waited):
+        self._add('lock_wait', str(holder), waited)
+
+    def add_lock_held(self, holder, held):
+        self._add('lock_held', str(holder), held)
+
+    def dump(self):
+        '''Merge the slots in the window into a marshallable dictionary.'''
+        self.lock.acquire()
+        try:
+            now = time.time()
+            self._current_slot(now)
+            slots = [s for s in self.slots if now - s.start < self.window]
+            merged = {'calls':{}, 'lock_wait':{}, 'lock_held':{}}
+            callers = {}
+            for slot in slots:
+                for table, histograms in merged.iteritems():
+                    for name, histogram in getattr(slot, table).iteritems():
+                        if name not in histograms:
+                            histograms[name] = LatencyHistogram()
+                        histograms[name].merge(histogram)
+                for (caller, method), count in slot.callers.iteritems():
+                    methods = callers.setdefault(caller, {})
+                    methods[method] = methods.get(method, 0) + count
+        finally:
+            self.lock.release()
+        result = {'window':self.window, 'since':min([s.start for s in slots]),
+                  'callers':callers}
+        for table, histograms in merged.iteritems():
+            result[table] = dict([(name, histogram.summary())
+                for name, histogram in histograms.iteritems()])
+        return result
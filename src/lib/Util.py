@@ -21,7 +21,7 @@ from getopt import getopt, GetoptError
 from Cobalt.Exceptions import TimeFormatError, TimerException, ThreadPickledAliveException
 from Cobalt.Exceptions import JobValidationError
 import logging
-from threading import Thread
+from threading import Thread, Condition, Lock
 from Queue import Queue
 import inspect
 import re
@@ -657,6 +657,66 @@ class Timer (object):
 
     elapsed_times = property(__get_elapsed_times, doc = "list of elapsed times")
 
+class ReadWriteLock (object):
+    '''A lock that many readers may hold at once, or a single writer.
+
+    Writers are preferred: once a writer is waiting, new readers wait
+    behind it, so a steady stream of readers cannot starve it.  The lock is
+    not reentrant.  acquire and release are the writer operations, so this
+    can stand in for a threading.Lock.
+    '''
+    def __init__(self):
+        self.__cond = Condition(Lock())
+        self.__readers = 0
+        self.__writer = False
+        self.__writers_waiting = 0
+
+    def acquire_read(self):
+        '''acquire a shared lock'''
+        self.__cond.acquire()
+        try:
+            while self.__writer or self.__writers_waiting:
+                self.__cond.wait()
+            self.__readers += 1
+        finally:
+            self.__cond.release()
+
+    def release_read(self):
+        '''release a shared lock'''
+        self.__cond.acquire()
+        try:
+            self.__readers -= 1
+            if self.__readers == 0:
+                self.__cond.notifyAll()
+        finally:
+            self.__cond.release()
+
+    def acquire(self):
+        '''acquire the exclusive lock'''
+        self.__cond.acquire()
+        try:
+            self.__writers_waiting += 1
+            while self.__writer or self.__readers:
+                self.__cond.wait()
+            self.__writers_waiting -= 1
+            self.__writer = True
+        finally:
+            self.__cond.release()
+
+    def release(self):
+        '''release the exclusive lock'''
+        self.__cond.acquire()
+        try:
+            self.__writer = False
+            self.__cond.notifyAll()
+        finally:
+            self.__cond.release()
+
+    def __get_readers(self):
+        return self.__readers
+
+    readers = property(__get_readers, doc = "number of shared holders")
+
 def getattrname(clsname, attrname):
     '''return mangled private attribute names so that they may be looked up in the dictionary or using getattr()'''
     if attrname[0:2] != "__" or attrname[-2:] == "__":
@@ -1,6 +1,15 @@
 import logging
+import os
+import shutil
+import tempfile
+import cPickle
 
-from Cobalt.Components.base import Component, exposed, automatic
+from mock import patch
+
+from Cobalt.Components.base import Component, exposed, automatic, locking, readonly
+from Cobalt.Data import Data
+from Cobalt.Journal import read_journal
+import threading
 import Cobalt.Proxy
 import time, random
 from TestCobalt.Utilities.Time import timeout
@@ -33,8 +42,8 @@ class TestComponent (object):
         assert component.method2.exposed
         assert not getattr(component.method3, "exposed", False)
         exposed_methods = component.listMethods()
-        assert set(exposed_methods) == set(['get_implementation', 'get_name', 'get_statistics', 'listMethods', 'method1',
-            'method2', 'methodHelp', 'save'])
+        assert set(exposed_methods) == set(['get_implementation', 'get_name', 'get_profile', 'get_statistics',
+            'listMethods', 'method1', 'method2', 'methodHelp', 'reset_profile', 'save'])
         assert component._dispatch("method1", (), {}) == "return1"
         assert component._dispatch("method2", (), {}) == "return2"
         try:
@@ -67,3 +76,339 @@ class TestComponent (object):
         while len(component.m4data) > 1:
             assert component.m4data[1] - component.m4data[0] > 4
             component.m4data = component.m4data[1:]
+
+    def test_wake_task (self):
+
+        class TestComponent (Component):
+
+            runs = []
+
+            def method (self):
+                self.runs.append(time.time())
+            method = automatic(method, 3600)
+
+        component = TestComponent()
+        component.do_tasks()
+        assert len(component.runs) == 1
+        component.do_tasks()
+        assert len(component.runs) == 1
+        component.wake_task('method')
+        component.wake_task('method')
+        component.do_tasks()
+        assert len(component.runs) == 2
+        component.do_tasks()
+        assert len(component.runs) == 2
+
+    def test_wake_task_min_spacing (self):
+
+        class TestComponent (Component):
+
+            runs = []
+
+            def method (self):
+                self.runs.append(time.time())
+            method = automatic(method, 3600, 0.5)
+
+        component = TestComponent()
+        component.do_tasks()
+        component.wake_task('method')
+        component.do_tasks()
+        assert len(component.runs) == 1
+        start = time.time()
+        component.wait_for_tasks(10)
+        assert time.time() - start < 5
+        component.do_tasks()
+        assert len(component.runs) == 2
+        assert component.runs[1] - component.runs[0] >= 0.5
+
+    def test_wake_task_not_automatic (self):
+        component = Component()
+        try:
+            component.wake_task('save')
+        except ValueError:
+            pass
+        else:
+            assert not "woke a method that is not automatic"
+
+    def test_notify_scheduler (self):
+
+        class TestScheduler (Component):
+
+            name = "scheduler"
+            reasons = []
+
+            def wake_scheduler (self, reason=None):
+                self.reasons.append(reason)
+            wake_scheduler = exposed(wake_scheduler)
+
+        scheduler = TestScheduler()
+        component = Component(register=False)
+        component.do_tasks()
+        assert scheduler.reasons == []
+        component.notify_scheduler("job added")
+        component.notify_scheduler("job ended")
+        component.notify_scheduler("job added")
+        component.do_tasks()
+        assert scheduler.reasons == ["job added, job ended"]
+        component.do_tasks()
+        assert len(scheduler.reasons) == 1
+
+    def test_profile (self):
+
+        class TestComponent (Component):
+
+            def method1 (self):
+                return "return1"
+            method1 = exposed(method1)
+
+            def method2 (self):
+                return "return2"
+            method2 = locking(exposed(method2))
+
+        component = TestComponent()
+        component._dispatch("method1", (), {}, "10.0.0.1")
+        component._dispatch("method1", (), {}, "10.0.0.1")
+        component._dispatch("method2", (), {})
+        profile = component._dispatch("get_profile", (True,), {})
+        assert profile['calls']['method1']['count'] == 2
+        assert profile['calls']['method2']['count'] == 1
+        assert profile['callers']['10.0.0.1'] == {'method1':2}
+        assert profile['callers']['local'] == {'method2':1}
+        assert profile['lock_held']['method1']['count'] == 2
+        assert profile['lock_held']['method2']['count'] == 1
+        profile = component.get_profile()
+        assert profile['calls'].keys() == ['get_profile']
+
+    def test_readonly (self):
+
+        class TestComponent (Component):
+
+            inside = []
+            release = threading.Event()
+
+            def read (self):
+                self.inside.append('read')
+                self.release.wait(5)
+                return 'read'
+            read = readonly(exposed(read))
+
+            def write (self):
+                self.inside.append('write')
+                return 'write'
+            write = exposed(write)
+
+        component = TestComponent()
+        readers = []
+        for i in range(2):
+            reader = threading.Thread(target=component._dispatch, args=("read", (), {}))
+            reader.setDaemon(True)
+            reader.start()
+            readers.append(reader)
+        time.sleep(0.2)
+        assert component.inside == ['read', 'read']
+        writer = threading.Thread(target=component._dispatch, args=("write", (), {}))
+        writer.setDaemon(True)
+        writer.start()
+        writer.join(0.2)
+        assert component.inside == ['read', 'read']
+        component.release.set()
+        writer.join(5)
+        for reader in readers:
+            reader.join(5)
+        assert component.inside == ['read', 'read', 'write']
+        profile = component.get_profile()
+        assert profile['lock_held']['read (read)']['count'] == 2
+
+    def test_multicall (self):
+
+        class TestComponent (Component):
+
+            locked = []
+
+            def read (self, value):
+                self.locked.append(self._component_lock.readers)
+                return value
+            read = readonly(exposed(read))
+
+            def write (self, value):
+                self.locked.append(self._component_lock_holder)
+                return value * 2
+            write = exposed(write)
+
+            def fail (self):
+                raise ValueError("failed")
+            fail = exposed(fail)
+
+            def free (self):
+                self.locked.append(self._component_lock_holder)
+            free = locking(exposed(free))
+
+        component = TestComponent()
+        results = component._dispatch_multicall([
+            {'methodName':'write', 'params':(1,)},
+            {'methodName':'fail', 'params':()},
+            {'methodName':'free', 'params':()},
+            {'methodName':'write', 'params':(2,)},
+            {'methodName':'missing', 'params':()},
+        ], {})
+        assert results[0] == [2]
+        assert results[1]['faultString'] == "failed"
+        assert results[2] == [None]
+        assert results[3] == [4]
+        assert 'faultCode' in results[4]
+        assert component.locked == ["system.multicall", None, "system.multicall"]
+        assert component._component_lock_holder is None
+
+        component.locked = []
+        results = component._dispatch_multicall([
+            {'methodName':'read', 'params':(1,)},
+            {'methodName':'read', 'params':(2,)},
+        ], {})
+        assert results == [[1], [2]]
+        assert component.locked == [1, 1]
+        assert component.get_profile()['calls']['read']['count'] == 2
+
+
+class JournaledItem (Data):
+
+    fields = Data.fields + ["name", "state", "score", "nodes"]
+    versioned = True
+
+    def __init__ (self, spec):
+        Data.__init__(self, spec)
+        self.name = spec['name']
+        self.state = spec.get('state', "idle")
+        self.score = spec.get('score', 0)
+        self.nodes = spec.get('nodes', [])
+
+
+class JournaledComponent (Component):
+
+    name = "journaled"
+    journal_delta_fields = {'items':['score']}
+
+    def __init__ (self, *args, **kwargs):
+        Component.__init__(self, *args, **kwargs)
+        self.items = {}
+        self.counter = 0
+
+    def __getstate__ (self):
+        state = Component.__getstate__(self)
+        state.update({'items':self.items, 'counter':self.counter})
+        return state
+
+    def __setstate__ (self, state):
+        Component.__setstate__(self, state)
+        self.items = state['items']
+        self.counter = state['counter']
+
+    def journal_collections (self):
+        return {'items':self.items}
+
+    def journal_replace (self, collection, key, item):
+        if item is None:
+            del self.items[key]
+        else:
+            self.items[key] = item
+
+    def journal_extra (self):
+        return {'counter':self.counter}
+
+    def journal_restore_extra (self, extra):
+        self.counter = extra['counter']
+
+
+class TestJournaledSave (object):
+
+    def setup (self):
+        self.directory = tempfile.mkdtemp()
+        self.statefile = os.path.join(self.directory, "journaled")
+        self.settings = {'sync':'never', 'sync_interval':5, 'compact_interval':300,
+                         'compact_size':1048576}
+        self.patcher = patch('Cobalt.Components.base.get_journal_settings',
+                             lambda: self.settings)
+        self.patcher.start()
+        self.component = JournaledComponent(register=False, statefile=self.statefile)
+        for name in ["a", "b", "c"]:
+            self.component.items[name] = JournaledItem({'name':name})
+
+    def teardown (self):
+        self.patcher.stop()
+        shutil.rmtree(self.directory)
+        Cobalt.Proxy.local_components.clear()
+
+    def load (self):
+        component = cPickle.load(open(self.statefile))
+        component.statefile = self.statefile
+        component.replay_journal()
+        return component
+
+    def test_journal_replay (self):
+        self.component.save()
+        snapshot = os.path.getmtime(self.statefile), os.path.getsize(self.statefile)
+        self.component.items["a"].score = 5
+        self.component.items["b"].state = "busy"
+        del self.component.items["c"]
+        self.component.items["d"] = JournaledItem({'name':"d"})
+        self.component.counter = 7
+        assert self.component.save().startswith("5 changes")
+        assert self.component.save() == "no changes to journal"
+        assert (os.path.getmtime(self.statefile), os.path.getsize(self.statefile)) == snapshot
+
+        component = self.load()
+        assert sorted(component.items.keys()) == ["a", "b", "d"]
+        assert component.items["a"].score == 5
+        assert component.items["b"].state == "busy"
+        assert component.counter == 7
+
+    def test_delta_fields (self):
+        self.component.save()
+        self.component.items["a"].score = 1
+        self.component.save()
+        self.component.items["a"].score = 2
+        self.component.items["b"].score = 3
+        self.component.save()
+        generation, batches = read_journal(self.statefile + ".journal")
+        assert batches[0] == [('set', 'items', "a", {'score':1})]
+        assert sorted(batches[1]) == [('set', 'items', "a", {'score':2}),
+                                      ('set', 'items', "b", {'score':3})]
+
+    def test_changed_in_place (self):
+        self.component.save()
+        self.component.items["a"].nodes.append("n1")
+        assert self.component.save().startswith("1 changes")
+        assert self.component.save() == "no changes to journal"
+        self.component.items["a"].nodes.append("n2")
+        self.component.save()
+        component = self.load()
+        assert component.items["a"].nodes == ["n1", "n2"]
+        assert component.items["b"].nodes == []
+
+    def test_compaction (self):
+        self.component.save()
+        self.component.items["a"].state = "busy"
+        self.component.save()
+        self.settings['compact_interval'] = -1
+        self.component.items["b"].state = "busy"
+        assert self.component.save().startswith("state saved")
+        assert read_journal(self.statefile + ".journal") == (2, [])
+        component = self.load()
+        assert component.items["b"].state == "busy"
+
+    def test_stale_journal_ignored (self):
+        self.component.save()
+        self.component.items["a"].state = "busy"
+        self.component.save()
+        stale = open(self.statefile + ".journal", "rb").read()
+        self.component.journal_snapshot()
+        self.component.items["a"].state = "done"
+        self.component.save()
+        open(self.statefile + ".journal", "wb").write(stale)
+        component = self.load()
+        assert component.items["a"].state == "done"
+
+    def test_disabled (self):
+        self.settings = None
+        self.component.save()
+        assert not os.path.exists(self.statefile + ".journal")
+        assert os.path.exists(self.statefile)
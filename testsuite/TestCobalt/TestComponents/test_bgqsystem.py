@@ -4,6 +4,7 @@ Mock is required for this set of tests to work
 
 """
 
+import time
 from mock import MagicMock, Mock, patch
 
 pybgsched_mock = Mock()
@@ -257,3 +258,403 @@ class TestBGQSystem(object):
         drain_block = self.bgqsystem._find_drain_block(job)
         assert drain_block is None, 'drain_block not None'
 
+
+
+class TestBlockSnapshots(object):
+    '''Tests for the scheduling snapshots taken by find_job_location.'''
+
+    def setup(self):
+        BGSystem.configure = MagicMock(name='configure')
+        BGSystem.update_block_state = MagicMock(name='update_block_state')
+        self.bgqsystem = BGSystem()
+        node_cards = [Cobalt.Components.bgq_base_system.NodeCard('R00-M0-N%02d' % i) for i in range(4)]
+        self.add_block('BIG', node_cards, 128)
+        self.add_block('LEFT', node_cards[:2], 64)
+        self.add_block('RIGHT', node_cards[2:], 64)
+        self.bgqsystem.update_relatives()
+
+    def add_block(self, name, node_cards, size):
+        block = Cobalt.Components.bgq_base_system.Block({'name': name, 'size': size,
+            'node_cards': node_cards, 'block_type': 'normal', 'queue': 'default'})
+        self.bgqsystem._blocks[name] = block
+        self.bgqsystem._managed_blocks.add(name)
+
+    def test_snapshot_relatives(self):
+        snapshots, changed = self.bgqsystem._snapshot_blocks()
+        assert sorted(snapshots.keys()) == ['BIG', 'LEFT', 'RIGHT'], "Bad snapshot keys %s" % snapshots.keys()
+        assert snapshots['BIG']._children == set([snapshots['LEFT'], snapshots['RIGHT']]), \
+                "Bad children %s" % snapshots['BIG']._children
+        assert snapshots['LEFT'].parents == ['BIG'], "Bad parents %s" % snapshots['LEFT'].parents
+        assert snapshots['LEFT'].relatives == ['BIG'], "Bad relatives %s" % snapshots['LEFT'].relatives
+
+    def test_snapshot_refreshes_changed_blocks_only(self):
+        snapshots, changed = self.bgqsystem._snapshot_blocks()
+        left = snapshots['LEFT']
+        snapshots['BIG'].state = 'stale'
+        self.bgqsystem._blocks['LEFT'].state = 'busy'
+        snapshots, changed = self.bgqsystem._snapshot_blocks()
+        assert snapshots['LEFT'] is left, "Snapshot was replaced rather than refreshed"
+        assert left.state == 'busy', "Changed block not refreshed: %s" % left.state
+        assert snapshots['BIG'].state == 'stale', "Unchanged block was recopied"
+        assert changed == set(['LEFT']), "Bad changed blocks %s" % changed
+
+    def test_snapshot_does_not_share_block_state(self):
+        snapshots, changed = self.bgqsystem._snapshot_blocks()
+        snapshots['LEFT'].backfill_time = 100.0
+        snapshots['LEFT'].node_geometry.append(1)
+        assert self.bgqsystem._blocks['LEFT'].backfill_time is None, "Snapshot wrote through to block"
+        assert self.bgqsystem._blocks['LEFT'].node_geometry != snapshots['LEFT'].node_geometry, \
+                "Snapshot shares node_geometry with block"
+
+    def test_snapshot_drops_unmanaged_blocks(self):
+        snapshots, changed = self.bgqsystem._snapshot_blocks()
+        self.bgqsystem._managed_blocks.remove('RIGHT')
+        self.bgqsystem.update_relatives()
+        snapshots, changed = self.bgqsystem._snapshot_blocks()
+        assert 'RIGHT' not in snapshots, "Unmanaged block still in snapshot"
+        assert snapshots['BIG']._children == set([snapshots['LEFT']]), \
+                "Bad children %s" % snapshots['BIG']._children
+
+
+def populate_blocks(bgqsystem):
+    '''Populate bgqsystem with a small unmanaged block layout:
+
+       FULL covers all eight node cards, A and B each half of it, A1 and A2
+       each half of A.  PT sits on B's last two node cards and passes
+       through A2.
+
+    '''
+    nc = [Cobalt.Components.bgq_base_system.NodeCard('R00-M0-N%02d' % i) for i in range(8)]
+    for name, node_cards, size, pt in [('FULL', nc, 256, []),
+                                       ('A', nc[:4], 128, []),
+                                       ('B', nc[4:], 128, []),
+                                       ('A1', nc[:2], 64, []),
+                                       ('A2', nc[2:4], 64, []),
+                                       ('PT', nc[6:], 64, [nc[2]])]:
+        bgqsystem._blocks[name] = Cobalt.Components.bgq_base_system.Block({'name': name, 'size': size,
+            'node_cards': node_cards, 'passthrough_node_cards': pt, 'block_type': 'normal',
+            'queue': 'default', 'scheduled': True, 'functional': True})
+
+
+class TestUpdateRelatives(object):
+    '''Tests for the node card indexed update_relatives.'''
+
+    def setup(self):
+        BGSystem.configure = MagicMock(name='configure')
+        BGSystem.update_block_state = MagicMock(name='update_block_state')
+        self.bgqsystem = BGSystem()
+        populate_blocks(self.bgqsystem)
+
+    def relations(self):
+        ret = {}
+        for name in self.bgqsystem._managed_blocks:
+            b = self.bgqsystem._blocks[name]
+            ret[name] = (sorted(b.relatives), sorted([p.name for p in b._parents]),
+                    sorted([c.name for c in b._children]), sorted(b.passthrough_blocks))
+        return ret
+
+    def rebuilt_relations(self):
+        self.bgqsystem.update_relatives()
+        return self.relations()
+
+    def test_full_rebuild(self):
+        self.bgqsystem._managed_blocks.update(self.bgqsystem._blocks.keys())
+        relations = self.rebuilt_relations()
+        assert relations['FULL'] == (['A', 'A1', 'A2', 'B', 'PT'], [], ['A', 'A1', 'A2', 'B', 'PT'], []), \
+                "Bad FULL relations %s" % (relations['FULL'],)
+        assert relations['A1'] == (['A', 'FULL'], ['A', 'FULL'], [], []), "Bad A1 relations %s" % (relations['A1'],)
+        assert relations['PT'] == (['B', 'FULL'], ['B', 'FULL'], [], ['A', 'A2']), \
+                "Bad PT relations %s" % (relations['PT'],)
+        assert relations['A2'][3] == ['PT'], "Bad A2 passthrough %s" % (relations['A2'][3],)
+
+    def test_incremental_add_matches_rebuild(self):
+        for name in ['A1', 'PT', 'FULL', 'A', 'B', 'A2']:
+            self.bgqsystem.add_blocks([{'name': name}])
+        relations = self.relations()
+        expected = self.rebuilt_relations()
+        assert relations == expected, "Incremental relations %s do not match rebuild %s" % (relations, expected)
+
+    def test_incremental_del_matches_rebuild(self):
+        self.bgqsystem.add_blocks([{'name': name} for name in self.bgqsystem._blocks.keys()])
+        self.bgqsystem.del_blocks([{'name': 'A'}, {'name': 'A2'}])
+        relations = self.relations()
+        assert 'A' not in relations['FULL'][0], "Deleted block still a relative"
+        assert relations['PT'][3] == [], "Deleted block still a passthrough block %s" % (relations['PT'][3],)
+        expected = self.rebuilt_relations()
+        assert relations == expected, "Incremental relations %s do not match rebuild %s" % (relations, expected)
+
+    def test_wiring_conflicts_are_relatives(self):
+        self.bgqsystem._blocks['A']._wiring_conflicts.add('B')
+        self.bgqsystem._blocks['B']._wiring_conflicts.add('A')
+        self.bgqsystem.add_blocks([{'name': 'A'}])
+        self.bgqsystem.add_blocks([{'name': 'B'}])
+        assert self.bgqsystem._blocks['A'].relatives == ['B'], "Wiring conflict not a relative"
+        assert self.relations() == self.rebuilt_relations(), "Incremental wiring relations do not match rebuild"
+
+
+class TestLocationsCache(object):
+    '''Tests for the incrementally maintained locations cache.'''
+
+    def setup(self):
+        BGSystem.configure = MagicMock(name='configure')
+        BGSystem.update_block_state = MagicMock(name='update_block_state')
+        self.bgqsystem = BGSystem()
+        populate_blocks(self.bgqsystem)
+        self.bgqsystem._blocks['A1'].queue = 'default:short'
+        self.bgqsystem._managed_blocks.update(self.bgqsystem._blocks.keys())
+        self.bgqsystem.update_relatives()
+        self.refresh_cache()
+
+    def refresh_cache(self):
+        self.bgqsystem.cached_blocks, changed = self.bgqsystem._snapshot_blocks()
+        self.bgqsystem._build_locations_cache(changed)
+
+    def cache_contents(self):
+        locations = {}
+        for q_name, by_size in self.bgqsystem._locations_cache.iteritems():
+            for size, blocks in by_size.iteritems():
+                locations[(q_name, size)] = sorted(blocks.keys())
+        return (locations, self.bgqsystem._defined_sizes, sorted(self.bgqsystem._not_functional_set))
+
+    def rebuilt_contents(self):
+        self.bgqsystem._build_locations_cache()
+        return self.cache_contents()
+
+    def test_initial_cache(self):
+        locations, defined_sizes, not_functional = self.cache_contents()
+        assert defined_sizes == {'default': [64, 128, 256], 'short': [64]}, "Bad defined sizes %s" % defined_sizes
+        assert locations[('default', 64)] == ['A1', 'A2', 'PT'], "Bad locations %s" % locations
+        assert locations[('short', 64)] == ['A1'], "Bad locations %s" % locations
+        assert not_functional == [], "Bad not functional set %s" % not_functional
+
+    def test_not_functional_propagates_to_relatives(self):
+        self.bgqsystem._blocks['A'].functional = False
+        self.refresh_cache()
+        contents = self.cache_contents()
+        locations, defined_sizes, not_functional = contents
+        assert not_functional == ['A', 'A1', 'A2', 'FULL'], "Bad not functional set %s" % not_functional
+        assert locations[('default', 64)] == ['PT'], "Bad locations %s" % locations
+        assert contents == self.rebuilt_contents(), "Incremental cache does not match rebuild"
+
+    def test_changes_match_rebuild(self):
+        self.bgqsystem._blocks['A'].functional = False
+        self.refresh_cache()
+        self.bgqsystem._blocks['A'].functional = True
+        self.bgqsystem._blocks['B'].state = 'error'
+        self.bgqsystem._blocks['A2'].queue = 'short'
+        self.bgqsystem._blocks['PT'].scheduled = False
+        self.bgqsystem.offline_blocks = ['A1']
+        self.refresh_cache()
+        contents = self.cache_contents()
+        locations, defined_sizes, not_functional = contents
+        assert locations == {('default', 256): ['FULL'], ('default', 128): ['A'], ('short', 64): ['A2']}, \
+                "Bad locations %s" % locations
+        assert contents == self.rebuilt_contents(), "Incremental cache does not match rebuild"
+
+    def test_possible_locations(self):
+        locations = self.bgqsystem.possible_locations(100, 'default')
+        assert sorted([b.name for b in locations]) == ['A', 'B'], "Bad possible locations %s" % locations
+        assert self.bgqsystem.possible_locations(1, 'nosuchqueue') == [], "Locations for unknown queue"
+
+
+class TestBlockStateRecompute(object):
+    '''Tests for recomputing only the block states whose inputs changed.'''
+
+    def setup(self):
+        BGSystem.configure = MagicMock(name='configure')
+        BGSystem.update_block_state = MagicMock(name='update_block_state')
+        self.bgqsystem = BGSystem()
+        populate_blocks(self.bgqsystem)
+        self.bgqsystem._managed_blocks.update(self.bgqsystem._blocks.keys())
+        self.bgqsystem.update_relatives()
+        self.bgqsystem.booter = MagicMock(name='booter')
+        self.bgqsystem.booter.pending_boots = []
+        self.bgqsystem.booter.fetch_queued_messages.return_value = []
+        self.bgqsystem.io_link_to_mp_dict = {}
+        self.bad_node_cards = set()
+        self.bgqsystem.get_nodecard_state = self.get_nodecard_state
+        self.bgqsystem.get_nodecard_isMetaState = MagicMock(return_value=False)
+        self.bgqsystem.get_nodecard_state_str = MagicMock(return_value='Error')
+        self.bgqsystem.check_block_hardware = MagicMock(side_effect=self.bgqsystem.check_block_hardware)
+
+    def get_nodecard_state(self, name):
+        if name in self.bad_node_cards:
+            return pybgsched_mock.Hardware.Error
+        return pybgsched_mock.Hardware.Available
+
+    def update(self):
+        '''Run a state pass, starting every block off idle as the bridge would.
+        Return the names of the blocks whose hardware was checked.
+
+        '''
+        for b in self.bgqsystem._blocks.values():
+            b.state = 'idle'
+        self.bgqsystem.check_block_hardware.reset_mock()
+        self.bgqsystem._recompute_block_state()
+        return set([args[0].name for args, kwargs in self.bgqsystem.check_block_hardware.call_args_list])
+
+    def states(self):
+        return dict([(b.name, b.state) for b in self.bgqsystem._blocks.values()])
+
+    def test_first_pass_checks_all(self):
+        checked = self.update()
+        assert checked == set(self.bgqsystem._blocks.keys()), "Blocks not checked %s" % checked
+        assert set(self.states().values()) == set(['idle']), "Bad states %s" % self.states()
+
+    def test_unchanged_blocks_not_rechecked(self):
+        self.update()
+        checked = self.update()
+        assert checked == set(), "Unchanged blocks checked %s" % checked
+        assert set(self.states().values()) == set(['idle']), "Bad states %s" % self.states()
+
+    def test_allocation_rechecks_relatives(self):
+        self.update()
+        self.bgqsystem._blocks['A'].used_by = 'joe'
+        checked = self.update()
+        assert checked == set(['A', 'A1', 'A2', 'FULL']), "Bad blocks checked %s" % checked
+        expected = {'A': 'allocated', 'A1': 'blocked (A)', 'A2': 'blocked (A)', 'FULL': 'blocked (A)',
+                    'B': 'idle', 'PT': 'idle'}
+        assert self.states() == expected, "Bad states %s" % self.states()
+        checked = self.update()
+        assert checked == set(), "Unchanged blocks checked %s" % checked
+        assert self.states() == expected, "Cached states not kept %s" % self.states()
+        self.bgqsystem._blocks['A'].used_by = None
+        self.update()
+        assert set(self.states().values()) == set(['idle']), "Bad states %s" % self.states()
+
+    def test_hardware_change_rechecks_users(self):
+        self.update()
+        self.bad_node_cards.add('R00-M0-N07')
+        checked = self.update()
+        assert checked == set(['B', 'FULL', 'PT']), "Bad blocks checked %s" % checked
+        states = self.states()
+        assert states['B'].startswith('hardware offline'), "Bad state %s" % states['B']
+        assert states['A'] == 'idle', "Bad state %s" % states['A']
+        assert sorted(set(self.bgqsystem.offline_blocks)) == ['B', 'FULL', 'PT'], \
+                "Bad offline blocks %s" % self.bgqsystem.offline_blocks
+        checked = self.update()
+        assert checked == set(), "Unchanged blocks checked %s" % checked
+        assert sorted(set(self.bgqsystem.offline_blocks)) == ['B', 'FULL', 'PT'], \
+                "Cached offline blocks not kept %s" % self.bgqsystem.offline_blocks
+        self.bad_node_cards.clear()
+        assert self.update() == set(['B', 'FULL', 'PT']), "Repaired hardware users not checked"
+        assert set(self.states().values()) == set(['idle']), "Bad states %s" % self.states()
+
+    def test_failed_node_card_evaluated_once(self):
+        self.update()
+        self.bad_node_cards.add('R00-M0-N02')
+        self.update()
+        assert self.bgqsystem.get_nodecard_state_str.call_count == 1, \
+                "Node card failure evaluated %d times" % self.bgqsystem.get_nodecard_state_str.call_count
+        states = self.states()
+        for name in ['A', 'A2', 'FULL']:
+            assert states[name] == 'hardware offline (Error): nodeboard R00-M0-N02', \
+                    "Bad state for %s: %s" % (name, states[name])
+        assert states['PT'] == 'hardware offline: passthrough nodeboard R00-M0-N02', "Bad state %s" % states['PT']
+        assert states['A1'] == 'idle' and states['B'] == 'idle', "Bad states %s" % states
+
+    def test_hardware_index(self):
+        index = Cobalt.Components.bgq_base_system.BlockHardwareIndex()
+        blocks = self.bgqsystem._blocks
+        for name in ['A', 'B', 'PT']:
+            index.add(blocks[name])
+        assert index.affected_blocks([('node_card', 'R00-M0-N02')]) == set(['A']), "Bad node card users"
+        assert index.affected_blocks([('passthrough_node_card', 'R00-M0-N02')]) == set(['PT']), \
+                "Bad passthrough users"
+        assert not index.masks['A'] & index.masks['B'], "Disjoint blocks share mask bits"
+        assert index.masks['B'] & index.masks['PT'], "Overlapping blocks share no mask bits"
+        index.remove('A')
+        assert 'R00-M0-N00' not in index.node_cards, "Node card of removed block still indexed"
+        assert 'R00-M0-N02' in index.node_cards, "Passthrough node card dropped with removed block"
+
+
+class TestResourceBitmap(object):
+    '''Tests for the bitmask hardware representation on blocks.'''
+
+    def setup(self):
+        BGSystem.configure = MagicMock(name='configure')
+        BGSystem.update_block_state = MagicMock(name='update_block_state')
+        self.bgqsystem = BGSystem()
+        populate_blocks(self.bgqsystem)
+
+    def test_mask_round_trip(self):
+        bitmap = Cobalt.Components.bgq_base_system.ResourceBitmap()
+        names = ['N%04d' % i for i in range(0, 1000, 7)]
+        mask = bitmap.mask(names)
+        assert sorted(bitmap.names(mask)) == names, "Mask did not round trip"
+        assert bitmap.mask(names[:3]) | bitmap.mask(names[3:]) == mask, "Masks of a split set do not combine"
+        assert bitmap.mask([]) == 0, "Empty mask not zero"
+
+    def test_block_masks(self):
+        blocks = self.bgqsystem._blocks
+        assert blocks['A']._node_card_mask | blocks['B']._node_card_mask == blocks['FULL']._node_card_mask, \
+                "A and B do not make up FULL"
+        assert not (blocks['A']._node_card_mask & blocks['B']._node_card_mask), "A and B overlap"
+        assert blocks['PT']._passthrough_node_card_mask & blocks['A2']._node_card_mask, \
+                "PT does not pass through A2"
+        assert blocks['A'].is_child(blocks['A1']) and blocks['A'].is_superblock(blocks['A1']), "A1 not a child of A"
+        assert not blocks['A1'].is_child(blocks['A']), "A a child of A1"
+        assert not blocks['A1'].does_block_overlap(blocks['A2']), "A1 and A2 overlap"
+
+    def test_queue_equivalence_classes(self):
+        blocks = self.bgqsystem._blocks
+        blocks['A'].queue = 'qa'
+        blocks['A1'].queue = 'qa'
+        blocks['A2'].queue = 'qa'
+        blocks['B'].queue = 'qb'
+        blocks['PT'].queue = 'qb'
+        blocks['FULL'].scheduled = False
+        self.bgqsystem._managed_blocks.update(blocks.keys())
+        equiv = self.bgqsystem.find_queue_equivalence_classes({'res': 'A1'}, ['qa', 'qb'])
+        equiv.sort(key=lambda e: e['queues'])
+        assert equiv == [{'queues': ['qa'], 'reservations': ['res']}, {'queues': ['qb'], 'reservations': []}], \
+                "Bad equivalence classes %s" % equiv
+
+
+class TestBatchedPlacement(object):
+    '''Tests for placing more than one job per find_job_location call.'''
+
+    def setup(self):
+        BGSystem.configure = MagicMock(name='configure')
+        BGSystem.update_block_state = MagicMock(name='update_block_state')
+        self.bgqsystem = BGSystem()
+        populate_blocks(self.bgqsystem)
+        self.bgqsystem._managed_blocks.update(self.bgqsystem._blocks.keys())
+        self.bgqsystem.update_relatives()
+        self.bgqsystem.reserve_resources_until = Mock(name='reserve_resources_until', return_value=True)
+
+    def jobs(self, *node_counts):
+        return [{'jobid': str(i), 'nodes': nodes, 'queue': 'default', 'utility_score': 1, 'walltime': 10, 'attrs': {}}
+                for i, nodes in enumerate(node_counts)]
+
+    def test_single_placement_by_default(self):
+        best = self.bgqsystem.find_job_location(self.jobs(64, 64, 64), [])
+        assert len(best) == 1, "Placed more than one job: %s" % best
+
+    def test_batch_places_non_overlapping_jobs(self):
+        self.bgqsystem.max_jobs_per_pass = 0
+        best = self.bgqsystem.find_job_location(self.jobs(64, 64, 64, 64), [])
+        assert sorted([locs[0] for locs in best.values()]) == ['A1', 'A2', 'PT'], "Bad placements %s" % best
+        assert self.bgqsystem.reserve_resources_until.call_count == 3, "Not every placement reserved"
+
+    def test_batch_respects_limit(self):
+        self.bgqsystem.max_jobs_per_pass = 2
+        best = self.bgqsystem.find_job_location(self.jobs(64, 64, 64), [])
+        assert sorted(best.keys()) == ['0', '1'], "Bad placements %s" % best
+
+    def test_batch_does_not_jump_drained_job(self):
+        #the 256 node job has to wait for FULL, so later jobs must not start on it
+        self.bgqsystem.max_jobs_per_pass = 0
+        self.bgqsystem._blocks['A1'].state = 'busy'
+        jobs = self.jobs(64, 256, 64)
+        jobs[2]['walltime'] = 120 #too long to backfill ahead of the drain
+        best = self.bgqsystem.find_job_location(jobs, [[['A1'], time.time() + 3600]])
+        assert best.keys() == ['0'], "Bad placements %s" % best
+        assert self.bgqsystem._blocks['FULL'].draining, "FULL not drained for the 256 node job"
+
+    def test_batch_backfills_into_drain_window(self):
+        self.bgqsystem.max_jobs_per_pass = 0
+        self.bgqsystem._blocks['A1'].state = 'busy'
+        best = self.bgqsystem.find_job_location(self.jobs(64, 256, 64), [[['A1'], time.time() + 3600]])
+        assert sorted(best.keys()) == ['0', '2'], "Bad placements %s" % best
+        assert sorted([locs[0] for locs in best.values()]) == ['A2', 'PT'], "Bad placements %s" % best
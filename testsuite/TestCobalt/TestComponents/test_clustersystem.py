@@ -63,6 +63,7 @@ def compare_dict(d1, d2):
 
 import Cobalt.Components.cluster_base_system
 import Cobalt.Components.cluster_system
+from mock import Mock, patch
 import time
 
 
@@ -643,3 +644,153 @@ class TestReservationHandling(object):
 
 
 
+
+class TestCleanupBatches(object):
+    '''Test cleaning nodes with a single forker batch per job'''
+
+    def setup(self):
+        self.cluster_system = Cobalt.Components.cluster_system.ClusterSystem()
+        self.cluster_system.cleanup_mode = 'fanout'
+        self.cluster_system._script_command = lambda option, host, jobid, user, group: ['epilogue', host]
+        self.cluster_system.running_nodes = set(['vs1.test', 'vs2.test', 'vs3.test'])
+        self.cluster_system.locations_by_jobid[1] = ['vs1.test', 'vs2.test', 'vs3.test']
+        self.cluster_system.jobid_to_user[1] = 'testuser'
+        self.cluster_system.del_process_groups = Mock()
+        self.cluster_system.node_end_time_dict = {0: []}
+
+    def teardown(self):
+        del self.cluster_system
+
+    def result(self, exit_status=0, lost_child=False, timed_out=False):
+        return {'exit_status': exit_status, 'signum': 0, 'core_dump': False, 'lost_child': lost_child,
+                'timed_out': timed_out, 'stdout': [], 'stderr': []}
+
+    @patch('Cobalt.Components.cluster_base_system.ComponentProxy')
+    def test_clean_nodes_one_request(self, mock_proxy):
+        #all of a job's hosts are handed to the forker in one request
+        mock_proxy.return_value.fork_batch.return_value = 7
+        self.cluster_system.clean_nodes(['vs1.test', 'vs2.test', 'vs3.test'], 'testuser', 1)
+        assert mock_proxy.return_value.fork_batch.call_count == 1
+        args = mock_proxy.return_value.fork_batch.call_args[0]
+        assert args[0] == {'vs1.test': ['epilogue', 'vs1.test'], 'vs2.test': ['epilogue', 'vs2.test'],
+                'vs3.test': ['epilogue', 'vs3.test']}, args[0]
+        assert args[3] == self.cluster_system.cleanup_max_running
+        assert args[5] == 'system'
+        assert self.cluster_system.cleaning_host_count[1] == 3
+        assert self.cluster_system.cleaning_processes == []
+        assert self.cluster_system.cleaning_batches[7]['hosts'] == set(['vs1.test', 'vs2.test', 'vs3.test'])
+
+    @patch('Cobalt.Components.cluster_base_system.ComponentProxy')
+    def test_hosts_freed_as_they_finish(self, mock_proxy):
+        #each host returns to service when its own epilogue finishes
+        mock_proxy.return_value.fork_batch.return_value = 7
+        self.cluster_system.clean_nodes(['vs1.test', 'vs2.test', 'vs3.test'], 'testuser', 1)
+        mock_proxy.return_value.poll_batches.return_value = [{'id': 7, 'lost': False, 'running': 2, 'pending': 0,
+            'finished': {'vs1.test': self.result()}}]
+        self.cluster_system.check_done_cleaning()
+        assert self.cluster_system.running_nodes == set(['vs2.test', 'vs3.test'])
+        assert self.cluster_system.cleaning_host_count[1] == 2
+        assert self.cluster_system.cleaning_batch_acks == [[7, 'vs1.test']]
+        mock_proxy.return_value.poll_batches.return_value = [{'id': 7, 'lost': False, 'running': 0, 'pending': 0,
+            'finished': {'vs2.test': self.result(1), 'vs3.test': self.result(None, timed_out=True)}}]
+        self.cluster_system.check_done_cleaning()
+        mock_proxy.return_value.poll_batches.assert_called_with([7], [[7, 'vs1.test']])
+        assert self.cluster_system.running_nodes == set()
+        assert self.cluster_system.down_nodes == set(['vs2.test', 'vs3.test'])
+        assert self.cluster_system.cleaning_batches == {}
+        assert 1 not in self.cluster_system.locations_by_jobid
+        self.cluster_system.del_process_groups.assert_called_with(1)
+
+    @patch('Cobalt.Components.cluster_base_system.ComponentProxy')
+    def test_lost_batch(self, mock_proxy):
+        #hosts in a batch that the forker lost are marked down
+        mock_proxy.return_value.fork_batch.return_value = 7
+        self.cluster_system.clean_nodes(['vs1.test', 'vs2.test', 'vs3.test'], 'testuser', 1)
+        mock_proxy.return_value.poll_batches.return_value = [{'id': 7, 'lost': True, 'running': 0, 'pending': 0,
+            'finished': {}}]
+        self.cluster_system.check_done_cleaning()
+        assert self.cluster_system.down_nodes == set(['vs1.test', 'vs2.test', 'vs3.test'])
+        assert self.cluster_system.cleaning_host_count[1] == 0
+        assert self.cluster_system.cleaning_batches == {}
+
+class TestTopologyPlacement(object):
+    '''Test topology-aware node selection'''
+
+    def setup(self):
+        self.topology = Cobalt.Components.cluster_base_system.ClusterTopology()
+        self.node_order = {}
+
+    def add_nodes(self, switch, rack, names):
+        for name in names:
+            self.topology.add_node(name, switch, rack)
+            self.node_order[name] = len(self.node_order)
+
+    def test_best_fitting_switch(self):
+        #a job that fits on one switch uses the switch with the fewest free nodes that still fits
+        self.add_nodes('s1', 'r1', ['n1', 'n2', 'n3'])
+        self.add_nodes('s2', 'r1', ['n4', 'n5'])
+        assert sorted(self.topology.select(set(self.node_order), 2, self.node_order)) == ['n4', 'n5']
+        assert sorted(self.topology.select(set(self.node_order), 3, self.node_order)) == ['n1', 'n2', 'n3']
+
+    def test_fewest_switches(self):
+        #whole switches are taken largest first, and the remainder comes from the best fitting switch
+        self.add_nodes('s1', 'r1', ['n1', 'n2', 'n3', 'n4'])
+        self.add_nodes('s2', 'r1', ['n5', 'n6', 'n7'])
+        self.add_nodes('s3', 'r1', ['n8'])
+        assert sorted(self.topology.select(set(self.node_order), 5, self.node_order)) == ['n1', 'n2', 'n3', 'n4', 'n8']
+
+    def test_fewest_racks(self):
+        #a job that spans switches is kept within one rack when one rack is big enough
+        self.add_nodes('s1', 'r1', ['n1', 'n2'])
+        self.add_nodes('s2', 'r2', ['n3', 'n4'])
+        self.add_nodes('s3', 'r2', ['n5', 'n6'])
+        self.add_nodes('s4', 'r3', ['n7', 'n8', 'n9'])
+        assert sorted(self.topology.select(set(self.node_order), 4, self.node_order)) == ['n3', 'n4', 'n5', 'n6']
+
+    def test_contiguous_nodes(self):
+        #within a switch, the most closely spaced nodes in hostfile order are chosen
+        self.add_nodes(None, None, ['n%s' % i for i in range(8)])
+        candidates = set(['n0', 'n2', 'n4', 'n5', 'n6', 'n7'])
+        assert self.topology.select(candidates, 3, self.node_order) == ['n4', 'n5', 'n6']
+
+    def test_read_topology_file(self):
+        f = open('cobalt-topology-test', 'w')
+        f.write("# node switch rack\nvs1.test sw1 rack1\nvs2.test sw1 rack1\n\nvs3.test sw2  # no rack\n")
+        f.close()
+        try:
+            self.topology.read('cobalt-topology-test')
+        finally:
+            os.remove('cobalt-topology-test')
+        assert self.topology.switches == {'vs1.test': 'sw1', 'vs2.test': 'sw1', 'vs3.test': 'sw2'}
+        assert self.topology.racks == {'sw1': 'rack1', 'sw2': None}
+
+    def test_find_job_location_topology(self):
+        #the system places jobs on as few switches as it can
+        cluster_system = Cobalt.Components.cluster_system.ClusterSystem()
+        cluster_system.placement_mode = 'topology'
+        cluster_system.topology.add_node('vs1.test', 's1')
+        cluster_system.topology.add_node('vs2.test', 's1')
+        cluster_system.topology.add_node('vs3.test', 's2')
+        cluster_system.topology.add_node('vs4.test', 's2')
+        cluster_system.running_nodes = set(['vs2.test'])
+        job = get_basic_job_dict()
+        job['nodes'] = 2
+        best_location = cluster_system.find_job_location([job], [[['vs2.test'], int(time.time()) + 400]])
+        assert sorted(best_location['1']) == ['vs3.test', 'vs4.test'], best_location
+
+    def test_drain_locations_topology(self):
+        #drain locations are chosen among all the nodes free by the soonest drain time
+        cluster_system = Cobalt.Components.cluster_system.ClusterSystem()
+        cluster_system.placement_mode = 'topology'
+        cluster_system.topology.add_node('vs1.test', 's1')
+        cluster_system.topology.add_node('vs2.test', 's2')
+        cluster_system.topology.add_node('vs3.test', 's1')
+        cluster_system.topology.add_node('vs4.test', 's2')
+        now = int(time.time())
+        cluster_system.running_nodes = set(['vs2.test', 'vs3.test', 'vs4.test'])
+        cluster_system.init_drain_times([[['vs2.test', 'vs3.test'], now + 300], [['vs4.test'], now + 600]])
+        job = get_basic_job_dict()
+        job['nodes'] = 2
+        best_location, drain_time, ready_to_run = cluster_system._find_job_location(job, now)
+        assert sorted(best_location['1']) == ['vs1.test', 'vs3.test'], best_location
+        assert drain_time == now + 300 and not ready_to_run
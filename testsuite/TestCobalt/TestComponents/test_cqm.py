@@ -28,20 +28,23 @@ config_fp.write(CQM_CONFIG_FILE_ENTRY)
 config_fp.close()
 
 import ConfigParser
+import cPickle
+from mock import patch
 from nose.tools import timed, TimeExpired
 import os
 import os.path
 import pwd
 import grp
+import shutil
 import tempfile
-from threading import Lock, Condition
+from threading import Lock, Condition, Thread
 import traceback
 import types
 import unittest
 import xmlrpclib
 
 import Cobalt.Components.cqm
-from Cobalt.Components.base import Component, exposed, automatic, query
+from Cobalt.Components.base import Component, exposed, automatic, query, marshal_query_result
 from Cobalt.Components.cqm import QueueManager, Signal_Map
 from Cobalt.Components.slp import TimingServiceLocator
 from Cobalt.Data import IncrID, Data, DataDict
@@ -347,6 +350,238 @@ class TestCQMJobManagement (TestCQMComponent):
         #assert len(r) == 1
         #assert r[0].queue == "restricted-group"
 
+    def test_dependencies_satisfied(self):
+        self.cqm.add_queues([{'name':"default"}])
+        [first] = self.cqm.add_jobs([{'queue':"default", 'jobname':"first"}])
+        [other] = self.cqm.add_jobs([{'queue':"default", 'jobname':"other"}])
+        [waiting] = self.cqm.add_jobs([{'queue':"default", 'jobname':"waiting",
+            'all_dependencies':"%s:%s" % (first.jobid, other.jobid)}])
+        [later] = self.cqm.add_jobs([{'queue':"default", 'jobname':"later"}])
+        self.cqm.set_jobs([{'jobname':"later"}], {'all_dependencies':[str(first.jobid)]})
+        assert waiting.dep_hold and later.dep_hold
+
+        first.exit_status = 0
+        self.cqm._job_terminal_action({'job':first})
+        assert waiting.satisfied_dependencies == [str(first.jobid)]
+        assert waiting.dep_hold
+        assert not later.dep_hold
+
+        other.exit_status = 0
+        self.cqm._job_terminal_action({'job':other})
+        assert not waiting.dep_hold
+        assert not self.cqm._dependency_index()
+
+    def test_dependency_failed(self):
+        self.cqm.add_queues([{'name':"default"}])
+        [first] = self.cqm.add_jobs([{'queue':"default", 'jobname':"first"}])
+        [waiting] = self.cqm.add_jobs([{'queue':"default", 'jobname':"waiting",
+            'all_dependencies':str(first.jobid)}])
+        self.cqm.check_dep_fail()
+        assert not waiting.dep_fail
+
+        first.exit_status = 1
+        self.cqm._job_terminal_action({'job':first})
+        assert waiting.dep_hold
+        assert waiting.dep_fail
+
+        self.cqm.set_jobs([{'jobname':"waiting"}], {'all_dependencies':[]})
+        assert not waiting.dep_fail
+        assert not waiting.dep_hold
+
+class TestCQMUtilityScores (TestCQMComponent):
+    def setup(self):
+        TestCQMComponent.setup(self)
+        self.cqm = QueueManager()
+        self.setup_jobid()
+        self.cqm.add_queues([{'name':"default"}, {'name':"prio"}])
+        self.cqm.set_queues([{'name':"prio"}], {'priority':5})
+        self.jobs = self.cqm.add_jobs([{'queue':"default", 'jobname':"small", 'nodes':16, 'walltime':30},
+            {'queue':"default", 'jobname':"large", 'nodes':512, 'walltime':60},
+            {'queue':"prio", 'jobname':"prio", 'nodes':16, 'walltime':30}])
+
+    def teardown(self):
+        del self.cqm
+        TestCQMComponent.teardown(self)
+
+    def scores(self):
+        return dict([(job.jobname, job.score) for job in self.jobs])
+
+    def test_builtin(self):
+        self.cqm.compute_utility_scores()
+        assert self.scores() == {'small':0.1, 'large':0.1, 'prio':5.1}
+
+    def test_batched(self):
+        def by_size():
+            return [s / 16.0 + queue_priority for s in size]
+        self.cqm.user_utility_functions['by_size'] = Cobalt.Components.cqm.batched(by_size)
+        self.cqm.set_queues([{'name':"*"}], {'policy':"by_size"})
+        self.cqm.compute_utility_scores()
+        assert self.scores() == {'small':1.0, 'large':32.0, 'prio':6.0}
+
+    def test_per_job(self):
+        def by_walltime():
+            return wall_time / 60.0
+        self.cqm.user_utility_functions['by_walltime'] = by_walltime
+        self.cqm.set_queues([{'name':"default"}], {'policy':"by_walltime"})
+        self.cqm.compute_utility_scores()
+        assert self.scores() == {'small':30.0, 'large':60.0, 'prio':5.1}
+
+    def test_batched_wrong_length(self):
+        def broken():
+            return [1.0]
+        self.cqm.user_utility_functions['broken'] = Cobalt.Components.cqm.batched(broken)
+        self.cqm.set_queues([{'name':"default"}], {'policy':"broken"})
+        self.cqm.compute_utility_scores()
+        assert self.cqm.user_utility_functions['broken'] is self.cqm.builtin_utility_functions['default']
+        self.cqm.compute_utility_scores()
+        assert self.scores()['small'] == 0.1
+
+class TestCQMRunningCounts (TestCQMComponent):
+    def setup(self):
+        TestCQMComponent.setup(self)
+        self.cqm = QueueManager()
+        self.setup_jobid()
+        self.cqm.add_queues([{'name':"default"}])
+        self.queue = self.cqm.Queues['default']
+        self.cqm.set_queues([{'name':"default"}], {'maxrunning':1, 'maxusernodes':600, 'totalnodes':1000})
+        self.first, self.second, self.other = self.cqm.add_jobs([
+            {'queue':"default", 'user':"dilbert", 'nodes':512},
+            {'queue':"default", 'user':"dilbert", 'nodes':512},
+            {'queue':"default", 'user':"wally", 'nodes':512}])
+
+    def teardown(self):
+        del self.cqm
+        TestCQMComponent.teardown(self)
+
+    def walk(self, job, states):
+        for state in states:
+            job._sm_state = state
+
+    def test_counts(self):
+        assert self.queue.jobs.user_resource_jobs("dilbert") == 0
+        self.walk(self.first, ['Job_Prologue', 'Resource_Prologue'])
+        assert self.queue.jobs.user_resource_jobs("dilbert") == 1
+        assert self.queue.running_jobs == 1
+        assert self.queue.running_nodes == 0
+        self.walk(self.first, ['Running'])
+        assert self.queue.jobs.running_nodes("dilbert") == 512
+        assert self.queue.jobs.running_nodes("wally") == 0
+        self.walk(self.first, ['Resource_Epilogue', 'Job_Epilogue'])
+        assert self.queue.running_jobs == 0
+        assert self.queue.running_nodes == 0
+
+    def test_concurrent_build(self):
+        # readonly calls may build the counts at the same time after a restart
+        self.walk(self.first, ['Job_Prologue', 'Resource_Prologue', 'Running'])
+        self.queue.jobs._running = None
+        results = []
+        threads = [Thread(target=lambda: results.append(self.queue.jobs._running_counts())) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert len(set([id(running) for running in results])) == 1
+        assert self.queue.running_nodes == 512
+        assert self.queue.jobs.user_resource_jobs("dilbert") == 1
+        # adding a job twice does not count it twice
+        self.queue.jobs._running.add(self.first)
+        assert self.queue.running_nodes == 512
+        assert self.queue.jobs.user_resource_jobs("dilbert") == 1
+
+    def test_computed_fields(self):
+        self.walk(self.first, ['Job_Prologue', 'Resource_Prologue', 'Running'])
+        specs = [{'name':"default", 'running_jobs':"*", 'running_nodes':"*"}]
+        [queue] = marshal_query_result(self.cqm.get_queues(specs), specs)
+        assert queue['running_jobs'] == 1 and queue['running_nodes'] == 512
+        assert 'running_jobs' not in self.queue.to_rx()
+        try:
+            self.cqm.set_queues([{'name':"default"}], {'running_nodes':0})
+        except QueueError:
+            pass
+        else:
+            assert False, "set_queues accepted a computed field"
+        assert self.queue.running_nodes == 512
+
+    def test_restrictions(self):
+        restrictions = self.queue.restrictions
+        spec = {'queue':"default", 'user':"dilbert", 'nodes':64}
+        assert restrictions['maxrunning'].CanAccept(spec)[0]
+        self.walk(self.first, ['Job_Prologue', 'Resource_Prologue', 'Running'])
+        assert not restrictions['maxrunning'].CanAccept(spec)[0]
+        assert restrictions['maxusernodes'].CanAccept(spec)[0]
+        assert not restrictions['maxusernodes'].CanAccept(dict(spec, nodes=128))[0]
+        assert restrictions['totalnodes'].CanAccept(dict(spec, user="wally", nodes=488))[0]
+        assert not restrictions['totalnodes'].CanAccept(dict(spec, user="wally", nodes=512))[0]
+
+    def test_max_running(self):
+        self.queue.update_max_running()
+        assert not (self.first.max_running or self.second.max_running or self.other.max_running)
+        self.walk(self.first, ['Job_Prologue'])
+        self.queue.update_max_running()
+        assert not self.first.max_running
+        assert self.second.max_running
+        assert not self.other.max_running
+
+        [late] = self.cqm.add_jobs([{'queue':"default", 'user':"dilbert"}])
+        assert late.max_running
+
+        self.cqm.set_queues([{'name':"default"}], {'maxrunning':2})
+        self.queue.update_max_running()
+        assert not self.second.max_running and not late.max_running
+
+        self.cqm.set_queues([{'name':"default"}], {'maxrunning':1})
+        self.queue.update_max_running()
+        assert self.second.max_running
+        self.walk(self.first, ['Job_Epilogue'])
+        self.queue.update_max_running()
+        assert not self.second.max_running and not late.max_running
+
+    def test_moved_job(self):
+        self.cqm.add_queues([{'name':"other"}])
+        self.walk(self.first, ['Job_Prologue'])
+        self.queue.update_max_running()
+        assert self.second.max_running
+        self.cqm.set_jobs([{'jobid':self.second.jobid}], {'queue':"other"})
+        assert not self.second.max_running
+        assert self.cqm.Queues['other'].jobs.user_resource_jobs("dilbert") == 0
+
+class TestCQMJournal (TestCQMComponent):
+    def setup(self):
+        TestCQMComponent.setup(self)
+        self.directory = tempfile.mkdtemp()
+        self.statefile = os.path.join(self.directory, "cqm")
+        self.patcher = patch('Cobalt.Components.base.get_journal_settings', lambda: {'sync':'never',
+            'sync_interval':5, 'compact_interval':300, 'compact_size':1048576})
+        self.patcher.start()
+        self.cqm = QueueManager(statefile=self.statefile)
+        self.setup_jobid()
+        self.cqm.add_queues([{'name':"default"}, {'name':"other"}])
+        self.jobs = self.cqm.add_jobs([{'queue':"default", 'user':"dilbert", 'nodes':512} for _ in range(4)])
+
+    def teardown(self):
+        self.patcher.stop()
+        shutil.rmtree(self.directory)
+        del self.cqm
+        TestCQMComponent.teardown(self)
+
+    def test_replay(self):
+        self.cqm.save()
+        first, second, third, fourth = self.jobs
+        self.cqm.Queues['default'].jobs.remove(first)
+        self.cqm.set_jobs([{'jobid':third.jobid}], {'queue':"other"})
+        fourth.attrs['location'] = "ANL-R00"
+        [fifth] = self.cqm.add_jobs([{'queue':"default", 'user':"wally", 'nodes':512}])
+        assert not self.cqm.save().startswith("state saved")
+
+        cqm = cPickle.load(open(self.statefile))
+        cqm.statefile = self.statefile
+        cqm.replay_journal()
+        assert [job.jobid for job in cqm.Queues['default'].jobs] == [second.jobid, fourth.jobid, fifth.jobid]
+        assert [job.jobid for job in cqm.Queues['other'].jobs] == [third.jobid]
+        assert cqm.Queues['default'].jobs[1].attrs['location'] == "ANL-R00"
+        assert cqm.Queues['default'].jobs.user_resource_jobs("wally") == 0
+
+
 class Task (Data):
     required_fields = ['jobid', 'location', 'user', 'cwd', 'executable', 'args', ]
     fields = Data.fields + ["id", "jobid", "location", "size", "mode", "user", "executable", "args", "env", "cwd", "umask",
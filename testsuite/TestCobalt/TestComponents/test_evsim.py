@@ -0,0 +1,82 @@
+import Cobalt
+import TestCobalt
+
+# the simulator's modules read their prediction settings at import time
+config_fp = open(Cobalt.CONFIG_FILES[0], "a")
+config_fp.write("""
+[histm]
+prediction_scheme: paired
+running_job_walltime_prediction: False
+walltime_prediction: False
+""")
+config_fp.close()
+
+import Cobalt.Proxy
+from Cobalt.Components.evsim import EventSimulator
+
+__all__ = [
+    "TestEventSimulator",
+]
+
+class TestEventSimulator (object):
+
+    def setup (self):
+        self.evsim = EventSimulator()
+
+    def teardown (self):
+        Cobalt.Proxy.local_components.clear()
+
+    def event (self, unixtime, jobid):
+        return {'machine':0, 'type':"Q", 'unixtime':unixtime, 'jobid':jobid}
+
+    def drain (self):
+        '''Advance the clock through every pending event, returning their job ids.'''
+        jobids = []
+        while self.evsim.events:
+            self.evsim.clock_increment()
+            jobids.append(self.evsim.get_current_event_job())
+        return jobids
+
+    def test_time_order (self):
+        for unixtime, jobid in [(30, 3), (10, 1), (20, 2)]:
+            self.evsim.add_event(self.event(unixtime, jobid))
+        assert self.evsim.events_length() == 3
+        assert self.evsim.get_next_event_time_sec() == 10
+        self.evsim.clock_increment()
+        assert self.evsim.get_current_time() == 10
+        assert self.evsim.get_next_event_time_sec() == 20
+        assert self.drain() == [2, 3]
+        assert self.evsim.get_current_time() == 30
+        assert self.evsim.get_next_event_time_sec() == -1
+        assert not self.evsim.is_finished()
+        self.evsim.clock_increment()
+        assert self.evsim.is_finished()
+
+    def test_ties (self):
+        for jobid in range(5):
+            self.evsim.add_event(self.event(10, jobid))
+        self.evsim.add_event(self.event(5, 5))
+        assert self.drain() == [5, 0, 1, 2, 3, 4]
+
+    def test_missing_time (self):
+        assert self.evsim.add_event({'type':"Q"}) == -1
+        assert self.evsim.events_length() == 0
+
+    def test_add_events (self):
+        # a batch larger than the heap is merged by re-heaping
+        self.evsim.add_event(self.event(20, 0))
+        self.evsim.add_events([self.event(20, 1), self.event(10, 2), self.event(20, 3), {'type':"Q"}])
+        assert self.evsim.events_length() == 4
+        # a small batch is pushed onto the existing heap
+        self.evsim.add_events([self.event(15, 4)])
+        self.evsim.add_event(self.event(20, 5))
+        assert self.drain() == [2, 4, 0, 1, 3, 5]
+
+    def test_time_span (self):
+        self.evsim.add_events([self.event(100, 1), self.event(40, 2)])
+        self.evsim.add_event(self.event(250, 3))
+        assert self.evsim.get_time_span() == 210
+        # the span covers every event added, including past ones
+        self.drain()
+        self.evsim.add_event(self.event(70, 4))
+        assert self.evsim.get_time_span() == 210
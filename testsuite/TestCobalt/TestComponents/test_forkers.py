@@ -18,6 +18,11 @@ console_level = DEBUG
 import Cobalt
 import TestCobalt
 import ConfigParser
+import cPickle
+import os
+import select
+import signal
+import tempfile
 import time
 
 config_file = Cobalt.CONFIG_FILES[0]
@@ -32,6 +37,7 @@ config.read(Cobalt.CONFIG_FILES)
 from mock import Mock, MagicMock, patch
 
 import Cobalt.Components.base_forker
+import Cobalt.Data
 from Cobalt.Components.user_script_forker import UserScriptForker
 from Cobalt.Components.user_script_forker import UserScriptChild
 Cobalt.Components.base_forker.config = config
@@ -78,6 +84,172 @@ class TestBaseForker(object):
         self.bf._wait() #SIGKILL and we're done
         assert self.bf.children[self.child_id].signum == 9, 'Job not SIGKILLed'
 
+    def wait_for_child(self, child_id, timeout=10):
+        end = time.time() + timeout
+        while not self.bf.children[child_id].complete and time.time() < end:
+            time.sleep(0.1)
+            self.bf._wait()
+
+    def test_wait_uses_pid_index(self):
+        # reaped children are found through the pid index and dropped from it
+        self.setup_base_forker()
+        self.child_id = self.bf.fork(['/bin/true'])
+        pid = self.bf.children[self.child_id].pid
+        assert self.bf._pids[pid] is self.bf.children[self.child_id]
+        self.wait_for_child(self.child_id)
+        child = self.bf.children[self.child_id]
+        assert child.complete and child.exit_status == 0
+        assert child.pid is None
+        assert pid not in self.bf._pids
+
+    def test_fork_reused_pid(self):
+        # a stale child still holding a pid that has been reused must no longer be signaled
+        self.setup_base_forker()
+        stale = TestChild(args=['/bin/true'])
+        stale.pid = 4242
+        self.bf.children[stale.id] = stale
+        self.bf.marked_for_death[stale.id] = stale
+        self.bf._pids[stale.pid] = stale
+        def start(child):
+            child.pid = 4242
+        with patch.object(TestChild, 'start', start):
+            self.child_id = self.bf.fork(['/bin/true'])
+        assert stale.pid is None
+        assert not self.bf.marked_for_death.has_key(stale.id)
+        assert self.bf._pids[4242] is self.bf.children[self.child_id]
+
+    def test_sigchld_wakeup(self):
+        # SIGCHLD makes the wakeup fd readable and wakeup() schedules the wait task
+        self.setup_base_forker()
+        assert self.bf.wakeup_fd is not None
+        self.child_id = self.bf.fork(['/bin/true'])
+        try:
+            readable = select.select([self.bf.wakeup_fd], [], [], 10)[0]
+        except select.error:
+            # interrupted by the SIGCHLD itself
+            readable = select.select([self.bf.wakeup_fd], [], [], 0)[0]
+        assert readable == [self.bf.wakeup_fd], "SIGCHLD did not wake the forker"
+        self.bf.wakeup()
+        assert '_wait' in self.bf._woken_tasks
+        assert select.select([self.bf.wakeup_fd], [], [], 0)[0] == [], "wakeup pipe not drained"
+        self.bf.do_tasks()
+        assert self.bf.children[self.child_id].complete
+
+    def test_output_capped(self):
+        # output beyond max_output_bytes is dropped and marked as truncated
+        self.setup_base_forker()
+        self.bf.MAX_OUTPUT_BYTES = 100
+        self.bf.OUTPUT_CHUNK_SIZE = 16
+        output = tempfile.TemporaryFile()
+        output.write("line\n" * 100)
+        child = TestChild(args=['/bin/true'])
+        lines = self.bf._read_output(child, output, "stdout")
+        assert lines[:-1] == ["line"] * 20, lines
+        assert lines[-1] == "[stdout truncated after 100 bytes]"
+        output.seek(0, 0)
+        output.truncate()
+        output.write("line\n" * 20)
+        assert self.bf._read_output(child, output, "stdout") == ["line"] * 20
+
+    def test_poll_children(self):
+        # only children that started, finished or were cleaned up since the last poll are returned
+        self.setup_base_forker()
+        first = self.bf.fork(['/bin/true'], tag='script')
+        second = self.bf.fork(['/bin/sleep', '60'], tag='script')
+        other = self.bf.fork(['/bin/true'], tag='other')
+        try:
+            changes = self.bf.poll_children(tag='script')
+            assert changes['full']
+            assert sorted([c['id'] for c in changes['updated']]) == [first, second]
+            changes = self.bf.poll_children('script', changes['epoch'], changes['version'])
+            assert not changes['full']
+            assert changes['updated'] == [] and changes['deleted'] == []
+            self.wait_for_child(first)
+            changes = self.bf.poll_children('script', changes['epoch'], changes['version'])
+            assert [(c['id'], c['complete']) for c in changes['updated']] == [(first, True)]
+            changes = self.bf.poll_children('script', changes['epoch'], changes['version'], cleanup_ids=[first])
+            assert changes['updated'] == [] and changes['deleted'] == [first]
+            assert first not in self.bf.children
+            changes = self.bf.poll_children('script', 'some other run', changes['version'])
+            assert changes['full'] and [c['id'] for c in changes['updated']] == [second]
+        finally:
+            self.bf.children[second].signal(signal.SIGKILL)
+
+    def wait_for_batch(self, batch_id, timeout=10):
+        end = time.time() + timeout
+        while self.bf.batches[batch_id].running and time.time() < end:
+            time.sleep(0.1)
+            self.bf._wait()
+
+    def test_fork_batch(self):
+        # batched commands run at most max_running at a time and their results are kept until acknowledged
+        self.setup_base_forker()
+        commands = {'a': ['/bin/true'], 'b': ['/bin/false'], 'c': ['/bin/true']}
+        batch_id = self.bf.fork_batch(commands, tag='epilogue', max_running=2)
+        batch = self.bf.batches[batch_id]
+        assert len(batch.running) == 2 and len(batch.pending) == 1
+        self.wait_for_batch(batch_id)
+        self.wait_for_batch(batch_id)
+        [status] = self.bf.poll_batches([batch_id])
+        assert not status['lost'] and status['running'] == 0 and status['pending'] == 0
+        assert dict([(key, result['exit_status']) for key, result in status['finished'].items()]) == \
+                {'a': 0, 'b': 1, 'c': 0}
+        assert self.bf.children == {}, "finished batch children were not cleaned up"
+        [status] = self.bf.poll_batches([batch_id], [[batch_id, 'a'], [batch_id, 'b']])
+        assert status['finished'].keys() == ['c']
+        [status] = self.bf.poll_batches([batch_id], [[batch_id, 'c']])
+        assert status['lost'] and batch_id not in self.bf.batches
+
+    def test_fork_batch_timeout(self):
+        # commands that outlive the timeout are interrupted and reported as timed out
+        self.setup_base_forker()
+        batch_id = self.bf.fork_batch({'a': ['/bin/sleep', '60']}, timeout=0)
+        child_id = self.bf.batches[batch_id].running.keys()[0]
+        time.sleep(0.1)
+        self.bf._wait()
+        result = self.bf.poll_batches([batch_id])[0]['finished']['a']
+        assert result['timed_out'] and not result['lost_child']
+        assert child_id in self.bf.marked_for_death
+        self.bf.marked_for_death[child_id].signal(signal.SIGKILL)
+
+    def test_fork_batch_restart(self):
+        # a restarted forker reports the running command of a batch as lost, runs the rest, cleans up the lost child, and
+        # never reuses the batch's id
+        self.setup_base_forker()
+        batch_id = self.bf.fork_batch({'a': ['/bin/sleep', '60'], 'b': ['/bin/true']}, max_running=1)
+        assert len(self.bf.batches[batch_id].pending) == 1
+        running_child_id = self.bf.batches[batch_id].running.keys()[0]
+        self.bf.children[running_child_id].signal(signal.SIGKILL)
+        state = cPickle.loads(cPickle.dumps(self.bf.__getstate__()))
+        Cobalt.Components.base_forker.ChildBatch.id_gen = Cobalt.Data.IncrID()
+        restarted = Cobalt.Components.base_forker.BaseForker.__new__(Cobalt.Components.base_forker.BaseForker)
+        restarted.__setstate__(state)
+        restarted.child_cls = TestChild
+        self.bf = restarted
+        self.wait_for_batch(batch_id)
+        [status] = restarted.poll_batches([batch_id])
+        assert not status['lost']
+        assert status['finished']['a']['lost_child']
+        assert status['finished']['b']['exit_status'] == 0
+        assert running_child_id not in restarted.children
+        restarted.poll_batches([], [[batch_id, 'a'], [batch_id, 'b']])
+        assert batch_id not in restarted.batches
+        assert restarted.children == {}
+        new_batch_id = restarted.fork_batch({'a': ['/bin/true']})
+        assert new_batch_id > batch_id, "batch id %s reused after restart" % new_batch_id
+
+    @patch('Cobalt.Proxy.ComponentProxy')
+    def test_fork_batch_notify(self, mock_proxy):
+        # the notify component hears about batches as their commands finish
+        self.setup_base_forker()
+        batch_id = self.bf.fork_batch({'a': ['/bin/true']}, notify='system')
+        self.wait_for_batch(batch_id)
+        assert ('system', batch_id) in self.bf._batch_notifications
+        assert 'flush_batch_notifications' in self.bf._woken_tasks
+        self.bf.flush_batch_notifications()
+        mock_proxy.assert_called_with('system', retry=False)
+        mock_proxy.return_value.batch_progress.assert_called_with([batch_id])
+
 
 class TestUserScriptForker(object):
 
@@ -1,10 +1,15 @@
 import time
 import itertools
 import warnings
+import xmlrpclib
 
 from Cobalt.Data import IncrID, RandomID, Data, ForeignData, DataList, \
-     DataDict, ForeignData, ForeignDataDict, DataState
+     DataDict, ForeignData, ForeignDataDict, DataState, ChangeLog
 from Cobalt.Exceptions import DataCreationError, DataStateError, DataStateTransitionError
+from Cobalt.Util import FailureMode
+from Cobalt.Components.base import Component
+from Cobalt.Proxy import ComponentProxy
+import Cobalt.Proxy
 
 import Cobalt.Logging
 
@@ -372,3 +377,169 @@ class TestForeignDataDict (object):
         assert f.__oserror__.status == True
         f.Sync()
         assert f.__oserror__.status == False
+
+
+class VersionedData (Data):
+    fields = Data.fields + ['id', 'value']
+    versioned = True
+    def __init__(self, spec):
+        Data.__init__(self, spec)
+        self.id = spec.get('id')
+        self.value = spec.get('value')
+
+
+class TestChangeLog (object):
+
+    def setup (self):
+        self.changes = ChangeLog(max_deleted=2)
+        self.items = DataDict()
+        self.items.item_cls = VersionedData
+        self.items.key = 'id'
+        self.items.q_add([{'id':1, 'value':'queued'}, {'id':2, 'value':'queued'}])
+
+    def get_changes (self, specs, epoch, version):
+        return self.changes.get_changes_since(self.items.values(), 'id', epoch, version)
+
+    def test_full (self):
+        changes = self.get_changes([], None, "0")
+        assert changes['full']
+        assert sorted([item['id'] for item in changes['updated']]) == [1, 2]
+        assert changes['count'] == 2
+
+    def test_delta (self):
+        changes = self.get_changes([], None, "0")
+        self.items[2].value = 'running'
+        self.items[1].value = 'queued'
+        self.items.q_add([{'id':3, 'value':'queued'}])
+        self.items.q_del([{'id':1}])
+        self.changes.record_deleted([1])
+        changes = self.get_changes([], changes['epoch'], changes['version'])
+        assert not changes['full']
+        assert sorted([item['id'] for item in changes['updated']]) == [2, 3]
+        assert changes['deleted'] == [1]
+        changes = self.get_changes([], changes['epoch'], changes['version'])
+        assert changes['updated'] == [] and changes['deleted'] == []
+
+    def test_deleted_overflow (self):
+        changes = self.get_changes([], None, "0")
+        self.changes.record_deleted([3, 4, 5])
+        assert self.get_changes([], changes['epoch'], changes['version'])['full']
+
+    def test_foreign_sync (self):
+        f = ForeignDataDict()
+        f.item_cls = TestForeignDataDict.my_data
+        f.key = 'id'
+        f.__changes__ = self.get_changes
+        f.Sync()
+        assert sorted(f.keys()) == [1, 2]
+        self.items[1].value = 'running'
+        self.items.q_del([{'id':2}])
+        self.changes.record_deleted([2])
+        f.Sync()
+        assert f.keys() == [1]
+        assert f[1].value == 'running'
+        # an unrecorded deletion forces the next update to be full
+        self.items.q_add([{'id':3, 'value':'queued'}])
+        self.items.q_del([{'id':1}])
+        f.Sync()
+        assert f._sync_epoch is None
+        f.Sync()
+        assert f.keys() == [3]
+
+    def test_foreign_sync_fault (self):
+        def unreachable (specs, epoch, version):
+            raise xmlrpclib.Fault(20, "Server Failure")
+        # a component without the change feed
+        class OldComponent (Component):
+            name = "old-component"
+        OldComponent()
+        missing = ComponentProxy("old-component").get_changes
+        f = ForeignDataDict()
+        f.item_cls = TestForeignDataDict.my_data
+        f.key = 'id'
+        f.__oserror__ = FailureMode("test")
+        f.__function__ = lambda specs: [{'tag':'foo', 'id':4, 'value':'queued'}]
+        f.__changes__ = unreachable
+        f.Sync()
+        assert f.__oserror__.status == False
+        assert f.__changes__ is unreachable
+        assert f.keys() == []
+        f.__changes__ = self.get_changes
+        f.Sync()
+        assert f.__oserror__.status == True
+        assert sorted(f.keys()) == [1, 2]
+        f.__changes__ = missing
+        f.Sync()
+        assert f.__changes__ is None
+        assert f.keys() == [4]
+        Cobalt.Proxy.local_components.clear()
+
+
+class IndexedData (Data):
+    fields = Data.fields + ['id', 'queue', 'state', 'location']
+    indexed = ['id', 'queue', 'state', 'location']
+    def __init__(self, spec):
+        Data.__init__(self, spec)
+        self.id = spec.get('id')
+        self.queue = spec.get('queue')
+        self.state = spec.get('state')
+        self.location = spec.get('location', [])
+
+
+class TestIndexedDataDict (object):
+
+    def setup (self):
+        self.datadict = DataDict()
+        self.datadict.item_cls = IndexedData
+        self.datadict.key = "id"
+        self.datadict.q_add([{'id':1, 'queue':"default", 'state':"queued"},
+                             {'id':2, 'queue':"default", 'state':"running"},
+                             {'id':3, 'queue':"short", 'state':"queued"}])
+
+    def ids (self, items):
+        return sorted([item.id for item in items])
+
+    def test_q_get (self):
+        assert self.ids(self.datadict.q_get([{'queue':"default"}])) == [1, 2]
+        assert self.ids(self.datadict.q_get([{'queue':"default", 'state':"queued"}])) == [1]
+        assert self.ids(self.datadict.q_get([{'queue':"default"}, {'queue':"short"}])) == [1, 2, 3]
+        assert self.ids(self.datadict.q_get([{'queue':"*", 'tag':"unknown"}])) == [1, 2, 3]
+        assert self.datadict.q_get([{'queue':"long"}]) == []
+
+    def test_q_get_unhashable (self):
+        self.datadict[2].location = ['R00-M0']
+        assert self.ids(self.datadict.q_get([{'location':['R00-M0']}])) == [2]
+        assert self.ids(self.datadict.q_get([{'location':['R00-M0'], 'queue':"default"}])) == [2]
+
+    def test_attribute_set (self):
+        self.datadict.q_get([{'queue':"*"}])
+        self.datadict[3].queue = "default"
+        self.datadict[1].state = "running"
+        assert self.ids(self.datadict.q_get([{'queue':"default"}])) == [1, 2, 3]
+        assert self.ids(self.datadict.q_get([{'queue':"short"}])) == []
+        assert self.ids(self.datadict.q_get([{'state':"running"}])) == [1, 2]
+
+    def test_add_del (self):
+        self.datadict.q_get([{'queue':"*"}])
+        self.datadict.q_add([{'id':4, 'queue':"short", 'state':"queued"}])
+        self.datadict.q_del([{'id':3}])
+        del self.datadict[1]
+        removed = self.datadict.pop(2)
+        removed.queue = "short"
+        assert self.ids(self.datadict.q_get([{'queue':"short"}])) == [4]
+        assert self.ids(self.datadict.q_get([{'queue':"default"}])) == []
+
+    def test_copy (self):
+        self.datadict.q_get([{'queue':"*"}])
+        copied = self.datadict.copy()
+        self.datadict[3].queue = "default"
+        assert self.ids(copied.q_get([{'queue':"default"}])) == [1, 2, 3]
+        del copied[3]
+        assert self.ids(self.datadict.q_get([{'queue':"default"}])) == [1, 2, 3]
+
+    def test_pickle (self):
+        import cPickle
+        self.datadict.q_get([{'queue':"*"}])
+        restored = cPickle.loads(cPickle.dumps(self.datadict))
+        restored[1].queue = "short"
+        assert self.ids(restored.q_get([{'queue':"short"}])) == [1, 3]
@@ -0,0 +1,57 @@
+import os
+import shutil
+import tempfile
+
+from Cobalt.Journal import StateJournal, read_journal
+
+class TestStateJournal (object):
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "state.journal")
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+
+    def test_missing(self):
+        assert read_journal(self.path) == (None, [])
+
+    def test_round_trip(self):
+        journal = StateJournal(self.path, sync='always')
+        journal.reset(3)
+        journal.append([('put', 'jobs', 1, {'a':1})])
+        journal.append([('del', 'jobs', 1)])
+        journal.close()
+        assert journal.size == os.path.getsize(self.path)
+        generation, batches = read_journal(self.path)
+        assert generation == 3
+        assert batches == [[('put', 'jobs', 1, {'a':1})], [('del', 'jobs', 1)]]
+
+    def test_reset_truncates(self):
+        journal = StateJournal(self.path)
+        journal.reset(1)
+        journal.append([('extra', {})])
+        journal.reset(2)
+        journal.close()
+        assert read_journal(self.path) == (2, [])
+
+    def test_damaged_tail(self):
+        journal = StateJournal(self.path, sync='never')
+        journal.reset(1)
+        journal.append([('extra', {'a':1})])
+        journal.append([('extra', {'a':2})])
+        journal.close()
+        data = open(self.path, "rb").read()
+        open(self.path, "wb").write(data[:-3])
+        assert read_journal(self.path) == (1, [[('extra', {'a':1})]])
+        open(self.path, "wb").write(data[:-3] + "xyz")
+        open(self.path, "r+b").write(data[:-1] + "!")
+        assert read_journal(self.path) == (1, [[('extra', {'a':1})]])
+
+    def test_bad_policy(self):
+        try:
+            StateJournal(self.path, sync='sometimes')
+        except ValueError:
+            pass
+        else:
+            assert False, "bad sync policy accepted"
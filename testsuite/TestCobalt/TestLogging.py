@@ -0,0 +1,125 @@
+import logging
+import os
+import shutil
+import tempfile
+import xmlrpclib
+
+from Cobalt.Logging import dbwriter
+
+class FakeWriter (object):
+
+    '''Stands in for the cdbwriter component proxy.'''
+
+    def __init__(self, bulk=True):
+        self.bulk = bulk
+        self.available = True
+        self.received = []
+        self.calls = 0
+        setattr(self, "system.multicall", self.multicall)
+
+    def add_messages(self, messages):
+        if not self.bulk:
+            raise xmlrpclib.Fault(1, "add_messages")
+        if not self.available:
+            raise xmlrpclib.Fault(1, "database unavailable")
+        self.calls += 1
+        self.received.extend(messages)
+        return len(messages)
+
+    def add_message(self, message):
+        self.received.append(message)
+        return True
+
+    def multicall(self, calls):
+        return [[getattr(self, call['methodName'])(*call['params'])] for call in calls]
+
+class TestDBWriter (object):
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+        self.writer = dbwriter(logging.getLogger("test"),
+                overflow_filename=os.path.join(self.directory, "overflow"), max_queued=3)
+        self.writer.threaded = False
+        self.writer.enabled = True
+        self.writer.batch_size = 2
+        self.cdbwriter = FakeWriter()
+        self.writer.cdbwriter = self.cdbwriter
+        self.writer.cdbwriter_alive = True
+
+    def teardown(self):
+        self.writer.close_overflow()
+        shutil.rmtree(self.directory)
+
+    def test_batches(self):
+        for message in ["a", "b", "c"]:
+            self.writer.msg_queue.append(message)
+        self.writer.deliver()
+        assert self.cdbwriter.received == ["a", "b", "c"]
+        assert self.cdbwriter.calls == 2
+        assert not self.writer.msg_queue
+
+    def test_unavailable(self):
+        self.cdbwriter.available = False
+        self.writer.queue_message("a")
+        assert self.writer.pending_messages() == ["a"]
+        assert not self.writer.cdbwriter_alive
+
+    def test_overflow(self):
+        self.writer.cdbwriter_alive = False
+        self.writer.last_connect = 2**31
+        for message in ["a", "b", "c", "d", "e", "f"]:
+            self.writer.queue_message(message)
+        assert self.writer.pending_messages() == ["a", "b", "c"]
+        assert self.writer.overflow
+        assert open(self.writer.overflow_filename).read() == "d\ne\nf\n"
+
+        # delivery stops partway through the overflow file
+        self.cdbwriter.available = True
+        self.writer.cdbwriter_alive = True
+        self.writer.batch_size = 4
+        sent = []
+        def add_messages(messages):
+            sent.append(list(messages))
+            if len(sent) == 2:
+                raise xmlrpclib.Fault(1, "database unavailable")
+            return len(messages)
+        self.cdbwriter.add_messages = add_messages
+        self.writer.deliver()
+        assert sent == [["a", "b", "c"], ["d", "e", "f"]]
+        assert not self.writer.pending_messages()
+
+        # new messages keep going to the file until it has been delivered
+        self.writer.queue_message("g")
+        assert open(self.writer.overflow_filename).read() == "d\ne\nf\ng\n"
+        self.cdbwriter.add_messages = FakeWriter().add_messages
+        self.writer.cdbwriter_alive = True
+        self.writer.batch_size = 2
+        self.writer.deliver()
+        assert self.cdbwriter.add_messages.im_self.received == ["d", "e", "f", "g"]
+        assert not self.writer.overflow
+        assert self.writer.overflow_offset == 0
+        assert not os.path.exists(self.writer.overflow_filename)
+
+        self.writer.queue_message("h")
+        assert self.cdbwriter.add_messages.im_self.received[-1] == "h"
+
+    def test_overflow_offset(self):
+        self.writer.cdbwriter_alive = False
+        self.writer.last_connect = 2**31
+        for message in ["a", "b", "c", "d", "e", "f"]:
+            self.writer.queue_message(message)
+        self.writer.msg_queue = []
+        self.writer.cdbwriter_alive = True
+        self.writer.batch_size = 2
+        # the writer takes only the first message of the batch
+        self.writer._send = lambda batch: 1
+        self.writer.deliver()
+        assert self.writer.overflow_offset == 2
+        assert self.writer.read_overflow() == (["e", "f"], [4, 6])
+
+    def test_older_writer(self):
+        self.cdbwriter.bulk = False
+        self.writer.queue_message("a")
+        self.writer.queue_message("b")
+        assert self.cdbwriter.received == ["a", "b"]
+        assert not self.writer.bulk
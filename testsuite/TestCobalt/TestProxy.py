@@ -0,0 +1,177 @@
+import time
+import xmlrpclib
+
+from mock import Mock, patch
+
+import Cobalt.Proxy
+from Cobalt.Components.base import Component, exposed
+ConnectionPool = Cobalt.Proxy.ConnectionPool
+
+class TestConnectionPool (object):
+
+    def setup(self):
+        self.pool = ConnectionPool(max_idle=2, idle_timeout=60)
+
+    def test_reuse(self):
+        connection = Mock()
+        assert self.pool.get('host') is None
+        self.pool.put('host', connection)
+        assert self.pool.get('host') is connection
+        assert self.pool.get('host') is None
+        assert not connection.close.called
+
+    def test_keyed(self):
+        connection = Mock()
+        self.pool.put('host1', connection)
+        assert self.pool.get('host2') is None
+        assert self.pool.get('host1') is connection
+
+    def test_max_idle(self):
+        connections = [Mock() for i in range(3)]
+        for connection in connections:
+            self.pool.put('host', connection)
+        assert connections[2].close.called
+        assert len(self.pool.idle['host']) == 2
+
+    def test_idle_timeout(self):
+        self.pool.idle_timeout = 0.1
+        connection = Mock()
+        self.pool.put('host', connection)
+        time.sleep(0.2)
+        assert self.pool.get('host') is None
+        assert connection.close.called
+
+    def test_clear(self):
+        connection = Mock()
+        self.pool.put('host', connection)
+        self.pool.clear()
+        assert connection.close.called
+        assert self.pool.get('host') is None
+
+class TestLocateCache (object):
+
+    def setup(self):
+        Cobalt.Proxy.clear_proxy_caches()
+        self.slp = Mock()
+        self.slp.locate.return_value = 'https://somehost:8256'
+
+    def teardown(self):
+        Cobalt.Proxy.clear_proxy_caches()
+
+    def test_cached(self):
+        with patch.object(Cobalt.Proxy, 'DeferredProxy', return_value=self.slp):
+            assert Cobalt.Proxy.locate('foo', 60) == 'https://somehost:8256'
+            assert Cobalt.Proxy.locate('foo', 60) == 'https://somehost:8256'
+        assert self.slp.locate.call_count == 1
+
+    def test_expired(self):
+        with patch.object(Cobalt.Proxy, 'DeferredProxy', return_value=self.slp):
+            Cobalt.Proxy.locate('foo', 0)
+            Cobalt.Proxy.locate('foo', 0)
+        assert self.slp.locate.call_count == 2
+
+    def test_forget_location(self):
+        with patch.object(Cobalt.Proxy, 'DeferredProxy', return_value=self.slp):
+            Cobalt.Proxy.locate('foo', 60)
+            Cobalt.Proxy.forget_location('root:secret@otherhost:8256')
+            Cobalt.Proxy.locate('foo', 60)
+            assert self.slp.locate.call_count == 1
+            Cobalt.Proxy.forget_location('root:secret@somehost:8256')
+            Cobalt.Proxy.locate('foo', 60)
+        assert self.slp.locate.call_count == 2
+
+    def test_not_found(self):
+        self.slp.locate.return_value = ''
+        with patch.object(Cobalt.Proxy, 'DeferredProxy', return_value=self.slp):
+            try:
+                Cobalt.Proxy.locate('foo', 60)
+            except Cobalt.Proxy.ComponentLookupError:
+                pass
+            else:
+                assert False, "locate found a component that is not registered"
+            assert 'foo' not in Cobalt.Proxy._located
+
+    def test_settings_cached(self):
+        settings = Cobalt.Proxy.get_communication_settings()
+        with patch.object(Cobalt.Proxy, 'SafeConfigParser') as parser:
+            assert Cobalt.Proxy.get_communication_settings() is settings
+            assert not parser.called
+
+class TestMultiCall (object):
+
+    def setup(self):
+
+        class TestComponent (Component):
+
+            name = "multicall-test"
+
+            def double (self, value):
+                return value * 2
+            double = exposed(double)
+
+            def fail (self):
+                raise ValueError("failed")
+            fail = exposed(fail)
+
+        self.component = TestComponent()
+
+    def teardown(self):
+        Cobalt.Proxy.local_components.clear()
+
+    def test_results(self):
+        batch = Cobalt.Proxy.MultiCall(Cobalt.Proxy.ComponentProxy("multicall-test"))
+        batch.double(1)
+        batch.fail()
+        batch.double(3)
+        assert len(batch) == 3
+        results = batch()
+        assert results[0] == 2
+        assert isinstance(results[1], xmlrpclib.Fault)
+        assert results[1].faultString == "failed"
+        assert results[2] == 6
+
+    def test_empty(self):
+        batch = Cobalt.Proxy.MultiCall(Cobalt.Proxy.ComponentProxy("multicall-test"))
+        assert batch() == []
+
+class TestResponseEncoding (object):
+
+    def test_round_trip(self):
+        jobs = [{'jobid':1, 'user':'alice', 'score':1.5, 'starttime':None,
+                 'user_hold':False, 'args':['-n', '2']}]
+        body, encoding = Cobalt.Proxy.dumps_json_response(jobs, "json")
+        assert encoding == 'json'
+        result = Cobalt.Proxy.loads_json_response(body, encoding)
+        assert result == (jobs,)
+        assert type(result[0][0]['user']) is str
+        assert type(result[0][0]['args'][0]) is str
+
+    def test_non_ascii_stays_unicode(self):
+        body, encoding = Cobalt.Proxy.dumps_json_response(u"caf\xe9", "json")
+        assert Cobalt.Proxy.loads_json_response(body, encoding) == (u"caf\xe9",)
+
+    def test_compressed(self):
+        value = ['x' * 100] * 1000
+        body, encoding = Cobalt.Proxy.dumps_json_response(value, "json, zlib")
+        assert encoding == 'json+zlib'
+        assert Cobalt.Proxy.loads_json_response(body, encoding) == (value,)
+        body, encoding = Cobalt.Proxy.dumps_json_response([1], "json, zlib")
+        assert encoding == 'json'
+
+    def test_fault(self):
+        body, encoding = Cobalt.Proxy.dumps_json_response(
+                xmlrpclib.Fault(1, "boom"), "json")
+        try:
+            Cobalt.Proxy.loads_json_response(body, encoding)
+        except xmlrpclib.Fault, fault:
+            assert fault.faultCode == 1
+            assert fault.faultString == "boom"
+        else:
+            assert False, "fault not raised"
+
+    def test_falls_back_to_xml(self):
+        assert Cobalt.Proxy.dumps_json_response([1], None) == (None, None)
+        assert Cobalt.Proxy.dumps_json_response([1], "xml") == (None, None)
+        assert Cobalt.Proxy.dumps_json_response(
+                xmlrpclib.DateTime(), "json") == (None, None)
+        assert Cobalt.Proxy.dumps_json_response('\xff', "json") == (None, None)
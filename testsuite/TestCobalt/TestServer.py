@@ -1,4 +1,5 @@
 import os
+import sys
 import socket
 import threading
 import xmlrpclib
@@ -6,7 +7,8 @@ import ssl
 import ConfigParser
 
 import Cobalt.Server
-from Cobalt.Server import find_intended_location, XMLRPCServer
+import Cobalt.Proxy
+from Cobalt.Server import find_intended_location, XMLRPCServer, PooledXMLRPCServer
 from Cobalt.Components.base import Component
 
 cp = ConfigParser.ConfigParser()
@@ -210,3 +212,65 @@ class TestXMLRPCServer_https (XMLRPCServerTester):
     def test_url (self):
         hname = socket.gethostname()
         assert self.server.url == "https://%s:5900" % hname, self.server.url
+
+
+class TestPooledXMLRPCServer (object):
+
+    def setup (self):
+        self._outside_require_auth = Cobalt.Server.XMLRPCRequestHandler.require_auth
+        Cobalt.Server.XMLRPCRequestHandler.require_auth = False
+        self.server = PooledXMLRPCServer(("localhost", 5900), keyfile=keypath,
+                certfile=certpath, cafile=capath, register=False, timeout=1,
+                workers=2, backlog=2)
+        self.server.register_instance(c)
+
+    def teardown (self):
+        self.server.server_close()
+        Cobalt.Server.XMLRPCRequestHandler.require_auth = self._outside_require_auth
+
+    def proxy (self):
+        return xmlrpclib.ServerProxy("https://localhost:5900",
+                transport=Cobalt.Proxy.XMLRPCTransport(timeout=10))
+
+    def serve (self, client):
+        # serve_forever sets signal handlers, so it has to run in the main thread
+        errors = []
+        def run_client ():
+            try:
+                try:
+                    client()
+                except:
+                    errors.append(sys.exc_info())
+            finally:
+                self.server.shutdown()
+        client_thread = threading.Thread(target=run_client)
+        client_thread.start()
+        self.server.serve_forever()
+        client_thread.join()
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
+
+    def test_concurrent_pings (self):
+        results = []
+        def ping (value):
+            results.append(self.proxy().ping(value))
+        def client ():
+            threads = [threading.Thread(target=ping, args=(value, )) for value in range(6)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.serve(client)
+        assert len(self.server.worker_threads) == 2
+        assert sorted([result[0] for result in results]) == range(6)
+
+    def test_queue_timeout (self):
+        self.server.queue_timeout = -1
+        def client ():
+            try:
+                self.proxy().ping(1)
+            except:
+                pass
+            else:
+                assert not "Served a request that waited too long."
+        self.serve(client)
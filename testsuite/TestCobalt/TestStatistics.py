@@ -0,0 +1,82 @@
+import time
+
+import Cobalt.Statistics
+LatencyHistogram = Cobalt.Statistics.LatencyHistogram
+CallProfile = Cobalt.Statistics.CallProfile
+
+class TestLatencyHistogram (object):
+
+    def test_empty(self):
+        hist = LatencyHistogram()
+        assert hist.summary() == {'count':0}
+        assert hist.percentile(0.5) == 0.0
+
+    def test_percentiles(self):
+        hist = LatencyHistogram()
+        for i in range(90):
+            hist.add_value(0.001)
+        for i in range(10):
+            hist.add_value(1.0)
+        summary = hist.summary()
+        assert summary['count'] == 100
+        assert summary['min'] == 0.001
+        assert summary['max'] == 1.0
+        # bucket edges are within a factor of growth of the true value
+        assert 0.001 <= summary['p50'] < 0.001 * LatencyHistogram.growth
+        assert 0.001 <= summary['p90'] < 0.001 * LatencyHistogram.growth
+        assert summary['p99'] == 1.0
+
+    def test_bounded(self):
+        hist = LatencyHistogram()
+        hist.add_value(0)
+        hist.add_value(1e6)
+        assert len(hist.buckets) == LatencyHistogram.bucket_count
+        assert hist.percentile(1.0) == 1e6
+
+    def test_merge(self):
+        hist1 = LatencyHistogram()
+        hist2 = LatencyHistogram()
+        hist1.add_value(0.5)
+        hist2.add_value(0.25)
+        hist2.add_value(2.0)
+        hist1.merge(hist2)
+        assert hist1.count == 3
+        assert hist1.min == 0.25
+        assert hist1.max == 2.0
+        assert hist1.total == 2.75
+
+class TestCallProfile (object):
+
+    def setup(self):
+        self.profile = CallProfile(window=1, slots=2)
+
+    def test_dump(self):
+        self.profile.add_call('get_jobs', 0.01, '10.0.0.1')
+        self.profile.add_call('get_jobs', 0.02, '10.0.0.1')
+        self.profile.add_call('add_jobs', 0.5, '10.0.0.2')
+        self.profile.add_lock_wait('add_jobs', 0.4)
+        self.profile.add_lock_held('add_jobs', 0.5)
+        dump = self.profile.dump()
+        assert dump['calls']['get_jobs']['count'] == 2
+        assert dump['calls']['add_jobs']['max'] == 0.5
+        assert dump['callers'] == {'10.0.0.1':{'get_jobs':2},
+                                   '10.0.0.2':{'add_jobs':1}}
+        assert dump['lock_wait']['add_jobs']['count'] == 1
+        assert dump['lock_held']['add_jobs']['total'] == 0.5
+
+    def test_window(self):
+        self.profile.add_call('get_jobs', 0.01, 'local')
+        time.sleep(0.6)
+        self.profile.add_call('add_jobs', 0.01, 'local')
+        assert len(self.profile.slots) == 2
+        time.sleep(0.6)
+        dump = self.profile.dump()
+        assert 'get_jobs' not in dump['calls']
+        assert dump['calls']['add_jobs']['count'] == 1
+
+    def test_reset(self):
+        self.profile.add_call('get_jobs', 0.01, 'local')
+        self.profile.reset()
+        dump = self.profile.dump()
+        assert dump['calls'] == {}
+        assert dump['callers'] == {}
@@ -4,10 +4,12 @@ import pwd
 import errno
 import tempfile
 import re
+import threading
 NamedTemporaryFile = tempfile.NamedTemporaryFile
 
 import Cobalt.Util
 Timer = Cobalt.Util.Timer
+ReadWriteLock = Cobalt.Util.ReadWriteLock
 disk_writer_thread = Cobalt.Util.disk_writer_thread
 init_cobalt_config = Cobalt.Util.init_cobalt_config
 check_required_options = Cobalt.Util.check_required_options
@@ -60,6 +62,65 @@ class TestTimers (object):
         assert t.has_expired
         t.stop()
 
+class TestReadWriteLock (object):
+    def setup(self):
+        self.lock = ReadWriteLock()
+
+    def _start(self, target):
+        thread = threading.Thread(target=target)
+        thread.setDaemon(True)
+        thread.start()
+        return thread
+
+    def test_shared_readers(self):
+        self.lock.acquire_read()
+        acquired = []
+        def reader():
+            self.lock.acquire_read()
+            acquired.append(True)
+            self.lock.release_read()
+        thread = self._start(reader)
+        thread.join(5)
+        assert acquired, "second reader was blocked by the first"
+        assert self.lock.readers == 1
+        self.lock.release_read()
+        assert self.lock.readers == 0
+
+    def test_writer_excludes_readers(self):
+        self.lock.acquire()
+        acquired = []
+        def reader():
+            self.lock.acquire_read()
+            acquired.append(True)
+            self.lock.release_read()
+        thread = self._start(reader)
+        thread.join(0.2)
+        assert not acquired, "reader acquired the lock while a writer held it"
+        self.lock.release()
+        thread.join(5)
+        assert acquired
+
+    def test_waiting_writer_blocks_new_readers(self):
+        self.lock.acquire_read()
+        events = []
+        def writer():
+            self.lock.acquire()
+            events.append('writer')
+            self.lock.release()
+        def reader():
+            self.lock.acquire_read()
+            events.append('reader')
+            self.lock.release_read()
+        writer_thread = self._start(writer)
+        time.sleep(0.1)
+        reader_thread = self._start(reader)
+        reader_thread.join(0.2)
+        assert events == [], "reader overtook a waiting writer"
+        self.lock.release_read()
+        writer_thread.join(5)
+        reader_thread.join(5)
+        assert events == ['writer', 'reader']
+
 class TestDiskWriter(object):
     '''Test out the threaded disk writer used by cqm and other components
     mainly for cobaltlog writing to possibly unreliable filesystems.
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+
+'''Compare XML-RPC and JSON response encoding for a get_jobs-sized reply'''
+
+import sys
+import time
+import xmlrpclib
+from optparse import OptionParser
+
+from Cobalt.Proxy import dumps_json_response, loads_json_response
+
+def make_jobs(count):
+    jobs = []
+    for jobid in range(count):
+        jobs.append({'jobid':jobid, 'user':"user%d" % (jobid % 50),
+            'queue':'default', 'state':'queued', 'nodes':512, 'procs':8192,
+            'walltime':'60', 'location':'', 'score':jobid * 0.5,
+            'project':"project%d" % (jobid % 20), 'mode':'c16',
+            'submittime':1300000000.0 + jobid, 'starttime':None,
+            'user_hold':False, 'admin_hold':False,
+            'all_dependencies':[], 'satisfied_dependencies':[],
+            'envs':{'PATH':'/usr/bin:/bin'}, 'args':['-n', str(jobid)],
+            'command':'/home/user/a.out', 'outputdir':'/home/user'})
+    return jobs
+
+def timed(func, repeat):
+    start = time.time()
+    for _ in range(repeat):
+        value = func()
+    return value, (time.time() - start) / repeat
+
+def report(name, size, count, encode_time, decode_time):
+    megabytes = size / 1048576.0
+    print "%-10s %9.2f MB %9.1f MB/s %11.0f items/s %9.1f MB/s %11.0f items/s" % (
+        name, megabytes, megabytes / encode_time, count / encode_time,
+        megabytes / decode_time, count / decode_time)
+
+if __name__ == '__main__':
+    parser = OptionParser(usage="%prog [-n jobs] [-r repeat]")
+    parser.add_option("-n", dest="jobs", type="int", default=5000,
+            help="number of jobs in the response")
+    parser.add_option("-r", dest="repeat", type="int", default=3,
+            help="number of times to repeat each measurement")
+    opts, args = parser.parse_args()
+    if args:
+        parser.print_usage()
+        sys.exit(1)
+
+    jobs = make_jobs(opts.jobs)
+    print "%-10s %12s %24s %24s" % ("encoding", "size", "encode", "decode")
+
+    body, encode_time = timed(lambda: xmlrpclib.dumps((jobs,), methodresponse=1,
+        allow_none=True), opts.repeat)
+    result, decode_time = timed(lambda: xmlrpclib.loads(body), opts.repeat)
+    assert result[0][0] == jobs
+    report("xml", len(body), opts.jobs, encode_time, decode_time)
+
+    for accept in ("json", "json, zlib"):
+        (body, encoding), encode_time = timed(
+                lambda: dumps_json_response(jobs, accept), opts.repeat)
+        result, decode_time = timed(lambda: loads_json_response(body, encoding),
+                opts.repeat)
+        assert result[0] == jobs
+        report(encoding, len(body), opts.jobs, encode_time, decode_time)